@@ -0,0 +1,284 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Background writer of the generated NIfTI files.
+
+Saving a 512³ image/label pair with ``SaveImage`` gzips ~1.5 GB of voxels and blocks the generator for
+seconds per pair. ``AsyncNiftiWriter`` moves the tensors to the host and hands them to a thread pool, so
+the next pair is generated while the previous one is compressed and written:
+
+- ``submit`` takes the ``SaveImage`` arguments of one file and returns a future. At most ``max_pending``
+  files wait in host memory; beyond that ``submit`` blocks until a write finishes (back-pressure).
+- ``flush`` waits for the submitted writes, logs the write throughput and raises the first write error.
+  Leaving the ``with`` block flushes and shuts the pool down.
+- ``compression_level`` sets the gzip level (0-9) of the ``.nii.gz`` files written by this writer; it is
+  given to each file's opener (``CompressedNibabelWriter``), nibabel's process-wide default is left alone.
+- ``encoding`` (per file) stores the voxels in a compact integer dtype instead of float32 (``encode_output``):
+  ``"int16"`` rounds to integer units such as HU, ``"int16_scaled"`` lets nibabel pick ``scl_slope`` and
+  ``scl_inter`` for other intensities such as MR, and ``"uint"`` writes labels in the smallest unsigned
+  dtype. With ``verify=True`` the file is read back and its round-trip error checked (``verify_output``).
+
+Threads rather than processes: zlib and file I/O release the GIL, so the writes run in parallel without
+pickling the volumes to another process.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import torch
+from monai.data import NibabelWriter
+from monai.transforms import SaveImage
+from nibabel.openers import ImageOpener
+
+logger = logging.getLogger("maisi.async_writer")
+
+OUTPUT_ENCODINGS = ("int16", "int16_scaled", "uint")
+
+
+class _CompressedNifti1Image(nib.Nifti1Image):
+    """``Nifti1Image`` saved with its own gzip level instead of ``Opener.default_compresslevel``."""
+
+    compresslevel: int | None = None
+
+    def to_filename(self, filename, **kwargs):
+        if self.compresslevel is None:
+            return super().to_filename(filename, **kwargs)
+        file_map = self.filespec_to_file_map(filename)
+        with ImageOpener(file_map["image"].filename, "wb", compresslevel=self.compresslevel) as fobj:
+            file_map["image"].fileobj = fobj
+            self.to_file_map(file_map, **kwargs)
+        self.file_map = self.filespec_to_file_map(filename)
+
+
+class CompressedNibabelWriter(NibabelWriter):
+    """
+    ``NibabelWriter`` that takes the gzip level of the file as a ``compresslevel`` write argument,
+    e.g. ``SaveImage(writer=CompressedNibabelWriter).set_options(write_kwargs={"compresslevel": 1})``.
+    """
+
+    @classmethod
+    def create_backend_obj(cls, data_array, affine=None, dtype=None, compresslevel=None, **kwargs):
+        nii = super().create_backend_obj(data_array, affine=affine, dtype=dtype, **kwargs)
+        nii = _CompressedNifti1Image(nii.dataobj, nii.affine, header=nii.header)
+        nii.compresslevel = compresslevel
+        return nii
+
+
+class ScaledNibabelWriter(CompressedNibabelWriter):
+    """
+    ``CompressedNibabelWriter`` that keeps the floating-point data and only sets the on-disk dtype, so that
+    nibabel stores it as ``output_dtype`` integers with the ``scl_slope``/``scl_inter`` covering its range.
+    """
+
+    @classmethod
+    def create_backend_obj(cls, data_array, affine=None, dtype=None, **kwargs):
+        nii = super().create_backend_obj(data_array, affine=affine, dtype=None, **kwargs)
+        if dtype is not None:
+            nii.set_data_dtype(dtype)
+        return nii
+
+
+def encode_output(data: torch.Tensor, encoding: str | None, save_kwargs: dict) -> tuple[torch.Tensor, dict]:
+    """
+    Prepare ``data`` and the ``SaveImage`` arguments of a compact output encoding.
+
+    Args:
+        data: image or label, on the host.
+        encoding: ``None`` (``SaveImage`` defaults, float32), ``"int16"`` (values rounded to integers, e.g. CT HU;
+            falls back to ``"int16_scaled"`` beyond the int16 range), ``"int16_scaled"`` (int16 with
+            ``scl_slope``/``scl_inter``, e.g. MR) or ``"uint"`` (integer labels in uint8, uint16 or uint32).
+        save_kwargs: ``SaveImage`` arguments of the file.
+
+    Returns:
+        tuple: the data and the ``SaveImage`` arguments to write it with.
+    """
+    if encoding is None:
+        return data, save_kwargs
+    if encoding not in OUTPUT_ENCODINGS:
+        raise ValueError(f"encoding must be None or one of {OUTPUT_ENCODINGS}.\n Got {encoding}")
+    lo, hi = float(data.min()), float(data.max())
+    if encoding == "uint":
+        if lo < 0 or (data.is_floating_point() and not torch.equal(data, data.round())):
+            raise ValueError(f"'uint' encoding needs non-negative integer labels, got values in [{lo}, {hi}].")
+        dtype = np.uint8 if hi <= np.iinfo(np.uint8).max else np.uint16 if hi <= np.iinfo(np.uint16).max else np.uint32
+        return data, {**save_kwargs, "output_dtype": dtype}
+    if not str(save_kwargs.get("output_ext", ".nii.gz")).startswith(".nii"):
+        raise ValueError(f"'{encoding}' encoding is only supported for NIfTI outputs, got {save_kwargs['output_ext']}.")
+    int16 = np.iinfo(np.int16)
+    if encoding == "int16" and int16.min <= lo and hi <= int16.max:
+        return data.round(), {**save_kwargs, "output_dtype": np.int16}
+    return data, {**save_kwargs, "output_dtype": np.int16, "writer": ScaledNibabelWriter}
+
+
+def verify_output(filename: str, reference: torch.Tensor, encoding: str | None) -> float:
+    """
+    Read back a written file and check its round-trip error against the data it was written from.
+
+    The bound is half a quantization step: 0 for ``"uint"`` labels, 0.5 for rounded ``"int16"`` values and
+    half the ``scl_slope`` of scaled files.
+
+    Returns:
+        float: maximum absolute error.
+
+    Raises:
+        ValueError: when the error exceeds the bound, or the shapes differ.
+    """
+    nii = nib.load(filename)
+    decoded = nii.get_fdata(dtype=np.float64)
+    expected = np.asarray(reference.detach().cpu(), dtype=np.float64).squeeze()
+    if decoded.squeeze().shape != expected.shape:
+        raise ValueError(f"{filename}: read back shape {decoded.shape} does not match the written shape {tuple(reference.shape)}.")
+    error = float(np.abs(decoded.squeeze() - expected).max()) if expected.size else 0.0
+    slope, _ = nii.header.get_slope_inter()
+    if encoding in (None, "uint"):
+        step = 0.0
+    else:
+        step = 1.0 if slope is None else abs(slope)
+    # float32 rounding of the stored values and scale factors
+    bound = 0.5 * step + 1e-5 * max(1.0, float(np.abs(expected).max()) if expected.size else 0.0)
+    if error > bound:
+        raise ValueError(f"{filename}: round-trip error {error} of the '{encoding}' encoding exceeds {bound}.")
+    return error
+
+
+class AsyncNiftiWriter:
+    """
+    Bounded background pool of ``SaveImage`` writes.
+
+    Args:
+        num_workers: number of writer threads.
+        max_pending: maximum number of files queued or being written; ``submit`` blocks beyond it.
+        compression_level: gzip level of the ``.nii.gz`` outputs, nibabel's default when ``None``.
+        verify: read every encoded file back and check its round-trip error (``verify_output``).
+
+    Example::
+
+        with AsyncNiftiWriter(num_workers=2, compression_level=1) as writer:
+            writer.submit(image, encoding="int16", output_dir=out, output_postfix="image", separate_folder=False)
+    """
+
+    def __init__(self, num_workers: int = 2, max_pending: int = 4, compression_level: int | None = None, verify: bool = False) -> None:
+        if compression_level is not None and not 0 <= compression_level <= 9:
+            raise ValueError(f"compression_level must be None or in [0, 9].\n Got {compression_level}")
+        self.num_workers = num_workers
+        self.max_pending = max(max_pending, 1)
+        self.compression_level = compression_level
+        self.verify = verify
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._futures: list[Future] = []
+        self._reset_counters()
+
+    def _reset_counters(self) -> None:
+        self.num_files = 0
+        self.num_bytes = 0
+        self.write_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_errors: dict[str, float] = {}
+        self._start = None
+
+    def __enter__(self) -> AsyncNiftiWriter:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # keep the original exception if the block failed, the writes are still completed
+        self.close(raise_errors=exc_type is None)
+
+    def submit(self, data: torch.Tensor, encoding: str | None = None, **save_kwargs) -> Future:
+        """
+        Queue ``SaveImage(**save_kwargs)(data)``; blocks while ``max_pending`` files are in flight.
+
+        ``data`` is detached and copied to the host here (host tensors too), so the caller can reuse, modify or
+        free it once ``submit`` returns.
+        ``encoding`` is one of ``OUTPUT_ENCODINGS`` (see ``encode_output``), ``None`` keeps float32.
+
+        Returns:
+            Future: completes with the ``SaveImage`` output, or the write error.
+        """
+        if encoding is not None and encoding not in OUTPUT_ENCODINGS:
+            raise ValueError(f"encoding must be None or one of {OUTPUT_ENCODINGS}.\n Got {encoding}")
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="nifti-writer")
+        if self._start is None:
+            self._start = time.time()
+        wait_start = time.time()
+        self._slots.acquire()
+        self.wait_seconds += time.time() - wait_start
+        data = data.detach().to("cpu", copy=True)
+        future = self._executor.submit(self._write, data, encoding, save_kwargs)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def _write(self, data: torch.Tensor, encoding: str | None, save_kwargs: dict):
+        start = time.time()
+        encoded, save_kwargs = encode_output(data, encoding, save_kwargs)
+        compressed = self.compression_level is not None and str(save_kwargs.get("output_ext", ".nii.gz")).endswith(".gz")
+        if compressed:
+            save_kwargs = {"writer": CompressedNibabelWriter, **save_kwargs}
+        saver = SaveImage(**save_kwargs)
+        writer = save_kwargs.get("writer")
+        if compressed and isinstance(writer, type) and issubclass(writer, CompressedNibabelWriter):
+            saver.set_options(write_kwargs={"compresslevel": self.compression_level})
+        output = saver(encoded)
+        error = None
+        if self.verify and encoding is not None:
+            meta = getattr(data, "meta", {})
+            filename = saver.folder_layout.filename(subject=str(meta.get("filename_or_obj", "")), idx=meta.get("patch_index"))
+            error = verify_output(filename, data, encoding)
+        with self._lock:
+            self.write_seconds += time.time() - start
+            self.num_files += 1
+            self.num_bytes += data.element_size() * data.numel()
+            if error is not None:
+                self.max_errors[encoding] = max(self.max_errors.get(encoding, 0.0), error)
+        return output
+
+    def flush(self, raise_errors: bool = True) -> None:
+        """
+        Wait for all the submitted writes and log their throughput.
+
+        Args:
+            raise_errors: raise the first write error, after all the writes are done; the errors are logged either way.
+        """
+        futures, self._futures = self._futures, []
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        for e in errors:
+            logger.error(f"NIfTI write failed: {e}")
+        if self.num_files:
+            elapsed = time.time() - self._start
+            logger.info(
+                f"Wrote {self.num_files} files ({self.num_bytes / 2**30:.2f} GiB of voxels) in {elapsed:.1f}s: "
+                f"{self.num_bytes / 2**20 / max(elapsed, 1e-6):.1f} MiB/s, {self.write_seconds:.1f}s of writing over "
+                f"{self.num_workers} threads, {self.wait_seconds:.1f}s blocked on the queue."
+            )
+        for encoding, error in self.max_errors.items():
+            logger.info(f"Verified '{encoding}' outputs: maximum round-trip error {error:.4g}.")
+        self._reset_counters()
+        if errors and raise_errors:
+            raise errors[0]
+
+    def close(self, raise_errors: bool = True) -> None:
+        """Flush and stop the writer threads; a later ``submit`` starts new ones."""
+        try:
+            self.flush(raise_errors=raise_errors)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
@@ -9,60 +9,224 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import time
+from collections.abc import Callable, Sequence
+
 import numpy as np
 import torch
 import torch.nn.functional as F
+from monai.networks.layers import GaussianFilter
 from monai.transforms import Rand3DElastic, RandAffine, RandZoom
-from monai.utils import ensure_tuple_rep
+from monai.utils import convert_data_type, convert_to_dst_type, ensure_tuple_rep, fall_back_tuple
 from torch import Tensor
 
+from . import morphology
 from .utils import dilate_one_img, erode_one_img
+from .utils_label import LabelLUT
 
 MAX_COUNT = 1000  # maximum augmentation retries before raising an error
+# voxels of the organ and tumour closings (box 5, pad_value=1.0: dilation + erosion of radius 2)
+# corrupted near the edges of an organ crop
+ORGAN_CROP_REACH = 4
+PROPOSAL_BATCH_SIZE = 16  # maximum number of tumour deformations drawn and evaluated together
+PROPOSAL_BATCH_BYTES = 2**30  # memory budget of the sampling grids and warped masks of a batch
+GAUSSIAN_TRUNCATED = 3.0  # truncation of the displacement smoothing kernel, in sigmas, as in Rand3DElastic
 
+logger = logging.getLogger(__name__)
 
-def erode3d(input_tensor, erosion=3):
-    # Define the structuring element
-    erosion = ensure_tuple_rep(erosion, 3)
-    structuring_element = torch.ones(1, 1, erosion[0], erosion[1], erosion[2]).to(input_tensor.device)
-
-    # Pad the input tensor to handle border pixels
-    input_padded = F.pad(
-        input_tensor.float().unsqueeze(0).unsqueeze(0),
-        (erosion[0] // 2, erosion[0] // 2, erosion[1] // 2, erosion[1] // 2, erosion[2] // 2, erosion[2] // 2),
-        mode="constant",
-        value=1.0,
-    )
 
-    # Apply erosion operation
-    output = F.conv3d(input_padded, structuring_element, padding=0)
+def erode3d(input_tensor, erosion=3):
+    """
+    Erode a 3D binary mask with a box element, treating voxels outside the volume as foreground.
 
-    # Set output values based on the minimum value within the structuring element
-    output = torch.where(output == torch.sum(structuring_element), 1.0, 0.0)
+    Args:
+        input_tensor (torch.Tensor): binary mask of shape [X,Y,Z].
+        erosion (int | Sequence[int]): odd box size, one value or one per axis.
 
-    return output.squeeze(0).squeeze(0)
+    Returns:
+        torch.Tensor: eroded float mask of shape [X,Y,Z].
+    """
+    return morphology.erode(input_tensor, ensure_tuple_rep(erosion, 3), pad_value=1.0).float()
 
 
 def dilate3d(input_tensor, erosion=3):
-    # Define the structuring element
-    erosion = ensure_tuple_rep(erosion, 3)
-    structuring_element = torch.ones(1, 1, erosion[0], erosion[1], erosion[2]).to(input_tensor.device)
-
-    # Pad the input tensor to handle border pixels
-    input_padded = F.pad(
-        input_tensor.float().unsqueeze(0).unsqueeze(0),
-        (erosion[0] // 2, erosion[0] // 2, erosion[1] // 2, erosion[1] // 2, erosion[2] // 2, erosion[2] // 2),
-        mode="constant",
-        value=1.0,
-    )
+    """
+    Dilate a 3D binary mask with a box element, treating voxels outside the volume as foreground.
+
+    Args:
+        input_tensor (torch.Tensor): binary mask of shape [X,Y,Z].
+        erosion (int | Sequence[int]): odd box size, one value or one per axis.
+
+    Returns:
+        torch.Tensor: dilated float mask of shape [X,Y,Z].
+    """
+    return morphology.dilate(input_tensor, ensure_tuple_rep(erosion, 3), pad_value=1.0).float()
+
+
+def _organ_crop(organ_region: Tensor, name: str) -> morphology.BBoxCrop:
+    """
+    Padded bounding box of the organ a tumour is deformed in.
+
+    The margin covers the reach of the closings. The deformation needs none: the tumour lies inside the
+    box, so the source voxels outside it are background in the full volume too, and the proposals are
+    multiplied by the organ mask, which is zero outside it. The proposals are still computed in the frame
+    of the volume (``sample_tumor_proposal``), so cropping does not change them.
+    """
+    return morphology.BBoxCrop(organ_region, margin=2 * ORGAN_CROP_REACH, reach=ORGAN_CROP_REACH, name=name)
+
+
+def _mul32(x, c: int):
+    """``x * c`` modulo 2**32 for ``x`` in [0, 2**32), without overflowing int64."""
+    return ((x & 0xFFFF) * c + (((x >> 16) * (c & 0xFFFF)) << 16)) & 0xFFFFFFFF
 
-    # Apply erosion operation
-    output = F.conv3d(input_padded, structuring_element, padding=0)
 
-    # Set output values based on the minimum value within the structuring element
-    output = torch.where(output > 0, 1.0, 0.0)
+def _hash32(x):
+    """Integer hash (lowbias32) of ints or int64 tensors in [0, 2**32)."""
+    x = x ^ (x >> 16)
+    x = _mul32(x, 0x7FEB352D)
+    x = x ^ (x >> 15)
+    x = _mul32(x, 0x846CA68B)
+    return x ^ (x >> 16)
 
-    return output.squeeze(0).squeeze(0)
+
+def _volume_noise(seed: int, spatial_shape: Sequence[int], window: Sequence[slice], device: torch.device) -> Tensor:
+    """
+    Uniform noise in [-1, 1] of the three displacement components over a ``window`` of a volume.
+
+    Every value is a hash of ``seed`` and of the voxel's index in the volume, so a window gets the same
+    values as the full volume has there.
+    """
+    key = _hash32(seed & 0xFFFFFFFF)
+    x, y, z = (torch.arange(w.start, w.stop, device=device).view(shape) for w, shape in zip(window, ((-1, 1, 1), (1, -1, 1), (1, 1, -1))))
+    size_x, size_y, size_z = spatial_shape
+    channels = []
+    for c in range(3):
+        index = ((c * size_x + x) * size_y + y) * size_z + z
+        index = (index ^ (index >> 32)) & 0xFFFFFFFF
+        channels.append(_hash32(_hash32(index) ^ key).float() * (2.0 / 0xFFFFFFFF) - 1.0)
+    return torch.stack(channels)
+
+
+def _draw_deformation(transform: Rand3DElastic | RandAffine) -> dict:
+    """
+    Draw the parameters of one deformation from the random state of ``transform``.
+
+    ``Rand3DElastic`` draws a noise seed, the magnitude and the sigma of its displacement field from its own
+    random state. ``RandAffine`` makes the draws of ``RandAffine.__call__``, so a seed gives the affine
+    proposals the transform itself would. Both then draw their affine parameters from ``rand_affine_grid``.
+    """
+    params = {}
+    if isinstance(transform, Rand3DElastic):
+        params["noise_seed"] = int(transform.R.randint(0, 2**32, dtype=np.int64))
+        params["magnitude"] = float(transform.R.uniform(*transform.magnitude_range))
+        params["sigma"] = float(transform.R.uniform(*transform.sigma_range))
+    else:
+        transform.randomize()
+    transform.rand_affine_grid(spatial_size=(1, 1, 1), randomize=True, lazy=True)
+    params["affine"] = transform.rand_affine_grid.get_transformation_matrix().tolist()
+    return params
+
+
+def _source_grid(params: dict, spatial_shape: Sequence[int], slices: Sequence[slice], margin: int, device: torch.device) -> Tensor:
+    """
+    ``grid_sample`` grid of one deformation, over ``slices`` of a volume of ``spatial_shape``.
+
+    The deformation is defined on the volume as in ``Rand3DElastic``/``RandAffine``: coordinates centred on
+    the volume, displaced by the smoothed noise (smoothed over the crop padded by ``margin``, at least the
+    Gaussian kernel radius) and mapped by the affine. The nearest source voxel is rounded in volume indices
+    and addressed at its centre in the crop, so every voxel gets the same source as with the full volume.
+    """
+    views = ((-1, 1, 1), (1, -1, 1), (1, 1, -1))
+    coords = [
+        (torch.arange(s.start, s.stop, device=device, dtype=torch.float32) - (n - 1) / 2).view(v) for s, n, v in zip(slices, spatial_shape, views)
+    ]
+    if "sigma" in params:
+        window = tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n)) for s, n in zip(slices, spatial_shape))
+        noise = _volume_noise(params["noise_seed"], spatial_shape, window, device)
+        offset = GaussianFilter(3, params["sigma"], GAUSSIAN_TRUNCATED).to(device)(noise.unsqueeze(0))[0]
+        offset = offset[(slice(None), *(slice(s.start - w.start, s.stop - w.start) for s, w in zip(slices, window)))]
+        coords = [c + o * params["magnitude"] for c, o in zip(coords, offset)]
+    x, y, z = coords
+    grid = []
+    for a, s, n in zip(params["affine"], slices, spatial_shape):
+        index = torch.round(a[0] * x + a[1] * y + a[2] * z + a[3] + (n - 1) / 2) - s.start
+        grid.append((2 * index + 1) / (s.stop - s.start) - 1)
+    # grid_sample takes the coordinates in reverse axis order
+    return torch.stack(torch.broadcast_tensors(*grid[::-1]), dim=-1)
+
+
+def sample_tumor_proposal(
+    transform: Rand3DElastic | RandAffine,
+    tumor: Tensor,
+    organ_mask: Tensor,
+    min_size: Callable[[int], float],
+    box: morphology.BBoxCrop | None = None,
+    max_count: int = MAX_COUNT,
+    name: str = "tumor augmentation",
+) -> Tensor | None:
+    """
+    Draw random tumour deformations in batches until one keeps enough of the tumour inside the organ.
+
+    The parameters of a batch of deformations are drawn from the transform's random state in order, the
+    cropped tumour is warped by all of them with one ``grid_sample``, and the proposals are masked and
+    measured together, with one host synchronization per batch. The first valid proposal in draw order is
+    returned. Batches start with one proposal, most tumours fit at the first draw, and double up to
+    ``PROPOSAL_BATCH_SIZE`` (fewer if their grids exceed ``PROPOSAL_BATCH_BYTES``). The i-th proposal does
+    not depend on the batch sizes, so a given seed gives the same result for any batching.
+
+    The deformations are the ones ``transform`` applies to the full volume (nearest interpolation, zero
+    padding): centred on the volume and, for ``Rand3DElastic``, with a displacement field defined on the
+    volume. Any crop containing the tumour and the organ gives the same proposals as the full volume, up to
+    the rounding of the GPU convolutions.
+
+    Args:
+        transform: ``Rand3DElastic`` or ``RandAffine`` with ``prob=1.0``, ``mode="nearest"`` and
+            ``padding_mode="zeros"``, seeded by the caller.
+        tumor: cropped tumour, [1,H,W,D]; zero outside the crop.
+        organ_mask: cropped mask the proposals are restricted to, [1,H,W,D].
+        min_size: minimum tumour size inside the organ for the proposal of a given (0-based) index.
+        box: crop of ``tumor`` and ``organ_mask`` in the volume, None if they are the full volume.
+        max_count: maximum number of proposals.
+        name: name used in the log.
+
+    Returns:
+        Tensor | None: the first valid proposal multiplied by ``organ_mask``, or None if none of the
+        ``max_count`` proposals is valid.
+    """
+    if transform.prob != 1.0 or transform.mode != "nearest" or transform.padding_mode != "zeros":
+        raise ValueError(f"{name}: the proposals need prob=1.0, mode='nearest' and padding_mode='zeros'.")
+    start_time = time.time()
+    spatial_shape = tuple(box.spatial_shape) if box is not None else tuple(tumor.shape[1:])
+    slices = box.slices if box is not None else tuple(slice(0, n) for n in spatial_shape)
+    margin = int(max(float(transform.sigma_range[1]) * GAUSSIAN_TRUNCATED, 0.5) + 0.5) + 1 if isinstance(transform, Rand3DElastic) else 0
+    # bytes per voxel of a proposal: sampling grid, displacement field and warped masks
+    max_batch_size = int(min(PROPOSAL_BATCH_SIZE, max(PROPOSAL_BATCH_BYTES // (48 * tumor[0].numel()), 1)))
+    image = tumor.float().unsqueeze(0)
+    drawn, num_valid, num_batches, accepted = 0, 0, 0, None
+    while drawn < max_count and accepted is None:
+        count = min(2**num_batches, max_batch_size, max_count - drawn)
+        grid = torch.stack([_source_grid(_draw_deformation(transform), spatial_shape, slices, margin, tumor.device) for _ in range(count)])
+        proposals = F.grid_sample(image.expand(count, -1, -1, -1, -1), grid, mode="nearest", padding_mode="zeros", align_corners=False)
+        proposals = proposals * organ_mask
+        sizes = proposals.flatten(1).sum(1).tolist()
+        valid = [i for i, size in enumerate(sizes) if size >= min_size(drawn + i)]
+        num_valid += len(valid)
+        num_batches += 1
+        if valid:
+            accepted = valid[0]
+            proposal = proposals[accepted]
+        drawn += count
+    elapsed = time.time() - start_time
+    if accepted is None:
+        logger.info(f"{name}: none of the {max_count} proposals is valid ({num_batches} batches, {elapsed:.2f}s)")
+        return None
+    rate = num_valid / drawn
+    logger.info(
+        f"{name}: accepted proposal {drawn - count + accepted + 1} in {elapsed:.2f}s; {num_valid} of {drawn} proposals "
+        f"valid in {num_batches} batches of up to {max_batch_size} ({100 * rate:.1f}% acceptance, {1 / rate - 1:.1f} expected retries)"
+    )
+    return proposal
 
 
 def augmentation_tumor_bone(pt_nda, output_size, random_seed=None):
@@ -78,6 +242,7 @@ def augmentation_tumor_bone(pt_nda, output_size, random_seed=None):
         rotate_range=(0, 0, 0.1),
         scale_range=(0.15, 0.15, 0),
         padding_mode="zeros",
+        device=volume.device,
     )
     elastic.set_random_state(seed=random_seed)
 
@@ -95,24 +260,26 @@ def augmentation_tumor_bone(pt_nda, output_size, random_seed=None):
             + (volume == 114).float()
             + real_l_volume_
         )
-        organ_mask = (organ_mask > 0).float()
-        cnt = 0
-        while True:
-            threshold = 0.8 if cnt < 40 else 0.75
-            real_l_volume = real_l_volume_
-            # random distor mask
-            distored_mask = elastic((real_l_volume > 0).cuda(), spatial_size=tuple(output_size)).as_tensor()
-            real_l_volume = distored_mask * organ_mask
-            cnt += 1
-            print(torch.sum(real_l_volume), "|", tumor_szie * threshold)
-            if torch.sum(real_l_volume) >= tumor_szie * threshold:
-                real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
-                real_l_volume = erode3d(real_l_volume, erosion=5).unsqueeze(0).to(torch.uint8)
-                break
+        box = _organ_crop(organ_mask > 0, "augmentation_tumor_bone")
+        organ_mask = (box.crop(organ_mask) > 0).float()
+        real_l_volume_c = box.crop(real_l_volume_)
+        tumor_size = float(tumor_szie)
+        # random distor mask
+        real_l_volume = sample_tumor_proposal(
+            elastic,
+            real_l_volume_c > 0,
+            organ_mask,
+            lambda i: tumor_size * (0.8 if i < 40 else 0.75),
+            box=box,
+            name="augmentation_tumor_bone",
+        )
+        if real_l_volume is None:
+            raise ValueError("Please check if tumor is inside organ.")
+        real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
+        real_l_volume = box.restrict_to_core(erode3d(real_l_volume, erosion=5)).unsqueeze(0).to(torch.uint8)
+        box.crop(volume)[real_l_volume == 1] = 128
     else:
-        real_l_volume = real_l_volume_
-
-    volume[real_l_volume == 1] = 128
+        volume[real_l_volume_ == 1] = 128
 
     pt_nda = volume.unsqueeze(0)
     return pt_nda
@@ -134,6 +301,7 @@ def augmentation_tumor_liver(pt_nda, output_size, random_seed=None):
         rotate_range=(np.pi / 36, np.pi / 36, np.pi / 36),
         scale_range=(0.2, 0.2, 0.2),
         padding_mode="zeros",
+        device=volume.device,
     )
     elastic.set_random_state(seed=random_seed)
 
@@ -146,23 +314,29 @@ def augmentation_tumor_liver(pt_nda, output_size, random_seed=None):
     volume[real_l_volume_ == 1] = 1
     volume[real_l_volume_ == 2] = 1
     ###########################
-    while True:
-        real_l_volume = real_l_volume_
-        # random distor mask
-        real_l_volume = elastic((real_l_volume == 2).cuda(), spatial_size=tuple(output_size)).as_tensor()
-        # get organ mask
-        organ_mask = (real_l_volume_ == 1).float() + (real_l_volume_ == 2).float()
-
-        organ_mask = dilate3d(organ_mask.squeeze(0), erosion=5)
-        organ_mask = erode3d(organ_mask, erosion=5).unsqueeze(0)
-        real_l_volume = real_l_volume * organ_mask
-        print(torch.sum(real_l_volume), "|", tumor_szie * 0.80)
-        if torch.sum(real_l_volume) >= tumor_szie * 0.80:
-            real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
-            real_l_volume = erode3d(real_l_volume, erosion=5).unsqueeze(0)
-            break
+    box = _organ_crop(real_l_volume_ > 0, "augmentation_tumor_liver")
+    real_l_volume_c = box.crop(real_l_volume_)
+    # get organ mask
+    organ_mask = (real_l_volume_c == 1).float() + (real_l_volume_c == 2).float()
+
+    organ_mask = dilate3d(organ_mask.squeeze(0), erosion=5)
+    organ_mask = box.restrict_to_core(erode3d(organ_mask, erosion=5)).unsqueeze(0)
+    tumor_size = float(tumor_szie)
+    # random distor mask
+    real_l_volume = sample_tumor_proposal(
+        elastic,
+        real_l_volume_c == 2,
+        organ_mask,
+        lambda i: tumor_size * 0.80,
+        box=box,
+        name="augmentation_tumor_liver",
+    )
+    if real_l_volume is None:
+        raise ValueError("Please check if tumor is inside organ.")
+    real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
+    real_l_volume = box.restrict_to_core(erode3d(real_l_volume, erosion=5)).unsqueeze(0)
 
-    volume[real_l_volume == 1] = 26
+    box.crop(volume)[real_l_volume == 1] = 26
 
     pt_nda = volume.unsqueeze(0)
     return pt_nda
@@ -183,6 +357,7 @@ def augmentation_tumor_lung(pt_nda, output_size, random_seed=None):
         rotate_range=(np.pi / 36, np.pi / 36, np.pi),
         scale_range=(0.15, 0.15, 0.15),
         padding_mode="zeros",
+        device=volume.device,
     )
     elastic.set_random_state(seed=random_seed)
 
@@ -201,26 +376,29 @@ def augmentation_tumor_lung(pt_nda, output_size, random_seed=None):
     volume[real_l_volume_.bool()] = mode
     ###########################
     if tumor_szie > 0:
-        # aug
-        while True:
-            real_l_volume = real_l_volume_.cpu().contiguous()
-            # random distor mask
-            real_l_volume = elastic(real_l_volume, spatial_size=tuple(output_size)).as_tensor().cuda()
-            # get lung mask v2 (133 order)
-            lung_mask = (volume == 28).float() + (volume == 29).float() + (volume == 30).float() + (volume == 31).float() + (volume == 32).float()
-
-            lung_mask = dilate3d(lung_mask.squeeze(0), erosion=5)
-            lung_mask = erode3d(lung_mask, erosion=5).unsqueeze(0)
-            real_l_volume = real_l_volume * lung_mask
-            print(torch.sum(real_l_volume), "|", tumor_szie * 0.85)
-            if torch.sum(real_l_volume) >= tumor_szie * 0.85:
-                real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
-                real_l_volume = erode3d(real_l_volume, erosion=5).unsqueeze(0).to(torch.uint8)
-                break
+        # get lung mask v2 (133 order)
+        lung_mask = (volume == 28).float() + (volume == 29).float() + (volume == 30).float() + (volume == 31).float() + (volume == 32).float()
+        box = _organ_crop((lung_mask > 0) | (real_l_volume_ > 0), "augmentation_tumor_lung")
+        lung_mask = dilate3d(box.crop(lung_mask).squeeze(0), erosion=5)
+        lung_mask = box.restrict_to_core(erode3d(lung_mask, erosion=5)).unsqueeze(0)
+        real_l_volume_c = box.crop(real_l_volume_).contiguous()
+        tumor_size = float(tumor_szie)
+        # aug: random distor mask
+        real_l_volume = sample_tumor_proposal(
+            elastic,
+            real_l_volume_c,
+            lung_mask,
+            lambda i: tumor_size * 0.85,
+            box=box,
+            name="augmentation_tumor_lung",
+        )
+        if real_l_volume is None:
+            raise ValueError("Please check if tumor is inside organ.")
+        real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
+        real_l_volume = box.restrict_to_core(erode3d(real_l_volume, erosion=5)).unsqueeze(0).to(torch.uint8)
+        box.crop(volume)[real_l_volume == 1] = 23
     else:
-        real_l_volume = real_l_volume_
-
-    volume[real_l_volume == 1] = 23
+        volume[real_l_volume_ == 1] = 23
 
     pt_nda = volume.unsqueeze(0)
     return pt_nda
@@ -242,6 +420,7 @@ def augmentation_tumor_pancreas(pt_nda, output_size, random_seed=None):
         rotate_range=(np.pi / 36, np.pi / 36, np.pi / 36),
         scale_range=(0.1, 0.1, 0.1),
         padding_mode="zeros",
+        device=volume.device,
     )
     elastic.set_random_state(seed=random_seed)
 
@@ -254,23 +433,29 @@ def augmentation_tumor_pancreas(pt_nda, output_size, random_seed=None):
     volume[real_l_volume_ == 1] = 4
     volume[real_l_volume_ == 2] = 4
     ###########################
-    while True:
-        real_l_volume = real_l_volume_
-        # random distor mask
-        real_l_volume = elastic((real_l_volume == 2).cuda(), spatial_size=tuple(output_size)).as_tensor()
-        # get organ mask
-        organ_mask = (real_l_volume_ == 1).float() + (real_l_volume_ == 2).float()
-
-        organ_mask = dilate3d(organ_mask.squeeze(0), erosion=5)
-        organ_mask = erode3d(organ_mask, erosion=5).unsqueeze(0)
-        real_l_volume = real_l_volume * organ_mask
-        print(torch.sum(real_l_volume), "|", tumor_szie * 0.80)
-        if torch.sum(real_l_volume) >= tumor_szie * 0.80:
-            real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
-            real_l_volume = erode3d(real_l_volume, erosion=5).unsqueeze(0)
-            break
+    box = _organ_crop(real_l_volume_ > 0, "augmentation_tumor_pancreas")
+    real_l_volume_c = box.crop(real_l_volume_)
+    # get organ mask
+    organ_mask = (real_l_volume_c == 1).float() + (real_l_volume_c == 2).float()
+
+    organ_mask = dilate3d(organ_mask.squeeze(0), erosion=5)
+    organ_mask = box.restrict_to_core(erode3d(organ_mask, erosion=5)).unsqueeze(0)
+    tumor_size = float(tumor_szie)
+    # random distor mask
+    real_l_volume = sample_tumor_proposal(
+        elastic,
+        real_l_volume_c == 2,
+        organ_mask,
+        lambda i: tumor_size * 0.80,
+        box=box,
+        name="augmentation_tumor_pancreas",
+    )
+    if real_l_volume is None:
+        raise ValueError("Please check if tumor is inside organ.")
+    real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
+    real_l_volume = box.restrict_to_core(erode3d(real_l_volume, erosion=5)).unsqueeze(0)
 
-    volume[real_l_volume == 1] = 24
+    box.crop(volume)[real_l_volume == 1] = 24
 
     pt_nda = volume.unsqueeze(0)
     return pt_nda
@@ -291,6 +476,7 @@ def augmentation_tumor_colon(pt_nda, output_size, random_seed=None):
         rotate_range=(np.pi / 36, np.pi / 36, np.pi / 36),
         scale_range=(0.1, 0.1, 0.1),
         padding_mode="zeros",
+        device=volume.device,
     )
     elastic.set_random_state(seed=random_seed)
 
@@ -301,34 +487,35 @@ def augmentation_tumor_colon(pt_nda, output_size, random_seed=None):
     ###########################
     if tumor_szie > 0:
         # get organ mask
-        organ_mask = (volume == 62).float()
+        box = _organ_crop(volume == 62, "augmentation_tumor_colon")
+        organ_mask = (box.crop(volume) == 62).float()
         organ_mask = dilate3d(organ_mask.squeeze(0), erosion=5)
-        organ_mask = erode3d(organ_mask, erosion=5).unsqueeze(0)
-        #         cnt = 0
-        cnt = 0
-        while True:
-            threshold = 0.8
-            real_l_volume = real_l_volume_
-            if cnt < 20:
-                # random distor mask
-                distored_mask = elastic((real_l_volume == 1).cuda(), spatial_size=tuple(output_size)).as_tensor()
-                real_l_volume = distored_mask * organ_mask
-            elif 20 <= cnt < 40:
-                threshold = 0.75
-            else:
-                break
-
-            real_l_volume = real_l_volume * organ_mask
-            print(torch.sum(real_l_volume), "|", tumor_szie * threshold)
-            cnt += 1
-            if torch.sum(real_l_volume) >= tumor_szie * threshold:
-                real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
-                real_l_volume = erode3d(real_l_volume, erosion=5).unsqueeze(0).to(torch.uint8)
-                break
+        organ_mask = box.restrict_to_core(erode3d(organ_mask, erosion=5)).unsqueeze(0)
+        real_l_volume_c = box.crop(real_l_volume_)
+        tumor_size = float(tumor_szie)
+        # random distor mask, at most 20 times
+        real_l_volume = sample_tumor_proposal(
+            elastic,
+            real_l_volume_c == 1,
+            organ_mask,
+            lambda i: tumor_size * 0.8,
+            box=box,
+            max_count=20,
+            name="augmentation_tumor_colon",
+        )
+        if real_l_volume is None:
+            # keep the tumour in place, restricted to the colon if enough of it remains
+            real_l_volume = real_l_volume_c * organ_mask
+            if torch.sum(real_l_volume) < tumor_size * 0.75:
+                real_l_volume = None
+        if real_l_volume is not None:
+            real_l_volume = dilate3d(real_l_volume.squeeze(0), erosion=5)
+            real_l_volume = box.restrict_to_core(erode3d(real_l_volume, erosion=5)).unsqueeze(0).to(torch.uint8)
+        else:
+            real_l_volume = real_l_volume_c
+        box.crop(volume)[real_l_volume == 1] = 27
     else:
-        real_l_volume = real_l_volume_
-    #     break
-    volume[real_l_volume == 1] = 27
+        volume[real_l_volume_ == 1] = 27
 
     pt_nda = volume.unsqueeze(0)
     return pt_nda
@@ -361,7 +548,7 @@ def augmentation_tumor_only(
         tumor_mask: input 3D tumor mask, [1,H,W,D] torch tensor.
         organ_mask: input 3D tumor mask, [1,H,W,D] torch tensor, binary mask.
         aug_transform: tumor augmentation transform
-        spatial_size: output image spatial size, used in random transform.
+        spatial_size: output image spatial size, used in random transform; it has to resolve to (H,W,D).
                       If not defined, will use (H,W,D). If some components are non-positive values,
                       the transform will use the corresponding components of whole_mask size.
                       For example, spatial_size=(128, 128, -1) will be adapted to (128, 128, 64)
@@ -387,21 +574,25 @@ def augmentation_tumor_only(
     tumor_size = torch.sum(tumor_region_binary_mask)
     ###########################
     if tumor_size > 0:
-        count = 0
         # get organ mask
         organ_mask = dilate_one_img(organ_mask.squeeze(0), filter_size=5, pad_value=1.0)
         organ_mask = erode_one_img(organ_mask, filter_size=5, pad_value=1.0).unsqueeze(0)
-        while True:
-            tumor_mask = tumor_mask_
-            # apply random augmentation to tumor region only, excluding organ basis
-            augmented_mask = aug_transform(tumor_mask_ * tumor_region_binary_mask, spatial_size=spatial_size).as_tensor()
-            # generate final tumor mask
-            count += 1
-            tumor_mask = finalize_tumor_mask(augmented_mask, organ_mask, tumor_size * min_tumor_size_ratio)
-            if tumor_mask is not None:
-                break
-            if count > MAX_COUNT:
-                raise ValueError("Please check if tumor is inside organ.")
+        threshold_tumor_size = float(tumor_size) * min_tumor_size_ratio
+        # apply random augmentation to tumor region only, excluding organ basis
+        if tuple(fall_back_tuple(spatial_size, tumor_mask_.shape[1:])) != tuple(tumor_mask_.shape[1:]):
+            raise ValueError(f"spatial_size must match the mask shape {tuple(tumor_mask_.shape[1:])}, got {spatial_size}.")
+        augmented_mask = sample_tumor_proposal(
+            aug_transform,
+            tumor_mask_ * tumor_region_binary_mask,
+            organ_mask,
+            lambda i: threshold_tumor_size,
+            max_count=MAX_COUNT + 1,
+            name="augmentation_tumor_only",
+        )
+        if augmented_mask is None:
+            raise ValueError("Please check if tumor is inside organ.")
+        # generate final tumor mask
+        tumor_mask = finalize_tumor_mask(augmented_mask, organ_mask, threshold_tumor_size)
     else:
         tumor_mask = tumor_mask_
 
@@ -464,6 +655,7 @@ def augmentation(pt_nda, output_size, random_seed=None):
             rotate_range=(np.pi / 90, np.pi / 90, np.pi / 90),
             scale_range=(0.2, 0.2, 0.2),
             padding_mode="zeros",
+            device=pt_nda.device,
         )
         elastic_tumor.set_random_state(seed=random_seed)
         volume = pt_nda.squeeze(0)
@@ -581,6 +773,9 @@ def remap_labels(x, mapping: dict[int, int]):
     """
     Remap integer labels in a tensor.
 
+    The remap is a single lookup-table gather; floating-point label tensors are expected to
+    hold integral values.
+
     Args:
         x (torch.Tensor): Input label tensor.
         mapping (dict[int,int]): Mapping from old label ids to new label ids.
@@ -588,7 +783,8 @@ def remap_labels(x, mapping: dict[int, int]):
     Returns:
         torch.Tensor: A copy of `x` with values replaced according to mapping.
     """
-    out = x.clone()
-    for old, new in mapping.items():
-        out[x == old] = new
+    index, *_ = convert_data_type(x, torch.Tensor)
+    if index.is_floating_point():
+        index = index.long()
+    out, *_ = convert_to_dst_type(LabelLUT(mapping, dtype=x.dtype)(index), dst=x)
     return out
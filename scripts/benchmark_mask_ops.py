@@ -0,0 +1,543 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks of the label-mask operations against their previous loop-based implementations.
+
+Each subcommand builds a synthetic label volume, checks that the current implementation
+matches the reference one exactly, and reports the timings:
+
+    python -m scripts.benchmark_mask_ops --size 512 --device cuda remap
+"""
+
+from __future__ import annotations
+
+import argparse
+import copy
+import json
+import logging
+import time
+from collections.abc import Callable
+from unittest import mock
+
+import numpy as np
+import scipy.stats
+import skimage
+import torch
+
+from . import augmentation, morphology
+from .augmentation import remap_labels as augmentation_remap_labels
+from .quality_check import CT_LABEL_GROUPS, get_masked_data, is_outlier
+from .utils import (
+    MapLabelValue,
+    dilate_one_img,
+    erode_one_img,
+    general_mask_generation_post_process,
+    get_index_arr,
+    organ_fill_by_closing,
+    organ_fill_by_removed_mask,
+    supress_non_largest_components,
+)
+from .utils_label import LabelLUT, load_label_lut
+
+
+def _timeit(fn: Callable, repeats: int, device: torch.device | None = None) -> tuple[float, object]:
+    """Return the best wall time of ``repeats`` calls of ``fn`` and its last output."""
+    best, out = float("inf"), None
+    for _ in range(repeats):
+        if device is not None and device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        out = fn()
+        if device is not None and device.type == "cuda":
+            torch.cuda.synchronize(device)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def _report(name: str, reference_time: float, current_time: float, equal: bool) -> None:
+    print(
+        f"{name:<40s} reference {reference_time * 1e3:10.1f} ms | current {current_time * 1e3:10.1f} ms | "
+        f"speedup {reference_time / current_time:7.1f}x | identical: {equal}"
+    )
+
+
+def _random_labels(size: int, num_labels: int, seed: int) -> np.ndarray:
+    """Blocky random label volume, so that labels form contiguous regions like a real segmentation."""
+    rng = np.random.default_rng(seed)
+    block = 16
+    coarse = rng.integers(0, num_labels, size=(size // block + 1,) * 3, dtype=np.int64)
+    labels = np.repeat(np.repeat(np.repeat(coarse, block, 0), block, 1), block, 2)
+    return np.ascontiguousarray(labels[:size, :size, :size]).astype(np.uint8)
+
+
+def _legacy_map_label_value_numpy(img: np.ndarray, pairs: tuple, dtype) -> np.ndarray:
+    img_flat = img.flatten()
+    out_flat = img_flat.astype(dtype)
+    for o, t in pairs:
+        out_flat[img_flat == o] = t
+    return out_flat.reshape(img.shape)
+
+
+def _legacy_map_label_value_torch(img: torch.Tensor, pairs: tuple, dtype) -> torch.Tensor:
+    out = img.detach().clone().to(dtype)
+    for o, t in pairs:
+        out[img == o] = t
+    return out
+
+
+def _legacy_augmentation_remap(x: torch.Tensor, mapping: dict) -> torch.Tensor:
+    out = x.clone()
+    for old, new in mapping.items():
+        out[x == old] = new
+    return out
+
+
+def benchmark_remap(args: argparse.Namespace) -> None:
+    """Benchmark the lookup-table remap against the per-label masked-assignment loops."""
+    with open(args.label_dict_remap_json) as f:
+        mapping_dict = json.load(f)
+    orig_labels = [pair[0] for pair in mapping_dict.values()]
+    target_labels = [pair[1] for pair in mapping_dict.values()]
+    pairs = tuple((o, t) for o, t in zip(orig_labels, target_labels) if o != t)
+    labels_np = _random_labels(args.size, max(orig_labels) + 1, args.seed)
+    device = torch.device(args.device)
+    print(f"remap: {args.size}^3 volume, {len(pairs)} remapped labels, device {device}")
+
+    # MapLabelValue, numpy backend
+    mapper = MapLabelValue(orig_labels, target_labels, dtype=np.int16)
+    t_ref, ref = _timeit(lambda: _legacy_map_label_value_numpy(labels_np, pairs, np.int16), args.repeats)
+    t_cur, cur = _timeit(lambda: mapper(labels_np), args.repeats)
+    _report("MapLabelValue (numpy)", t_ref, t_cur, np.array_equal(ref, cur))
+
+    # utils.remap_labels path: cached LUT from the JSON file, torch backend
+    labels_t = torch.from_numpy(labels_np).long().to(device)
+    lut = load_label_lut(args.label_dict_remap_json, dtype=torch.long)
+    t_ref, ref = _timeit(lambda: _legacy_map_label_value_torch(labels_t, pairs, torch.long), args.repeats, device)
+    t_cur, cur = _timeit(lambda: lut(labels_t), args.repeats, device)
+    _report(f"remap_labels JSON LUT (torch, {device.type})", t_ref, t_cur, torch.equal(ref, cur))
+
+    # augmentation.remap_labels with an explicit mapping dict
+    mapping = dict(pairs)
+    t_ref, ref = _timeit(lambda: _legacy_augmentation_remap(labels_t, mapping), args.repeats, device)
+    t_cur, cur = _timeit(lambda: augmentation_remap_labels(labels_t, mapping), args.repeats, device)
+    _report(f"augmentation.remap_labels ({device.type})", t_ref, t_cur, torch.equal(ref, cur))
+
+    # raw LUT on a uint8 volume, no dtype conversion
+    labels_u8 = torch.from_numpy(labels_np).to(device)
+    lut_u8 = LabelLUT(mapping)
+    t_ref, ref = _timeit(lambda: _legacy_augmentation_remap(labels_u8, mapping), args.repeats, device)
+    t_cur, cur = _timeit(lambda: lut_u8(labels_u8), args.repeats, device)
+    _report(f"LabelLUT uint8 ({device.type})", t_ref, t_cur, torch.equal(ref, cur))
+
+
+def _legacy_supress_non_largest_components(img, target_label, default_val=0):
+    index_arr = get_index_arr(img)
+    img_mod = copy.deepcopy(img)
+    new_background = np.zeros(img.shape, dtype=np.bool_)
+    for label in target_label:
+        label_cc = skimage.measure.label(img == label, connectivity=3)
+        uv, uc = np.unique(label_cc, return_counts=True)
+        dominant_vals = uv[np.argsort(uc)[::-1][:2]]
+        if len(dominant_vals) >= 2:
+            new_background = np.logical_or(
+                new_background,
+                np.logical_not(np.logical_or(label_cc == dominant_vals[0], label_cc == dominant_vals[1])),
+            )
+    for voxel in index_arr[new_background]:
+        img_mod[tuple(voxel)] = default_val
+    diff = np.sum((img - img_mod) > 0)
+    return img_mod, diff
+
+
+def _fragmented_labels(size: int, labels: list[int], seed: int) -> np.ndarray:
+    """Label volume where every label has one large component and many small fragments."""
+    rng = np.random.default_rng(seed)
+    volume = np.zeros((size,) * 3, dtype=np.uint8)
+    block = max(size // 8, 4)
+    for i, label in enumerate(labels):
+        # one large block per label
+        x0 = (i * block) % (size - block)
+        volume[x0 : x0 + block, x0 : x0 + block, size // 4 : size // 4 + block] = label
+        # scattered small fragments of the same label
+        centers = rng.integers(0, size - 3, size=(size // 4, 3))
+        for cx, cy, cz in centers:
+            volume[cx : cx + 2, cy : cy + 2, cz : cz + 2] = label
+    return volume
+
+
+def benchmark_suppress(args: argparse.Namespace) -> None:
+    """Benchmark the bounding-box, boolean-mask component suppression against the per-voxel loop."""
+    labels = [int(v) for v in args.labels.split(",")]
+    volume = _fragmented_labels(args.size, labels, args.seed)
+    print(f"suppress: {args.size}^3 volume, labels {labels}")
+    t_ref, ref = _timeit(lambda: _legacy_supress_non_largest_components(volume, labels, default_val=200), args.repeats)
+    t_cur, cur = _timeit(lambda: supress_non_largest_components(volume, labels, default_val=200), args.repeats)
+    _report("supress_non_largest_components", t_ref, t_cur, np.array_equal(ref[0], cur[0]) and ref[1] == cur[1])
+
+
+def _synthetic_generated_mask(size: int, target_tumor_label: int | None, seed: int) -> np.ndarray:
+    """Label volume resembling a generated mask: body, organs with fragments, holes and a tumor."""
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*(np.linspace(-1, 1, size),) * 3, indexing="ij"))
+    volume = np.zeros((size,) * 3, dtype=np.int64)
+    volume[np.sum(grid[:2] ** 2, axis=0) < 0.8] = 200
+    organs = [1, 3, 4, 5, 14, 12, 13, 19, 62, 28, 29, 30, 31, 32, 25, 132, 33, 34]
+    for organ in organs:
+        center = rng.uniform(-0.5, 0.5, size=3)
+        radius = rng.uniform(0.08, 0.2)
+        volume[np.sum((grid - center[:, None, None, None]) ** 2, axis=0) < radius**2] = organ
+        # small detached fragments and holes
+        for _ in range(4):
+            cx, cy, cz = rng.integers(2, size - 4, size=3)
+            volume[cx : cx + 2, cy : cy + 2, cz : cz + 2] = organ
+    holes = rng.random(volume.shape) < 0.002
+    volume[holes & (volume != 200)] = 200
+    if target_tumor_label is not None:
+        host = {23: 28, 24: 4, 26: 1, 27: 62, 128: 200, 129: 5}.get(target_tumor_label, 1)
+        host_voxels = np.argwhere(volume == host)
+        if len(host_voxels) > 0:
+            cx, cy, cz = host_voxels[len(host_voxels) // 2]
+            r = max(size // 32, 2)
+            volume[cx - r : cx + r, cy - r : cy + r, cz - r : cz + r] = target_tumor_label
+    return volume
+
+
+def _legacy_general_mask_generation_post_process(volume_t, target_tumor_label=None, device="cuda:0"):
+    """Step-by-step NumPy implementation that ``general_mask_generation_post_process`` replaced."""
+    # assume volume_t is np array with shape (H,W,D)
+    hepatic_vessel = volume_t == 25
+    airway = volume_t == 132
+
+    # ------------ refine body mask pred
+    body_region_mask = erode_one_img(torch.from_numpy(volume_t > 0).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
+    body_region_mask, _ = supress_non_largest_components(body_region_mask, [1])
+    body_region_mask = dilate_one_img(torch.from_numpy(body_region_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy().astype(np.long)
+    volume_t = volume_t * body_region_mask
+
+    # ------------ refine tumor pred
+    tumor_organ_dict = {23: 28, 24: 4, 26: 1, 27: 62, 128: 200}
+    for t in [23, 24, 26, 27, 128]:
+        if t != target_tumor_label:
+            volume_t[volume_t == t] = tumor_organ_dict[t]
+        else:
+            volume_t[organ_fill_by_closing(volume_t, target_label=t, device=device)] = t
+            volume_t[organ_fill_by_closing(volume_t, target_label=t, device=device)] = t
+    # we only keep the largest connected componet for tumors except hepatic tumor and bone lesion
+    if target_tumor_label != 26 and target_tumor_label != 128:
+        volume_t, _ = supress_non_largest_components(volume_t, [target_tumor_label], default_val=200)
+    target_tumor = volume_t == target_tumor_label
+
+    # ------------ remove undesired organ pred
+    # general post-process non-largest components suppression
+    # process 4 ROI organs + spleen + 2 kidney + 5 lung lobes + duodenum + inferior vena cava
+    oran_list = [1, 4, 10, 12, 3, 28, 29, 30, 31, 32, 5, 14, 13, 6, 7, 8, 9, 10]
+    if target_tumor_label != 128:
+        oran_list += list(range(33, 60))  # + list(range(63,87))
+    data, _ = supress_non_largest_components(volume_t, oran_list, default_val=200)  # 200 is body region
+    organ_remove_mask = (volume_t - data).astype(np.bool_)
+    # process intestinal system (stomach 12, duodenum 13, small bowel 19, colon 62)
+    intestinal_mask_ = (data == 12).astype(np.long) + (data == 13).astype(np.long) + (data == 19).astype(np.long) + (data == 62).astype(np.long)
+    intestinal_mask, _ = supress_non_largest_components(intestinal_mask_, [1], default_val=0)
+    # process small bowel 19
+    small_bowel_remove_mask = (data == 19).astype(np.long) - (data == 19).astype(np.long) * intestinal_mask
+    # process colon 62
+    colon_remove_mask = (data == 62).astype(np.long) - (data == 62).astype(np.long) * intestinal_mask
+    intestinal_remove_mask = (small_bowel_remove_mask + colon_remove_mask).astype(np.bool_)
+    data[intestinal_remove_mask] = 200
+
+    # ------------ full correponding organ in removed regions
+    for organ_label in oran_list:
+        data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+
+    if target_tumor_label == 23 and np.sum(target_tumor) > 0:
+        # speical process for cases with lung tumor
+        dia_lung_tumor_mask = dilate_one_img(torch.from_numpy(data == 23).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
+        tmp = (data * (dia_lung_tumor_mask.astype(np.long) - (data == 23).astype(np.long))).astype(np.float32).flatten()
+        tmp[tmp == 0] = float("nan")
+        mode = int(scipy.stats.mode(tmp.flatten(), nan_policy="omit")[0])
+        if mode in [28, 29, 30, 31, 32]:
+            dia_lung_tumor_mask = dilate_one_img(torch.from_numpy(dia_lung_tumor_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
+            lung_remove_mask = dia_lung_tumor_mask.astype(np.long) - (data == 23).astype(np.long).astype(np.long)
+            data[organ_fill_by_removed_mask(data, target_label=mode, remove_mask=lung_remove_mask, device=device)] = mode
+        dia_lung_tumor_mask = dilate_one_img(torch.from_numpy(dia_lung_tumor_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
+        data[organ_fill_by_removed_mask(data, target_label=23, remove_mask=dia_lung_tumor_mask * organ_remove_mask, device=device)] = 23
+        for organ_label in [28, 29, 30, 31, 32]:
+            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+
+    if target_tumor_label == 26 and np.sum(target_tumor) > 0:
+        # speical process for cases with hepatic tumor
+        # process liver 1
+        data[organ_fill_by_removed_mask(data, target_label=1, remove_mask=intestinal_remove_mask, device=device)] = 1
+        data[organ_fill_by_removed_mask(data, target_label=1, remove_mask=intestinal_remove_mask, device=device)] = 1
+        # process spleen 2
+        data[organ_fill_by_removed_mask(data, target_label=3, remove_mask=organ_remove_mask, device=device)] = 3
+        data[organ_fill_by_removed_mask(data, target_label=3, remove_mask=organ_remove_mask, device=device)] = 3
+        dia_tumor_mask = dilate_one_img(torch.from_numpy(data == target_tumor_label).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
+        dia_tumor_mask = dilate_one_img(torch.from_numpy(dia_tumor_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
+        data[organ_fill_by_removed_mask(data, target_label=target_tumor_label, remove_mask=dia_tumor_mask * organ_remove_mask, device=device)] = (
+            target_tumor_label
+        )
+        # refine hepatic tumor
+        hepatic_tumor_vessel_liver_mask_ = (data == 26).astype(np.long) + (data == 25).astype(np.long) + (data == 1).astype(np.long)
+        hepatic_tumor_vessel_liver_mask_ = (hepatic_tumor_vessel_liver_mask_ > 1).astype(np.long)
+        hepatic_tumor_vessel_liver_mask, _ = supress_non_largest_components(hepatic_tumor_vessel_liver_mask_, [1], default_val=0)
+        removed_region = (hepatic_tumor_vessel_liver_mask_ - hepatic_tumor_vessel_liver_mask).astype(np.bool_)
+        data[removed_region] = 200
+        target_tumor = (target_tumor * hepatic_tumor_vessel_liver_mask).astype(np.bool_)
+        # refine liver
+        data[organ_fill_by_closing(data, target_label=1, device=device)] = 1
+        data[organ_fill_by_closing(data, target_label=1, device=device)] = 1
+        data[organ_fill_by_closing(data, target_label=1, device=device)] = 1
+
+    if target_tumor_label == 27 and np.sum(target_tumor) > 0:
+        # speical process for cases with colon tumor
+        dia_tumor_mask = dilate_one_img(torch.from_numpy(data == target_tumor_label).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
+        dia_tumor_mask = dilate_one_img(torch.from_numpy(dia_tumor_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
+        data[organ_fill_by_removed_mask(data, target_label=target_tumor_label, remove_mask=dia_tumor_mask * organ_remove_mask, device=device)] = (
+            target_tumor_label
+        )
+
+    if target_tumor_label == 129 and np.sum(target_tumor) > 0:
+        # speical process for cases with kidney tumor
+        for organ_label in [5, 14]:
+            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+    # TODO: current model does not support hepatic vessel by size control.
+    # we treat it as liver for better visiaulization
+    print(
+        "Current model does not support hepatic vessel by size control, "
+        "so we treat generated hepatic vessel as part of liver for better visiaulization."
+    )
+    data[hepatic_vessel] = 1
+    data[airway] = 132
+    if target_tumor_label is not None:
+        data[target_tumor] = target_tumor_label
+
+    return data
+
+
+def benchmark_postprocess(args: argparse.Namespace) -> None:
+    """Check the device-resident mask post-processing against the NumPy pipeline and time both."""
+    device = torch.device(args.device)
+    targets = [None if v == "none" else int(v) for v in args.target_tumor_labels.split(",")]
+    for target in targets:
+        if args.mask is not None:
+            import nibabel as nib
+
+            volume = np.asarray(nib.load(args.mask).dataobj).astype(np.int64)
+        else:
+            volume = _synthetic_generated_mask(args.size, target, args.seed)
+        print(f"postprocess: volume {volume.shape}, target tumor {target}, device {device}")
+        t_ref, ref = _timeit(lambda: _legacy_general_mask_generation_post_process(volume.copy(), target, device=device), args.repeats)
+        t_cur, cur = _timeit(
+            lambda: general_mask_generation_post_process(volume.copy(), target, device=device, morph_batch_size=args.morph_batch_size),
+            args.repeats,
+            device,
+        )
+        _report(f"post-process (target {target})", t_ref, t_cur, np.array_equal(ref, cur))
+
+
+def benchmark_morphology(args: argparse.Namespace) -> None:
+    """Benchmark the separable max-pool morphology against MONAI's dense-convolution morphology."""
+    from monai.transforms.utils_morphological_ops import dilate as conv_dilate
+    from monai.transforms.utils_morphological_ops import erode as conv_erode
+
+    device = torch.device(args.device)
+    mask = torch.from_numpy(_random_labels(args.size, 2, args.seed)).to(device)[None, None].float()
+    print(f"morphology: {args.size}^3 binary mask, device {device}")
+    for k in [int(v) for v in args.kernel_sizes.split(",")]:
+        for name, reference_fn, current_fn, pad_value in [
+            ("dilate", conv_dilate, morphology.dilate, 0.0),
+            ("erode", conv_erode, morphology.erode, 1.0),
+        ]:
+            t_ref, ref = _timeit(lambda: reference_fn(mask, k, pad_value=pad_value), args.repeats, device)
+            t_cur, cur = _timeit(lambda: current_fn(mask, k, pad_value=pad_value), args.repeats, device)
+            _report(f"{name} box {k}x{k}x{k}", t_ref, t_cur, torch.equal(ref, cur))
+        t_cur, _ = _timeit(lambda: morphology.dilate(mask, k, element="ball"), args.repeats, device)
+        print(f"{'dilate ball radius ' + str(k // 2):<40s} current {t_cur * 1e3:10.1f} ms")
+
+
+def _legacy_organ_fill_by_closing(data, target_label, device, close_times=2, filter_size=3, pad_value=0.0):
+    mask = torch.from_numpy((data == target_label).astype(np.int64)).to(device)
+    for _ in range(close_times):
+        mask = dilate_one_img(mask, filter_size=filter_size, pad_value=pad_value)
+        mask = erode_one_img(mask, filter_size=filter_size, pad_value=pad_value)
+    return mask.cpu().numpy().astype(np.bool_)
+
+
+def _legacy_organ_fill_by_removed_mask(data, target_label, remove_mask, device):
+    mask = dilate_one_img(torch.from_numpy((data == target_label).astype(np.int64)).to(device), filter_size=3, pad_value=0.0)
+    mask = dilate_one_img(mask, filter_size=3, pad_value=0.0)
+    roi_oragn_mask = dilate_one_img(mask, filter_size=3, pad_value=0.0).cpu().numpy()
+    return (roi_oragn_mask * remove_mask).astype(np.bool_)
+
+
+def benchmark_crop(args: argparse.Namespace) -> None:
+    """Check the bounding-box cropped organ fills against the whole-volume ones and time both."""
+    device = torch.device(args.device)
+    volume = _synthetic_generated_mask(args.size, 23, args.seed)
+    remove_mask = np.zeros(volume.shape, dtype=np.bool_)
+    c, r = args.size // 2, max(args.size // 16, 2)
+    remove_mask[c - r : c + r, c - r : c + r, c - r : c + r] = True
+    print(f"crop: volume {volume.shape}, device {device}")
+    for label in [int(v) for v in args.labels.split(",")]:
+        box = morphology.bounding_box(volume == label)
+        if box is None:
+            print(f"label {label} is absent, skipped")
+            continue
+        fraction = np.prod([s.stop - s.start for s in box]) / volume.size
+        for pad_value in [0.0, 1.0]:
+            t_ref, ref = _timeit(lambda: _legacy_organ_fill_by_closing(volume, label, device, pad_value=pad_value), args.repeats, device)
+            t_cur, cur = _timeit(lambda: organ_fill_by_closing(volume, label, device, pad_value=pad_value), args.repeats, device)
+            _report(f"closing label {label} pad {pad_value} ({fraction:.1%} box)", t_ref, t_cur, np.array_equal(ref, cur))
+        t_ref, ref = _timeit(lambda: _legacy_organ_fill_by_removed_mask(volume, label, remove_mask, device), args.repeats, device)
+        t_cur, cur = _timeit(lambda: organ_fill_by_removed_mask(volume, label, remove_mask, device), args.repeats, device)
+        _report(f"removed-mask fill label {label}", t_ref, t_cur, np.array_equal(ref, cur))
+
+
+def _synthetic_tumor_volume(size: int, organ_label: int, tumor_label: int) -> torch.Tensor:
+    """Ball-shaped organ with a tumour near its surface, so that some deformations leave the organ; [1,1,X,Y,Z]."""
+    grid = torch.stack(torch.meshgrid(*[torch.arange(size, dtype=torch.float32)] * 3, indexing="ij"))
+    center = size / 2
+    volume = torch.zeros((size,) * 3)
+    volume[(grid - center).pow(2).sum(0) <= (size / 5) ** 2] = organ_label
+    volume[(grid - center - 0.08 * size).pow(2).sum(0) <= (size / 20) ** 2] = tumor_label
+    return volume[None, None]
+
+
+def benchmark_tumor(args: argparse.Namespace) -> None:
+    """Check the tumour augmentations on the organ crop against the same ones on the whole volume and time both."""
+    device = torch.device(args.device)
+    cases = {
+        "bone": (augmentation.augmentation_tumor_bone, 40, 128),
+        "liver": (augmentation.augmentation_tumor_liver, 1, 26),
+        "lung": (augmentation.augmentation_tumor_lung, 29, 23),
+        "pancreas": (augmentation.augmentation_tumor_pancreas, 4, 24),
+        "colon": (augmentation.augmentation_tumor_colon, 62, 27),
+    }
+
+    def _whole_volume(roi, name):
+        return morphology.BBoxCrop(torch.ones(roi.shape[-3:], dtype=torch.bool, device=roi.device), name=name)
+
+    print(f"tumor: volume {(args.size,) * 3}, device {device}")
+    for name in args.organs.split(","):
+        fn, organ_label, tumor_label = cases[name]
+        volume = _synthetic_tumor_volume(args.size, organ_label, tumor_label).to(device)
+        with mock.patch.object(augmentation, "_organ_crop", _whole_volume):
+            t_ref, ref = _timeit(lambda: fn(volume.clone(), volume.shape[-3:], args.seed), args.repeats, device)
+        t_cur, cur = _timeit(lambda: fn(volume.clone(), volume.shape[-3:], args.seed), args.repeats, device)
+        _report(f"augmentation_tumor_{name} crop vs whole volume", t_ref, t_cur, torch.equal(ref, cur))
+        with mock.patch.object(augmentation, "PROPOSAL_BATCH_SIZE", 1):
+            t_one, one = _timeit(lambda: fn(volume.clone(), volume.shape[-3:], args.seed), args.repeats, device)
+        _report(f"augmentation_tumor_{name} one vs batched proposals", t_one, t_cur, torch.equal(one, cur))
+
+
+def _legacy_is_outlier(statistics, image_data, label_data, label_int_dict):
+    outlier_results = {}
+    for label_name, stats in statistics.items():
+        low_thresh = min(stats["sigma_6_low"], stats["percentile_0_5"])
+        high_thresh = max(stats["sigma_6_high"], stats["percentile_99_5"])
+        if label_name == "bone":
+            high_thresh = 1000.0
+        masked_data = get_masked_data(label_data, image_data, label_int_dict.get(label_name, []))
+        masked_data = masked_data[~np.isnan(masked_data)]
+        if masked_data.size == 0:
+            outlier_results[label_name] = {"is_outlier": False, "median_value": None, "low_thresh": low_thresh, "high_thresh": high_thresh}
+            continue
+        median_value = np.nanmedian(masked_data)
+        if np.isnan(median_value):
+            median_value = None
+            is_outlier = False
+        else:
+            is_outlier = median_value < low_thresh or median_value > high_thresh
+        outlier_results[label_name] = {
+            "is_outlier": is_outlier,
+            "median_value": median_value,
+            "low_thresh": low_thresh,
+            "high_thresh": high_thresh,
+        }
+    return outlier_results
+
+
+def benchmark_qc(args: argparse.Namespace) -> None:
+    """Check the single-pass grouped-median quality check against the per-organ masking loop and time both."""
+    with open(args.median_statistics) as f:
+        statistics = json.load(f)
+    label_data = _synthetic_generated_mask(args.size, 23, args.seed)
+    rng = np.random.default_rng(args.seed)
+    image_data = rng.normal(40.0, 200.0, size=label_data.shape).astype(np.float32)
+    image_data[rng.random(label_data.shape) < 1e-4] = np.nan
+    print(f"qc: volume {label_data.shape}, {len(statistics)} label groups")
+    t_ref, ref = _timeit(lambda: _legacy_is_outlier(statistics, image_data, label_data, CT_LABEL_GROUPS), args.repeats)
+    t_cur, cur = _timeit(lambda: is_outlier(statistics, image_data, label_data, CT_LABEL_GROUPS), args.repeats)
+    _report("is_outlier", t_ref, t_cur, ref == cur)
+    device = torch.device(args.device)
+    image_t, label_t = torch.from_numpy(image_data).to(device), torch.from_numpy(label_data).to(device)
+    t_dev, dev = _timeit(lambda: is_outlier(statistics, image_t, label_t, CT_LABEL_GROUPS), args.repeats, device)
+    _report(f"is_outlier on {device} tensors", t_ref, t_dev, ref == dev)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark label-mask operations against their reference implementations.")
+    parser.add_argument("--size", type=int, default=512, help="edge length of the synthetic cubic label volume")
+    parser.add_argument("--repeats", type=int, default=3, help="number of timed repetitions; the best one is reported")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic volume")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="torch device")
+    parser.add_argument("--log_crops", action="store_true", help="log the voxel work saved by every bounding-box crop")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_remap = subparsers.add_parser("remap", help="lookup-table label remapping")
+    parser_remap.add_argument("--label_dict_remap_json", type=str, default="./configs/label_dict_124_to_132.json", help="label mapping JSON file")
+    parser_remap.set_defaults(func=benchmark_remap)
+
+    parser_suppress = subparsers.add_parser("suppress", help="suppression of non-largest connected components")
+    parser_suppress.add_argument("--labels", type=str, default="1,3,4,5,14", help="comma-separated labels to process")
+    parser_suppress.set_defaults(func=benchmark_suppress)
+
+    parser_post = subparsers.add_parser("postprocess", help="generated-mask post-processing, with an equivalence check")
+    parser_post.add_argument("--mask", type=str, default=None, help="optional NIfTI label volume to use instead of a synthetic one")
+    parser_post.add_argument(
+        "--target_tumor_labels", type=str, default="none,23,24,26,27,128", help="comma-separated target tumor labels ('none' for no tumor)"
+    )
+    parser_post.add_argument("--morph_batch_size", type=int, default=4, help="number of organ masks closed together")
+    parser_post.set_defaults(func=benchmark_postprocess)
+
+    parser_morph = subparsers.add_parser("morphology", help="separable max-pool morphology against dense convolution")
+    parser_morph.add_argument("--kernel_sizes", type=str, default="3,5,7,9", help="comma-separated odd box sizes")
+    parser_morph.set_defaults(func=benchmark_morphology)
+
+    parser_crop = subparsers.add_parser("crop", help="bounding-box cropped organ fills against whole-volume ones")
+    parser_crop.add_argument("--labels", type=str, default="1,3,4,5,23,28", help="comma-separated organ labels to fill")
+    parser_crop.set_defaults(func=benchmark_crop)
+
+    parser_tumor = subparsers.add_parser("tumor", help="tumour augmentations on the organ crop against the whole volume")
+    parser_tumor.add_argument("--organs", type=str, default="bone,liver,lung,pancreas,colon", help="comma-separated tumour augmentations")
+    parser_tumor.set_defaults(func=benchmark_tumor)
+
+    parser_qc = subparsers.add_parser("qc", help="single-pass grouped medians of the image quality check")
+    parser_qc.add_argument(
+        "--median_statistics", type=str, default="./configs/image_median_statistics_ct.json", help="real-image median statistics JSON file"
+    )
+    parser_qc.set_defaults(func=benchmark_qc)
+
+    args = parser.parse_args()
+    if args.log_crops:
+        logging.basicConfig(level=logging.INFO)
+        logging.getLogger(morphology.__name__).setLevel(logging.DEBUG)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
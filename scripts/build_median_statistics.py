@@ -0,0 +1,271 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Builder of the reference statistics of the image quality check.
+
+``quality_check.is_outlier`` compares the per-organ median intensity of a generated image with the
+spread of the per-organ medians of real images, stored in ``configs/image_median_statistics_ct.json``.
+This command rebuilds such a file from an image/label dataset, e.g. for another scanner population or
+for MR with ``--label_groups``.
+
+What lives here:
+
+- ``compute_case_medians``       — per-organ medians of one image/label pair (``grouped_statistics``),
+                                   run in worker processes.
+- ``load_case_medians``          — read the per-case medians recorded by previous runs.
+- ``summarize_medians``          — per-organ ``min_median``, ``max_median``, ``percentile_0_5``,
+                                   ``percentile_99_5``, ``sigma_6_*`` (mean +/- 3 std) and ``sigma_12_*``
+                                   (mean +/- 6 std) of the case medians.
+- ``build_median_statistics``    — process the new cases and write the statistics file.
+
+The per-case medians are appended to a JSON-lines file (``--cases``, next to the output by default) as
+the workers finish. A later run only processes the cases that are not in it yet, or whose files, label
+groups or clip range changed, and recomputes the statistics from all the recorded medians, so the dataset
+can grow incrementally and an interrupted run resumes where it stopped.
+
+Usage:
+
+    python -m scripts.build_median_statistics --datalist ./datasets/datalist.json --data_base_dir ./datasets \\
+        --output ./configs/image_median_statistics_ct.json --clip -1000 1000 --num_workers 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import monai
+import numpy as np
+import torch
+
+from .quality_check import CT_LABEL_GROUPS, grouped_statistics
+
+logger = logging.getLogger("maisi.median_statistics")
+
+
+def _file_signature(path: str) -> list[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _options_hash(label_groups: dict, clip) -> str:
+    """Hash of the options the medians depend on: the labels of every group and the clip range."""
+    options = {"label_groups": {name: sorted(int(v) for v in labels) for name, labels in label_groups.items()}, "clip": clip}
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def compute_case_medians(task: dict) -> dict:
+    """
+    Compute the per-organ median intensities of one image/label pair; runs in a worker process.
+
+    Args:
+        task: ``image`` and ``label`` file paths, ``key`` of the case, ``label_groups`` and optional ``clip`` range.
+
+    Returns:
+        dict: case record with the ``key``, the file ``signature``, the ``options`` hash of the label groups
+        and clip range, and the ``medians`` per label group (``None`` for the groups absent from the case).
+    """
+    loader = monai.transforms.LoadImage(image_only=True)
+    image, label = np.asarray(loader(task["image"])), np.asarray(loader(task["label"]))
+    if image.shape != label.shape:
+        raise ValueError(f"{task['key']}: image shape {image.shape} does not match label shape {label.shape}")
+    if task["clip"] is not None:
+        image = np.clip(image, *task["clip"])
+    stats = grouped_statistics(image, label.astype(np.int64, copy=False), task["label_groups"])
+    medians = {name: None if s["median"] is None else float(s["median"]) for name, s in stats.items()}
+    return {
+        "key": task["key"],
+        "signature": [_file_signature(task["image"]), _file_signature(task["label"])],
+        "options": _options_hash(task["label_groups"], task["clip"]),
+        "medians": medians,
+    }
+
+
+def load_case_medians(cases_path: str) -> dict[str, dict]:
+    """
+    Read the case records appended by previous runs.
+
+    Args:
+        cases_path: JSON-lines file of case records.
+
+    Returns:
+        dict: case key -> latest record of the case.
+    """
+    records = {}
+    if os.path.exists(cases_path):
+        with open(cases_path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record["key"]] = record
+    return records
+
+
+def summarize_medians(records, label_groups: dict) -> dict:
+    """
+    Summarize the case medians into the per-organ fields read by ``quality_check.is_outlier``.
+
+    Args:
+        records: case records, as returned by ``compute_case_medians``.
+        label_groups: label group name -> label integers; the groups without any case are left out.
+
+    Returns:
+        dict: label group name -> statistics, with the number of cases in ``num_cases``.
+    """
+    statistics = {}
+    for name in label_groups:
+        medians = np.array([r["medians"][name] for r in records if r["medians"].get(name) is not None], dtype=np.float64)
+        if medians.size == 0:
+            logger.warning(f"No case contains '{name}', it is left out of the statistics.")
+            continue
+        mean, std = float(medians.mean()), float(medians.std())
+        statistics[name] = {
+            "min_median": float(medians.min()),
+            "max_median": float(medians.max()),
+            "percentile_0_5": float(np.percentile(medians, 0.5)),
+            "percentile_99_5": float(np.percentile(medians, 99.5)),
+            "sigma_6_low": mean - 3 * std,
+            "sigma_6_high": mean + 3 * std,
+            "sigma_12_low": mean - 6 * std,
+            "sigma_12_high": mean + 6 * std,
+            "num_cases": int(medians.size),
+        }
+    return statistics
+
+
+def _init_worker(num_threads: int) -> None:
+    torch.set_num_threads(num_threads)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="[%(asctime)s][%(levelname)5s](%(name)s) - %(message)s")
+
+
+def build_median_statistics(
+    cases: list[dict],
+    output: str,
+    cases_path: str,
+    label_groups: dict | None = None,
+    clip: tuple[float, float] | None = None,
+    num_workers: int = 1,
+) -> dict:
+    """
+    Compute the medians of the new or changed cases in a process pool and write the statistics of all recorded cases.
+
+    Args:
+        cases: ``{"key", "image", "label"}`` of every case of the dataset.
+        output: statistics JSON file to write.
+        cases_path: JSON-lines file of the per-case medians, read and appended to.
+        label_groups: label group name -> label integers, ``CT_LABEL_GROUPS`` by default.
+        clip: optional intensity range the images are clipped to before the medians.
+        num_workers: number of worker processes.
+
+    Returns:
+        dict: the statistics written to ``output``.
+    """
+    label_groups = CT_LABEL_GROUPS if label_groups is None else label_groups
+    clip = None if clip is None else list(clip)
+    options = _options_hash(label_groups, clip)
+    records = load_case_medians(cases_path)
+    tasks = []
+    for case in cases:
+        record = records.get(case["key"])
+        # the recorded medians are reused unless the files, the labels of the groups or the clip range changed
+        if (
+            record is not None
+            and record.get("options") == options
+            and record["signature"] == [_file_signature(case["image"]), _file_signature(case["label"])]
+        ):
+            continue
+        tasks.append({**case, "label_groups": label_groups, "clip": clip})
+    logger.info(f"{len(cases) - len(tasks)} of {len(cases)} cases already recorded in {cases_path}, processing {len(tasks)}.")
+
+    start_time = time.time()
+    if tasks:
+        num_threads = max(1, (os.cpu_count() or 1) // max(num_workers, 1))
+        with (
+            open(cases_path, "a") as f,
+            ProcessPoolExecutor(
+                max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(num_threads,)
+            ) as executor,
+        ):
+            futures = {executor.submit(compute_case_medians, task): task["key"] for task in tasks}
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logger.warning(f"{futures[future]}: skipped, {e}")
+                    continue
+                records[record["key"]] = record
+                # append as the cases finish, so that an interrupted run keeps its progress
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                if (i + 1) % 50 == 0:
+                    logger.info(f"{i + 1}/{len(tasks)} cases processed in {time.time() - start_time:.1f}s")
+
+    case_keys = {case["key"] for case in cases}
+    # records of failed cases may still have other options, they are left out
+    statistics = summarize_medians([r for key, r in records.items() if key in case_keys and r.get("options") == options], label_groups)
+    with open(output, "w") as f:
+        json.dump(statistics, f, indent=4)
+    logger.info(f"Wrote the statistics of {len(statistics)} label groups over {len(case_keys)} cases to {output} in {time.time() - start_time:.1f}s")
+    return statistics
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build the per-organ median statistics of the image quality check from a dataset.")
+    parser.add_argument("--datalist", required=True, help='MONAI-style datalist JSON, e.g. {"training": [{"image": ..., "label": ...}]}')
+    parser.add_argument("--data_key", default="training", help="datalist key of the cases")
+    parser.add_argument("--data_base_dir", default="", help="base directory of the relative paths in the datalist")
+    parser.add_argument("--output", required=True, help="statistics JSON file to write")
+    parser.add_argument("--cases", default=None, help="JSON-lines file of the per-case medians, '<output>.cases.jsonl' by default")
+    parser.add_argument("--label_groups", default=None, help="JSON file of label group name -> label integers, the CT groups by default")
+    parser.add_argument("--clip", type=float, nargs=2, default=None, metavar=("A_MIN", "A_MAX"), help="clip the image intensities first")
+    parser.add_argument("--num_workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="number of worker processes")
+    args = parser.parse_args()
+
+    with open(args.datalist) as f:
+        items = json.load(f)[args.data_key]
+    cases = [
+        {
+            "key": item["image"],
+            "image": os.path.join(args.data_base_dir, item["image"]),
+            "label": os.path.join(args.data_base_dir, item["label"]),
+        }
+        for item in items
+    ]
+    label_groups = None
+    if args.label_groups is not None:
+        with open(args.label_groups) as f:
+            label_groups = json.load(f)
+    build_median_statistics(
+        cases,
+        args.output,
+        args.cases if args.cases is not None else os.path.splitext(args.output)[0] + ".cases.jsonl",
+        label_groups=label_groups,
+        clip=args.clip,
+        num_workers=args.num_workers,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="[%(asctime)s.%(msecs)03d][%(levelname)5s](%(name)s) - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    main()
@@ -38,10 +38,16 @@ SHELL Usage Example:
         --output_root "./features/features-512x512x512" \
         --target_shape "512x512x512"
 
+CPU-only nodes run the same command with `--device cpu` (gloo backend), e.g.
+`torchrun --nproc_per_node=4 compute_fid_2-5d_ct.py --device cpu --num_threads 8 ...`,
+or as a single process with `python compute_fid_2-5d_ct.py --device cpu ...`.
+
 This script loads two datasets (real vs. synthetic) in 3D medical format (NIfTI)
 and extracts feature maps via a 2.5D approach. It then computes the Frechet
 Inception Distance (FID) across three orthogonal planes. Data parallelism
-is implemented using torch.distributed with an NCCL backend.
+is implemented using torch.distributed with an NCCL backend: each rank
+accumulates running feature statistics (count, sum, sum of outer products)
+per plane, and the ranks merge them with a single all-reduce.
 
 Function Arguments (main):
 --------------------------
@@ -84,7 +90,7 @@ Function Arguments (main):
           (analogous to "enable_resampling=False").
 
     ignore_existing (bool):
-        If True, ignore any existing .pt feature files and force re-extraction.
+        If True, ignore the stored features and force re-extraction.
 
     model_name (str):
         Model identifier. Typically "radimagenet_resnet50" or "squeezenet1_1".
@@ -93,14 +99,62 @@ Function Arguments (main):
         Max number of images to process from each dataset (truncate if more are present).
 
     output_root (str):
-        Folder where extracted .pt feature files, logs, and results are saved.
+        Folder of the feature stores (sharded feature files with an index, one store
+        per dataset under `real_features_dir` / `synth_features_dir`), logs, and results.
 
     target_shape (str):
         Target shape as "XxYxZ" for padding, cropping, or resampling operations.
+
+    slice_batch_size (int):
+        Number of 2D slices per forward of the feature network; 0 (default) picks it
+        from `slice_memory_budget_gb`.
+
+    slice_memory_budget_gb (float or None):
+        Memory budget of one forward when `slice_batch_size` is 0, by default half the
+        free GPU memory.
+
+    real_stats_file (str or None):
+        Reference statistics of the real dataset: per-plane mean and covariance (with the
+        count, sum and sum of outer products), the feature network, normalisation, target
+        shape and slicing options, and a hash of the file list. If it exists, matches those
+        settings and `ignore_existing` is False, the real dataset is not processed, and
+        `real_filelist` may be omitted. Otherwise the statistics are rebuilt and saved to it.
+
+    synth_stats_file (str or None):
+        Optional file to save the per-plane feature statistics of the synthetic dataset to.
+
+    device (str or None):
+        "cuda" or "cpu"; by default CUDA when available. Under torchrun, CUDA ranks use
+        NCCL and CPU ranks use gloo; a plain `python` launch runs as a single process.
+
+    num_threads (int or None):
+        Number of CPU threads of each process (torch.set_num_threads).
+
+    num_workers (int):
+        Number of data-loading workers of each process.
+
+    metrics (str):
+        Comma-separated metrics among "fid", "kid" (kernel inception distance) and "pr"
+        (k-NN precision/recall). KID and precision/recall read the stored per-slice features.
+
+    kid_subsets, kid_subset_size (int):
+        Number and size of the random subsets of the KID estimate.
+
+    pr_k (int):
+        Neighbour rank of the k-NN manifold radii of precision/recall.
+
+    pr_max_samples (int or None):
+        Optional cap on the features per plane and dataset used for precision/recall.
+
+    knn_chunk_size (int):
+        Block size of the chunked k-NN distance computations.
 """
 
 from __future__ import annotations
 
+import glob
+import hashlib
+import json
 import logging
 import os
 import sys
@@ -109,10 +163,10 @@ from pathlib import Path
 
 import fire
 import monai
+import numpy as np
 import torch
 import torch.distributed as dist
-import torch.nn.functional as F
-from monai.metrics.fid import FIDMetric
+from monai.metrics.fid import _compute_frechet_distance
 from monai.transforms import Compose
 
 # ------------------------------------------------------------------------------
@@ -125,33 +179,6 @@ if not logger.handlers:
 logger.setLevel(logging.INFO)
 
 
-def drop_empty_slice(slices, empty_threshold: float):
-    """
-    Decide which 2D slices to keep by checking if their maximum intensity
-    is below a certain threshold.
-
-    Args:
-        slices (tuple or list of Tensors): Each element is (B, C, H, W).
-        empty_threshold (float): If the slice's maximum value is below this threshold,
-            it is considered "empty".
-
-    Returns:
-        list[bool]: A list of booleans indicating for each slice whether to keep it.
-    """
-    outputs = []
-    n_drop = 0
-    for s in slices:
-        largest_unique = torch.max(torch.unique(s))
-        if largest_unique < empty_threshold:
-            outputs.append(False)
-            n_drop += 1
-        else:
-            outputs.append(True)
-
-    logger.info(f"Empty slice drop rate {round((n_drop / len(slices)) * 100, 1)}%")
-    return outputs
-
-
 def subtract_mean(x: torch.Tensor) -> torch.Tensor:
     """
     Subtract per-channel means (ImageNet-like: [0.406, 0.456, 0.485])
@@ -247,6 +274,127 @@ def radimagenet_intensity_normalisation(volume: torch.Tensor, norm2d: bool = Fal
     return volume
 
 
+# Rough peak activation memory of the feature network, per byte of input slice, used by the
+# automatic slice batch size (forward passes under no_grad keep only a few feature maps alive).
+SLICE_ACTIVATION_FACTOR = 64
+# Slice batch size of the automatic mode on CPU.
+CPU_SLICE_BATCH_SIZE = 32
+
+
+def resolve_slice_batch_size(
+    slice_shape: tuple[int, ...],
+    device: torch.device,
+    slice_batch_size: int = 0,
+    memory_budget_bytes: int | None = None,
+    element_size: int = 4,
+) -> int:
+    """
+    Number of 2D slices passed to the feature network per forward.
+
+    Args:
+        slice_shape (tuple): (C, H, W) of one slice.
+        device (torch.device): Device of the feature network.
+        slice_batch_size (int): Fixed batch size if > 0; 0 selects it from the memory budget.
+        memory_budget_bytes (int or None): Memory allowed for one forward in the automatic mode,
+            by default half the free memory of a CUDA device.
+        element_size (int): Bytes per input element.
+
+    Returns:
+        int: Slice batch size, at least 1.
+    """
+    if slice_batch_size > 0:
+        return slice_batch_size
+    if memory_budget_bytes is None:
+        if device.type != "cuda":
+            return CPU_SLICE_BATCH_SIZE
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        memory_budget_bytes = free_bytes // 2
+    bytes_per_slice = element_size * SLICE_ACTIVATION_FACTOR
+    for size in slice_shape:
+        bytes_per_slice *= size
+    return max(1, int(memory_budget_bytes // bytes_per_slice))
+
+
+# ImageNet channel means subtracted from the (B, G, R) slices, as in ``subtract_mean``.
+IMAGENET_BGR_MEAN = (0.406, 0.456, 0.485)
+
+
+def _slice_features(
+    image: torch.Tensor,
+    plane_dims: list[int],
+    plane_indices: list[range],
+    feature_network: torch.nn.Module,
+    drop_empty: bool,
+    empty_threshold: float,
+    slice_batch_size: int,
+    memory_budget_bytes: int | None,
+) -> list[torch.Tensor]:
+    """
+    Features of the slices ``plane_indices[k]`` of ``image`` along ``plane_dims[k]``, for every plane.
+
+    The kept slices of all the planes form one interleaved stream, cut into fixed-size micro-batches; planes
+    with the same slice shape (all three for a cubic volume) share batches. Slices are read as views of
+    ``image`` and only copied when their micro-batch is assembled. Single-channel images are broadcast to
+    the three (B, G, R) channels by the mean subtraction, instead of being replicated up front.
+
+    Empty slices are dropped first, so they are never copied, normalised or passed to the network. The
+    slices of each plane are min-max normalised with the range of the kept slices of that plane, as
+    ``radimagenet_intensity_normalisation`` does on their concatenation.
+
+    Returns:
+        list of torch.Tensor: features of each plane, in slice-major order as ``torch.cat(torch.unbind(...))``.
+    """
+    batch, channels = image.shape[0], image.shape[1]
+    planes = []
+    for dim, index in zip(plane_dims, plane_indices):
+        other_dims = [d for d in range(image.dim()) if d != dim]
+        index = torch.tensor(list(index), dtype=torch.long, device=image.device)
+        # per-slice ranges, reduced in place without copying the slices
+        slice_max, slice_min = image.amax(dim=other_dims)[index], image.amin(dim=other_dims)[index]
+        if drop_empty:
+            keep = slice_max >= empty_threshold
+            n_drop = index.numel() - int(keep.sum())
+            logger.info(f"Empty slice drop rate {round((n_drop / max(index.numel(), 1)) * 100, 1)}%")
+            index, slice_max, slice_min = index[keep], slice_max[keep], slice_min[keep]
+        if index.numel():
+            minval, maxval = slice_min.min(), slice_max.max()
+        else:
+            minval = maxval = image.new_zeros(())
+        shape = tuple(image.shape[d] for d in other_dims[2:])
+        planes.append({"dim": dim, "index": index.tolist(), "min": minval, "max": maxval, "shape": shape})
+
+    mean = torch.tensor(IMAGENET_BGR_MEAN, dtype=image.dtype, device=image.device).view(1, 3, 1, 1)
+    features: list[torch.Tensor | None] = [None] * len(planes)
+    groups: dict[tuple[int, ...], list[int]] = {}
+    for k, plane in enumerate(planes):
+        groups.setdefault(plane["shape"], []).append(k)
+    for shape, plane_ids in groups.items():
+        stream = [(k, i) for k in plane_ids for i in planes[k]["index"]]
+        batch_size = resolve_slice_batch_size((3, *shape), image.device, slice_batch_size, memory_budget_bytes, image.element_size())
+        # number of slices per forward: each slice index holds `batch` images
+        step = max(1, batch_size // batch)
+        outputs = []
+        for start in range(0, len(stream), step):
+            chunk = stream[start : start + step]
+            # (n, B, C, h, w) -> (n * B, C, h, w)
+            images_2d = torch.stack([image.select(planes[k]["dim"], i) for k, i in chunk]).flatten(0, 1)
+            lo = torch.stack([planes[k]["min"] for k, _ in chunk]).repeat_interleave(batch).view(-1, 1, 1, 1)
+            hi = torch.stack([planes[k]["max"] for k, _ in chunk]).repeat_interleave(batch).view(-1, 1, 1, 1)
+            images_2d = (images_2d - lo) / (hi - lo + 1e-10)
+            # 'RGB' -> (B, G, R); a single channel broadcasts to the three
+            if channels != 1:
+                images_2d = images_2d[:, [2, 1, 0], ...]
+            images_2d = images_2d - mean
+            outputs.append(spatial_average(feature_network.forward(images_2d), keepdim=False))
+        if not outputs:
+            # no slice kept: an empty batch still yields (0, F) features
+            outputs.append(spatial_average(feature_network.forward(image.new_empty((0, 3, *shape))), keepdim=False))
+        outputs = torch.cat(outputs, dim=0)
+        for k, plane_features in zip(plane_ids, outputs.split([len(planes[k]["index"]) * batch for k in plane_ids])):
+            features[k] = plane_features
+    return features
+
+
 def get_features_2p5d(
     image: torch.Tensor,
     feature_network: torch.nn.Module,
@@ -256,10 +404,16 @@ def get_features_2p5d(
     xy_only: bool = True,
     drop_empty: bool = False,
     empty_threshold: float = -700,
+    slice_batch_size: int = 0,
+    memory_budget_bytes: int | None = None,
 ) -> tuple[torch.Tensor | None, torch.Tensor | None, torch.Tensor | None]:
     """
     Extract 2.5D features from a 3D image by slicing it along XY, YZ, ZX planes.
 
+    The slices of the requested planes go through the feature network as one stream of
+    ``slice_batch_size``-slice micro-batches (see ``_slice_features``), so the memory does
+    not grow with the volume size.
+
     Args:
         image (torch.Tensor): Input 5D tensor in shape (B, C, H, W, D).
         feature_network (torch.nn.Module): Model that processes 2D slices (C,H,W).
@@ -267,102 +421,450 @@ def get_features_2p5d(
         center_slices_ratio (float): Ratio of slices to keep in the center if `center_slices` is True.
         sample_every_k (int): Downsampling factor along each axis when slicing.
         xy_only (bool): If True, return only the XY-plane features.
-        drop_empty (bool): Drop slices that are deemed "empty" below `empty_threshold`.
+        drop_empty (bool): Drop slices that are deemed "empty" below `empty_threshold`,
+            before normalisation; the normalisation range only covers the kept slices.
         empty_threshold (float): Threshold to decide emptiness of slices.
+        slice_batch_size (int): Number of slices per forward; 0 selects it from `memory_budget_bytes`
+            (see ``resolve_slice_batch_size``).
+        memory_budget_bytes (int or None): Memory budget of the automatic slice batch size.
 
     Returns:
         tuple of torch.Tensor or None: (XY_features, YZ_features, ZX_features).
     """
     logger.info(f"center_slices: {center_slices}, ratio: {center_slices_ratio}")
 
-    # If there's only 1 channel, replicate to 3 channels
-    if image.shape[1] == 1:
-        image = image.repeat(1, 3, 1, 1, 1)
-
-    # Convert from 'RGB'→(R,G,B) to (B,G,R)
-    image = image[:, [2, 1, 0], ...]
+    def plane_index(size: int) -> range:
+        if center_slices:
+            start = int((1.0 - center_slices_ratio) / 2.0 * size)
+            end = int((1.0 + center_slices_ratio) / 2.0 * size)
+            return range(start, end, sample_every_k)
+        return range(size)
 
-    B, C, H, W, D = image.size()  # noqa: N806
+    # XY-plane slicing along D, YZ-plane slicing along H, ZX-plane slicing along W
+    plane_dims = [4] if xy_only else [4, 2, 3]
     with torch.no_grad():
-        # ---------------------- XY-plane slicing along D ----------------------
-        if center_slices:
-            start_d = int((1.0 - center_slices_ratio) / 2.0 * D)
-            end_d = int((1.0 + center_slices_ratio) / 2.0 * D)
-            slices = torch.unbind(image[:, :, :, :, start_d:end_d:sample_every_k], dim=-1)
-        else:
-            slices = torch.unbind(image, dim=-1)
+        features = _slice_features(
+            image,
+            plane_dims,
+            [plane_index(image.shape[dim]) for dim in plane_dims],
+            feature_network,
+            drop_empty,
+            empty_threshold,
+            slice_batch_size,
+            memory_budget_bytes,
+        )
+    if xy_only:
+        return features[0], None, None
+    return features[0], features[1], features[2]
+
+
+PLANES = ("xy", "yz", "zx")
+# Version of the feature statistics files; files of another version are rebuilt.
+STATISTICS_VERSION = 1
+# Intensity pipeline of the features: HU clipping, min-max to [0, 1] over the kept slices of a plane, BGR, ImageNet mean.
+NORMALISATION_ID = "hu[-1000,1000]_minmax-plane_bgr_imagenet-mean"
+
+
+class FeatureStatistics:
+    """
+    Running sufficient statistics of feature vectors: count, sum and sum of outer products, in float64.
 
-        if drop_empty:
-            mapping_index = drop_empty_slice(slices, empty_threshold)
-        else:
-            mapping_index = [True for _ in range(len(slices))]
+    They give the mean and the covariance of all the features seen so far without keeping the features,
+    merge across ranks with a sum, and can be saved to summarise a reference dataset once.
+    """
 
-        images_2d = torch.cat(slices, dim=0)
-        images_2d = radimagenet_intensity_normalisation(images_2d)
-        images_2d = images_2d[mapping_index]
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum: torch.Tensor | None = None
+        self.outer: torch.Tensor | None = None
+
+    @property
+    def num_features(self) -> int:
+        return 0 if self.sum is None else self.sum.numel()
+
+    def _ensure(self, num_features: int, device: torch.device) -> None:
+        if self.sum is None:
+            self.sum = torch.zeros(num_features, dtype=torch.float64, device=device)
+            self.outer = torch.zeros(num_features, num_features, dtype=torch.float64, device=device)
+
+    def update(self, features: torch.Tensor) -> None:
+        """Add a (N, F) batch of feature vectors."""
+        features = features.reshape(-1, features.shape[-1]).to(torch.float64)
+        self._ensure(features.shape[1], features.device)
+        features = features.to(self.sum.device)
+        self.count += features.shape[0]
+        self.sum += features.sum(dim=0)
+        self.outer += features.T @ features
+
+    def mean(self) -> torch.Tensor:
+        return self.sum / self.count
+
+    def covariance(self) -> torch.Tensor:
+        """Unbiased covariance, as ``monai.metrics.fid`` computes it from the features."""
+        mean = self.mean()
+        return (self.outer - self.count * torch.outer(mean, mean)) / (self.count - 1)
+
+    def state_dict(self) -> dict:
+        return {"count": self.count, "sum": self.sum.cpu(), "outer": self.outer.cpu()}
+
+    @classmethod
+    def from_state_dict(cls, state: dict, device: torch.device | None = None) -> FeatureStatistics:
+        stats = cls()
+        stats.count = int(state["count"])
+        stats.sum, stats.outer = state["sum"].to(device), state["outer"].to(device)
+        return stats
+
+
+def all_reduce_statistics(statistics: list[FeatureStatistics], device: torch.device) -> None:
+    """
+    Sum the statistics of all ranks in place, with one all-reduce of a single flat buffer.
 
-        feature_image_xy = feature_network.forward(images_2d)
-        feature_image_xy = spatial_average(feature_image_xy, keepdim=False)
-        if xy_only:
-            return feature_image_xy, None, None
+    Ranks without any feature (e.g. more ranks than images) take part with zeros.
+    Without an initialized process group (single-process run), the statistics are left as they are.
+    """
+    if not (dist.is_available() and dist.is_initialized()):
+        return
+    num_features = torch.tensor([stats.num_features for stats in statistics], dtype=torch.int64, device=device)
+    dist.all_reduce(num_features, op=dist.ReduceOp.MAX)
+    for stats, size in zip(statistics, num_features.tolist()):
+        stats._ensure(size, device)
+    buffer = torch.cat(
+        [
+            torch.cat([torch.tensor([float(s.count)], dtype=torch.float64, device=device), s.sum.to(device), s.outer.to(device).flatten()])
+            for s in statistics
+        ]
+    )
+    dist.all_reduce(buffer)
+    offset = 0
+    for stats in statistics:
+        n = stats.num_features
+        stats.count = int(buffer[offset].item())
+        stats.sum = buffer[offset + 1 : offset + 1 + n]
+        stats.outer = buffer[offset + 1 + n : offset + 1 + n + n * n].view(n, n)
+        offset += 1 + n + n * n
+
+
+def filelist_hash(lines: list[str]) -> str:
+    """SHA-256 of a (sorted, truncated) file list, identifying the dataset a statistics file summarises."""
+    return hashlib.sha256("\n".join(lines).encode()).hexdigest()
+
+
+def save_feature_statistics(path: str, statistics: dict[str, FeatureStatistics], metadata: dict | None = None) -> None:
+    """
+    Save per-plane statistics, e.g. the reference statistics of a real dataset.
 
-        # ---------------------- YZ-plane slicing along H ----------------------
-        if center_slices:
-            start_h = int((1.0 - center_slices_ratio) / 2.0 * H)
-            end_h = int((1.0 + center_slices_ratio) / 2.0 * H)
-            slices = torch.unbind(image[:, :, start_h:end_h:sample_every_k, :, :], dim=2)
-        else:
-            slices = torch.unbind(image, dim=2)
+    Args:
+        path: output ``.pt`` file.
+        statistics: plane -> statistics.
+        metadata: settings the statistics depend on (feature network, normalisation, shape,
+            slicing, file list hash), compared by ``stale_statistics`` before reuse.
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    torch.save(
+        {
+            "version": STATISTICS_VERSION,
+            "metadata": metadata or {},
+            # mean and covariance for readers of the file; the sums are kept to merge or extend the statistics
+            "planes": {
+                plane: {**stats.state_dict(), "mean": stats.mean().cpu(), "covariance": stats.covariance().cpu()}
+                for plane, stats in statistics.items()
+            },
+        },
+        path,
+    )
+
+
+def load_feature_statistics(path: str, device: torch.device | None = None) -> tuple[dict[str, FeatureStatistics], dict]:
+    """
+    Load per-plane statistics written by ``save_feature_statistics``.
 
-        if drop_empty:
-            mapping_index = drop_empty_slice(slices, empty_threshold)
-        else:
-            mapping_index = [True for _ in range(len(slices))]
+    Returns:
+        tuple: plane -> statistics, and the metadata (with its ``version``).
+    """
+    state = torch.load(path, weights_only=True)
+    if not isinstance(state, dict) or "planes" not in state:
+        return {}, {"version": None}
+    statistics = {plane: FeatureStatistics.from_state_dict(state["planes"][plane], device) for plane in PLANES}
+    return statistics, {**state["metadata"], "version": state["version"]}
 
-        images_2d = torch.cat(slices, dim=0)
-        images_2d = radimagenet_intensity_normalisation(images_2d)
-        images_2d = images_2d[mapping_index]
 
-        feature_image_yz = feature_network.forward(images_2d)
-        feature_image_yz = spatial_average(feature_image_yz, keepdim=False)
+def stale_statistics(metadata: dict, expected: dict) -> list[str]:
+    """
+    Names of the settings whose value in a statistics file differs from the current run.
 
-        # ---------------------- ZX-plane slicing along W ----------------------
-        if center_slices:
-            start_w = int((1.0 - center_slices_ratio) / 2.0 * W)
-            end_w = int((1.0 + center_slices_ratio) / 2.0 * W)
-            slices = torch.unbind(image[:, :, :, start_w:end_w:sample_every_k, :], dim=3)
-        else:
-            slices = torch.unbind(image, dim=3)
+    A ``filelist_hash`` of None in ``expected`` (file list not available) is not checked.
+    """
+    stale = [] if metadata.get("version") == STATISTICS_VERSION else ["version"]
+    for key, value in expected.items():
+        if key == "filelist_hash" and value is None:
+            continue
+        if metadata.get(key) != value:
+            stale.append(key)
+    return stale
+
+
+def frechet_distance(stats_synth: FeatureStatistics, stats_real: FeatureStatistics) -> torch.Tensor:
+    """FID between two feature distributions given by their statistics, as ``FIDMetric()(synth, real)``."""
+    return _compute_frechet_distance(stats_synth.mean(), stats_synth.covariance(), stats_real.mean(), stats_real.covariance())
+
+
+def kernel_inception_distance(
+    features_synth: torch.Tensor,
+    features_real: torch.Tensor,
+    num_subsets: int = 100,
+    subset_size: int = 1000,
+    seed: int = 0,
+) -> tuple[float, float]:
+    """
+    Kernel inception distance: unbiased MMD^2 with the cubic polynomial kernel ``(x.y / F + 1)^3``,
+    averaged over random subsets of both feature sets.
 
-        if drop_empty:
-            mapping_index = drop_empty_slice(slices, empty_threshold)
-        else:
-            mapping_index = [True for _ in range(len(slices))]
+    Unlike FID, the estimate is unbiased, so it can be compared across sample sizes.
 
-        images_2d = torch.cat(slices, dim=0)
-        images_2d = radimagenet_intensity_normalisation(images_2d)
-        images_2d = images_2d[mapping_index]
+    Args:
+        features_synth, features_real (torch.Tensor): (N, F) features.
+        num_subsets (int): Number of subset pairs.
+        subset_size (int): Samples per subset, capped by the size of the smaller set.
+        seed (int): Seed of the subset sampling.
 
-        feature_image_zx = feature_network.forward(images_2d)
-        feature_image_zx = spatial_average(feature_image_zx, keepdim=False)
+    Returns:
+        tuple of float: mean and standard deviation of the MMD^2 estimates.
 
-    return feature_image_xy, feature_image_yz, feature_image_zx
+    Raises:
+        ValueError: if a set has fewer than two features, or the features are empty.
+    """
+    if min(features_synth.shape[0], features_real.shape[0]) < 2 or features_real.shape[1] == 0:
+        raise ValueError(
+            f"KID needs at least two non-empty features in each set, got {tuple(features_synth.shape)} synthetic "
+            f"and {tuple(features_real.shape)} real features."
+        )
+    m = min(subset_size, features_synth.shape[0], features_real.shape[0])
+    num_features = features_real.shape[1]
+    generator = torch.Generator().manual_seed(seed)
+    estimates = []
+    for _ in range(num_subsets):
+        x = features_synth[torch.randperm(features_synth.shape[0], generator=generator)[:m].to(features_synth.device)].double()
+        y = features_real[torch.randperm(features_real.shape[0], generator=generator)[:m].to(features_real.device)].double()
+        k_xx = (x @ x.T / num_features + 1) ** 3
+        k_yy = (y @ y.T / num_features + 1) ** 3
+        k_xy = (x @ y.T / num_features + 1) ** 3
+        mmd = (k_xx.sum() - k_xx.diagonal().sum() + k_yy.sum() - k_yy.diagonal().sum()) / (m * (m - 1)) - 2 * k_xy.sum() / (m * m)
+        estimates.append(mmd)
+    estimates = torch.stack(estimates)
+    return float(estimates.mean()), float(estimates.std()) if num_subsets > 1 else 0.0
+
+
+def _squared_distances(a: torch.Tensor, b: torch.Tensor, b_sq_norms: torch.Tensor) -> torch.Tensor:
+    return ((a * a).sum(dim=1, keepdim=True) + b_sq_norms[None] - 2 * a @ b.T).clamp_(min=0)
+
+
+def knn_radii(features: torch.Tensor, k: int = 3, chunk_size: int = 4096) -> torch.Tensor:
+    """
+    Squared distance of every feature to its k-th nearest neighbour in the same set (itself excluded).
 
+    The distances are computed in (chunk_size x chunk_size) blocks, keeping a running top-k per row,
+    so the N x N distance matrix is never built.
 
-def pad_to_max_size(tensor: torch.Tensor, max_size: int, padding_value: float = 0.0) -> torch.Tensor:
+    Raises:
+        ValueError: if the set does not have more than ``k`` features.
     """
-    Zero-pad a 2D feature map or other tensor along the first dimension to match a specified size.
+    if features.shape[0] <= k:
+        raise ValueError(f"k-NN radii with k={k} need more than {k} features, got {features.shape[0]}.")
+    sq_norms = (features * features).sum(dim=1)
+    radii = []
+    for start in range(0, features.shape[0], chunk_size):
+        rows = features[start : start + chunk_size]
+        best = None
+        for col_start in range(0, features.shape[0], chunk_size):
+            block = _squared_distances(rows, features[col_start : col_start + chunk_size], sq_norms[col_start : col_start + chunk_size])
+            candidates = block if best is None else torch.cat([best, block], dim=1)
+            # k + 1 smallest: the nearest one is the feature itself
+            best = torch.topk(candidates, min(k + 1, candidates.shape[1]), dim=1, largest=False).values
+        radii.append(best[:, -1])
+    return torch.cat(radii)
+
+
+def manifold_coverage(queries: torch.Tensor, reference: torch.Tensor, radii: torch.Tensor, chunk_size: int = 4096) -> float:
+    """
+    Fraction of ``queries`` inside the k-NN balls (squared ``radii``) of at least one ``reference`` feature,
+    computed in blocks without building the full distance matrix.
+    """
+    sq_norms = (reference * reference).sum(dim=1)
+    covered = 0
+    for start in range(0, queries.shape[0], chunk_size):
+        rows = queries[start : start + chunk_size]
+        inside = torch.zeros(rows.shape[0], dtype=torch.bool, device=rows.device)
+        for col_start in range(0, reference.shape[0], chunk_size):
+            block = _squared_distances(rows, reference[col_start : col_start + chunk_size], sq_norms[col_start : col_start + chunk_size])
+            inside |= (block <= radii[None, col_start : col_start + chunk_size]).any(dim=1)
+        covered += int(inside.sum())
+    return covered / max(queries.shape[0], 1)
+
+
+def precision_recall(features_synth: torch.Tensor, features_real: torch.Tensor, k: int = 3, chunk_size: int = 4096) -> tuple[float, float]:
+    """
+    k-NN precision and recall (Kynkaanniemi et al., 2019): the fraction of synthetic features inside the
+    real feature manifold, and of real features inside the synthetic one, each manifold being the union of
+    the balls reaching the k-th nearest neighbour of its samples.
 
-    Args:
-        tensor (torch.Tensor): The feature tensor to pad.
-        max_size (int): Desired size along the first dimension.
-        padding_value (float): Value to fill during padding.
+    Raises:
+        ValueError: if a set does not have more than ``k`` features (see ``knn_radii``).
+    """
+    precision = manifold_coverage(features_synth, features_real, knn_radii(features_real, k, chunk_size), chunk_size)
+    recall = manifold_coverage(features_real, features_synth, knn_radii(features_synth, k, chunk_size), chunk_size)
+    return precision, recall
 
-    Returns:
-        torch.Tensor: Padded tensor matching `max_size` along dim=0.
+
+def options_hash(options: dict) -> str:
+    """Short hash of the settings the features depend on, part of the feature store keys."""
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class FeatureStore:
+    """
+    Append-only store of per-volume 2.5D features, in a few sharded files with an index.
+
+    Each rank appends the float32 features of its volumes to its own shard files
+    (``shard-r<rank>-<n>.bin``, rolled over at ``shard_bytes``) and one JSON line per volume
+    to its own index (``index-r<rank>.jsonl``), so concurrent ranks never write to the same
+    file. An index line records the volume path, its size and mtime, the options hash, and
+    the shard, offset and shape of each plane; it is written after the data, so an
+    interrupted write leaves no index entry. Readers merge the indexes of all ranks; the
+    last entry of a (path, options) pair wins, and it is only valid while the file is unchanged.
     """
-    pad_size = [0, 0] * (len(tensor.shape) - 1) + [0, max_size - tensor.shape[0]]
-    return F.pad(tensor, pad_size, "constant", padding_value)
+
+    def __init__(self, root: str, rank: int = 0, shard_bytes: int = 2**30) -> None:
+        self.root = root
+        self.rank = rank
+        self.shard_bytes = shard_bytes
+        os.makedirs(root, exist_ok=True)
+        self.index_path = os.path.join(root, f"index-r{rank:03d}.jsonl")
+        self._shard_id = len(glob.glob(os.path.join(root, f"shard-r{rank:03d}-*.bin")))
+
+    def read_index(self) -> dict[tuple[str, str], dict]:
+        """(path, options hash) -> latest index entry, over the indexes of all ranks."""
+        entries = {}
+        for index_path in sorted(glob.glob(os.path.join(self.root, "index-r*.jsonl"))):
+            with open(index_path) as f:
+                for line in f:
+                    # a line cut by an interrupted write is skipped
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    entries[(entry["path"], entry["options"])] = entry
+        return entries
+
+    @staticmethod
+    def _signature(path: str) -> list[int]:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def lookup(self, paths: list[str], options: str) -> dict[str, dict]:
+        """Index entries of the ``paths`` whose features are stored for ``options`` and whose file is unchanged."""
+        index = self.read_index()
+        found = {}
+        for path in paths:
+            entry = index.get((path, options))
+            if entry is not None and os.path.exists(path) and entry["signature"] == self._signature(path):
+                found[path] = entry
+        return found
+
+    def load_many(self, entries: list[dict]) -> list[list[torch.Tensor]]:
+        """Per-plane features of the ``entries``, read with one memory map per shard."""
+        maps = {}
+        results = []
+        for entry in entries:
+            features = []
+            for plane in entry["planes"]:
+                shard = maps.get(plane["shard"])
+                if shard is None:
+                    shard = maps[plane["shard"]] = np.memmap(os.path.join(self.root, plane["shard"]), dtype=np.float32, mode="r")
+                start = plane["offset"] // 4
+                count = int(np.prod(plane["shape"]))
+                features.append(torch.from_numpy(np.array(shard[start : start + count])).view(plane["shape"]))
+            results.append(features)
+        return results
+
+    def put(self, path: str, options: str, features) -> None:
+        """Append the per-plane features of the volume ``path``."""
+        shard_name = f"shard-r{self.rank:03d}-{self._shard_id:04d}.bin"
+        shard_path = os.path.join(self.root, shard_name)
+        if os.path.exists(shard_path) and os.path.getsize(shard_path) >= self.shard_bytes:
+            self._shard_id += 1
+            shard_name = f"shard-r{self.rank:03d}-{self._shard_id:04d}.bin"
+            shard_path = os.path.join(self.root, shard_name)
+        planes = []
+        with open(shard_path, "ab") as f:
+            for plane_features in features:
+                data = plane_features.detach().to("cpu", torch.float32).contiguous().numpy()
+                planes.append({"shard": shard_name, "offset": f.tell(), "shape": list(data.shape)})
+                f.write(data.tobytes())
+        entry = {"path": path, "options": options, "signature": self._signature(path), "planes": planes}
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def load_stored_features(store: FeatureStore, paths: list[str], options: str, device: torch.device) -> dict[str, torch.Tensor]:
+    """
+    Per-plane features of the ``paths`` found in ``store`` (written by any rank), concatenated, for the
+    metrics that need the features themselves rather than their statistics.
+    """
+    found = store.lookup(paths, options)
+    if len(found) < len(paths):
+        logger.warning(f"{len(paths) - len(found)}/{len(paths)} images have no stored features in {store.root}, they are left out.")
+    feats = store.load_many([found[path] for path in paths if path in found])
+    features = {}
+    for i, plane in enumerate(PLANES):
+        features[plane] = (torch.cat([f[i] for f in feats], dim=0) if feats else torch.empty(0, 0)).to(device)
+    return features
+
+
+def extract_statistics(
+    filenames: list[dict],
+    transforms,
+    store: FeatureStore,
+    options: str,
+    feature_network: torch.nn.Module,
+    device: torch.device,
+    name: str,
+    ignore_existing: bool = False,
+    num_workers: int = 6,
+    **feature_kwargs,
+) -> dict[str, FeatureStatistics]:
+    """
+    Accumulate the per-plane feature statistics of the images of one rank.
+
+    Features already in ``store`` for ``options`` (and an unchanged file) are bulk-loaded
+    without reading the image, unless ``ignore_existing``. The other images are loaded with
+    ``transforms``, and their features are extracted and appended to the store.
+    """
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    statistics = {plane: FeatureStatistics() for plane in PLANES}
+    stored = {} if ignore_existing else store.lookup([item["image"] for item in filenames], options)
+    if stored:
+        logger.info(f"[Rank {rank}] {name}: loading the stored features of {len(stored)}/{len(filenames)} images from {store.root}")
+        for feats in store.load_many(list(stored.values())):
+            for plane, plane_feats in zip(PLANES, feats):
+                statistics[plane].update(plane_feats.to(device))
+
+    missing = [item for item in filenames if item["image"] not in stored]
+    loader = monai.data.DataLoader(monai.data.Dataset(data=missing, transform=transforms), num_workers=num_workers, batch_size=1, shuffle=False)
+    for idx, batch_data in enumerate(loader, start=1):
+        img = batch_data["image"].to(device)
+        fn = img.meta["filename_or_obj"][0]
+        logger.info(f"[Rank {rank}] {name} data {idx}/{len(missing)}: {fn}")
+
+        img_t = img.as_tensor()
+        logger.info(f"image shape: {tuple(img_t.shape)}")
+        feats = get_features_2p5d(img_t, feature_network, xy_only=False, **feature_kwargs)
+        logger.info(f"feats shapes: {feats[0].shape}, {feats[1].shape}, {feats[2].shape}")
+        # keyed on the listed path, the loader keeps the order of `missing`
+        store.put(missing[idx - 1]["image"], options, feats)
+
+        for plane, plane_feats in zip(PLANES, feats):
+            statistics[plane].update(plane_feats.to(device))
+    return statistics
 
 
 def main(
@@ -381,6 +883,19 @@ def main(
     num_images: int = 100,
     output_root: str = "./features/features-512x512x512",
     target_shape: str = "512x512x512",
+    slice_batch_size: int = 0,
+    slice_memory_budget_gb: float = None,
+    real_stats_file: str = None,
+    synth_stats_file: str = None,
+    device: str = None,
+    num_threads: int = None,
+    num_workers: int = 6,
+    metrics: str = "fid",
+    kid_subsets: int = 100,
+    kid_subset_size: int = 1000,
+    pr_k: int = 3,
+    pr_max_samples: int = None,
+    knn_chunk_size: int = 4096,
 ):
     """
     Compute 2.5D FID using distributed GPU processing.
@@ -438,7 +953,7 @@ def main(
             - If None, skip resampling (similar to "enable_resampling=False").
 
         ignore_existing (bool):
-            If True, ignore any existing .pt feature files and force re-computation.
+            If True, ignore the stored features and force re-computation.
 
         model_name (str):
             Model identifier. Typically "radimagenet_resnet50" or "squeezenet1_1".
@@ -447,24 +962,80 @@ def main(
             Maximum number of images to load from each dataset (truncate if more are present).
 
         output_root (str):
-            Parent folder where extracted .pt files and logs will be saved.
+            Parent folder of the feature stores (see ``FeatureStore``) and logs.
 
         target_shape (str):
             Target shape, e.g. "512x512x512", for padding, cropping, or resampling operations.
 
+        slice_batch_size (int):
+            Number of 2D slices per forward of the feature network; 0 picks it from the memory budget.
+
+        slice_memory_budget_gb (float or None):
+            Memory budget of one forward in the automatic mode, by default half the free GPU memory.
+
+        real_stats_file (str or None):
+            Reference statistics of the real dataset, used in place of `real_filelist`: loaded
+            if the file exists, `ignore_existing` is False and its feature network, normalisation,
+            target shape, preprocessing, slicing options and file list hash (when `real_filelist`
+            is readable) match the current run; otherwise rebuilt and saved to it. This summarises
+            a reference dataset once for comparisons with many synthetic sets.
+
+        synth_stats_file (str or None):
+            Optional file to save the per-plane feature statistics of the synthetic dataset to.
+
+        device (str or None):
+            "cuda" or "cpu", by default CUDA when available. Distributed runs (torchrun with
+            more than one process) use the NCCL backend on CUDA and gloo on CPU; without
+            torchrun the script runs as a single process.
+
+        num_threads (int or None):
+            Number of CPU threads of each process, e.g. the cores per rank on CPU nodes.
+
+        num_workers (int):
+            Number of data-loading workers of each process.
+
+        metrics (str):
+            Comma-separated metrics among "fid", "kid" and "pr". KID (unbiased, subset-averaged) and
+            k-NN precision/recall are computed on rank 0 from the features in the feature stores,
+            so they need `real_filelist` and cost no extra feature extraction.
+
+        kid_subsets, kid_subset_size (int):
+            Number and size of the random subsets of the KID estimate.
+
+        pr_k (int):
+            Neighbour rank of the k-NN manifold radii.
+
+        pr_max_samples (int or None):
+            Optional cap on the features per plane and dataset for precision/recall.
+
+        knn_chunk_size (int):
+            Rows and columns per block of the chunked k-NN distances; memory is O(knn_chunk_size^2).
+
     Returns:
         None
     """
     # -------------------------------------------------------------------------
     # Initialize Process Group (Distributed)
     # -------------------------------------------------------------------------
-    dist.init_process_group(backend="nccl", init_method="env://", timeout=timedelta(seconds=7200))
-
-    local_rank = int(os.environ["LOCAL_RANK"])
-    world_size = int(dist.get_world_size())
-    device = torch.device("cuda", local_rank)
-    torch.cuda.set_device(device)
-    logger.info(f"[INFO] Running process on {device} of total {world_size} ranks.")
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    if device.type == "cuda":
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(device)
+    if num_threads is not None:
+        torch.set_num_threads(int(num_threads))
+
+    # torchrun sets WORLD_SIZE; a plain `python` launch runs as a single process without a process group
+    distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+    if distributed:
+        backend = "nccl" if device.type == "cuda" else "gloo"
+        dist.init_process_group(backend=backend, init_method="env://", timeout=timedelta(seconds=7200))
+    rank = dist.get_rank() if distributed else 0
+    world_size = dist.get_world_size() if distributed else 1
+    logger.info(
+        f"[INFO] Running process {rank} on {device} of total {world_size} ranks"
+        f"{f' ({dist.get_backend()})' if distributed else ''}, {torch.get_num_threads()} threads."
+    )
 
     # Convert potential string bools to actual bools (if using Fire or similar)
     if not isinstance(enable_padding, bool):
@@ -480,8 +1051,10 @@ def main(
     # Merge logic for resampling
     enable_resampling = enable_resampling_spacing is not None
 
+    memory_budget_bytes = None if slice_memory_budget_gb is None else int(float(slice_memory_budget_gb) * 1024**3)
+
     # Print out some flags on rank 0
-    if local_rank == 0:
+    if rank == 0:
         logger.info(f"Real dataset root: {real_dataset_root}")
         logger.info(f"Synth dataset root: {synth_dataset_root}")
         logger.info(f"enable_center_slices_ratio: {enable_center_slices_ratio}")
@@ -491,6 +1064,7 @@ def main(
         logger.info(f"enable_resampling_spacing: {enable_resampling_spacing}")
         logger.info(f"enable_resampling: {enable_resampling}")
         logger.info(f"ignore_existing: {ignore_existing}")
+        logger.info(f"slice_batch_size: {slice_batch_size or 'auto'}, slice_memory_budget_gb: {slice_memory_budget_gb}")
 
     # -------------------------------------------------------------------------
     # Load feature extraction model
@@ -515,27 +1089,51 @@ def main(
     if enable_resampling:
         rs_spacing = [float(x) for x in enable_resampling_spacing.split("x")]
         rs_spacing_tuple = tuple(rs_spacing)
-        if local_rank == 0:
+        if rank == 0:
             logger.info(f"Resampling spacing: {rs_spacing_tuple}")
     else:
         rs_spacing_tuple = (1.0, 1.0, 1.0)
 
     # Use the ratio if provided, otherwise 1.0
     center_slices_ratio_final = enable_center_slices_ratio if enable_center_slices else 1.0
-    if local_rank == 0:
+    if rank == 0:
         logger.info(f"center_slices_ratio: {center_slices_ratio_final}")
 
     # -------------------------------------------------------------------------
     # Prepare Real Dataset
     # -------------------------------------------------------------------------
     output_root_real = os.path.join(output_root, real_features_dir)
-    with open(real_filelist) as rf:
-        real_lines = [line.strip() for line in rf.readlines()]
-    real_lines.sort()
-    real_lines = real_lines[:num_images]
-
-    real_filenames = [{"image": os.path.join(real_dataset_root, f)} for f in real_lines]
-    real_filenames = monai.data.partition_dataset(data=real_filenames, shuffle=False, num_partitions=world_size, even_divisible=False)[local_rank]
+    real_lines = None
+    if os.path.isfile(real_filelist):
+        with open(real_filelist) as rf:
+            real_lines = [line.strip() for line in rf.readlines()]
+        real_lines.sort()
+        real_lines = real_lines[:num_images]
+
+    # Settings the real statistics depend on; a reference statistics file is rebuilt when any of them changes
+    reference_metadata = {
+        "model_name": model_name,
+        "normalisation": NORMALISATION_ID,
+        "target_shape": list(target_shape_tuple),
+        "enable_padding": enable_padding,
+        "enable_center_cropping": enable_center_cropping,
+        "resampling_spacing": list(rs_spacing_tuple) if enable_resampling else None,
+        "center_slices_ratio": center_slices_ratio_final if enable_center_slices else None,
+        "filelist_hash": None if real_lines is None else filelist_hash(real_lines),
+    }
+    real_stats = None
+    if real_stats_file is not None and os.path.isfile(real_stats_file) and not ignore_existing:
+        loaded_stats, loaded_metadata = load_feature_statistics(real_stats_file, device)
+        stale = stale_statistics(loaded_metadata, reference_metadata)
+        if not stale:
+            logger.info(f"Loading real feature statistics from {real_stats_file}")
+            if real_lines is None:
+                logger.info(f"{real_filelist} is not available, the file list of {real_stats_file} is not checked.")
+            real_stats = loaded_stats
+        elif rank == 0:
+            logger.info(f"Rebuilding {real_stats_file}, changed: {', '.join(stale)}")
+    if real_stats is None and real_lines is None:
+        raise FileNotFoundError(f"real_filelist {real_filelist} is required to compute the real feature statistics.")
 
     # -------------------------------------------------------------------------
     # Prepare Synthetic Dataset
@@ -547,7 +1145,7 @@ def main(
     synth_lines = synth_lines[:num_images]
 
     synth_filenames = [{"image": os.path.join(synth_dataset_root, f)} for f in synth_lines]
-    synth_filenames = monai.data.partition_dataset(data=synth_filenames, shuffle=False, num_partitions=world_size, even_divisible=False)[local_rank]
+    synth_filenames = monai.data.partition_dataset(data=synth_filenames, shuffle=False, num_partitions=world_size, even_divisible=False)[rank]
 
     # -------------------------------------------------------------------------
     # Build MONAI transforms
@@ -571,147 +1169,67 @@ def main(
     transforms = Compose(transform_list)
 
     # -------------------------------------------------------------------------
-    # Create DataLoaders
-    # -------------------------------------------------------------------------
-    real_ds = monai.data.Dataset(data=real_filenames, transform=transforms)
-    real_loader = monai.data.DataLoader(real_ds, num_workers=6, batch_size=1, shuffle=False)
-
-    synth_ds = monai.data.Dataset(data=synth_filenames, transform=transforms)
-    synth_loader = monai.data.DataLoader(synth_ds, num_workers=6, batch_size=1, shuffle=False)
-
-    # -------------------------------------------------------------------------
-    # Extract features for Real Dataset
-    # -------------------------------------------------------------------------
-    real_features_xy, real_features_yz, real_features_zx = [], [], []
-    for idx, batch_data in enumerate(real_loader, start=1):
-        img = batch_data["image"].to(device)
-        fn = img.meta["filename_or_obj"][0]
-        logger.info(f"[Rank {local_rank}] Real data {idx}/{len(real_filenames)}: {fn}")
-
-        out_fp = fn.replace(real_dataset_root, output_root_real).replace(".nii.gz", ".pt")
-        out_fp = Path(out_fp)
-        out_fp.parent.mkdir(parents=True, exist_ok=True)
-
-        if (not ignore_existing) and os.path.isfile(out_fp):
-            feats = torch.load(out_fp, weights_only=True)
-        else:
-            img_t = img.as_tensor()
-            logger.info(f"image shape: {tuple(img_t.shape)}")
-
-            feats = get_features_2p5d(
-                img_t,
-                feature_network,
-                center_slices=enable_center_slices,
-                center_slices_ratio=center_slices_ratio_final,
-                xy_only=False,
-            )
-            logger.info(f"feats shapes: {feats[0].shape}, {feats[1].shape}, {feats[2].shape}")
-            torch.save(feats, out_fp)
-
-        real_features_xy.append(feats[0])
-        real_features_yz.append(feats[1])
-        real_features_zx.append(feats[2])
-
-    real_features_xy = torch.vstack(real_features_xy)
-    real_features_yz = torch.vstack(real_features_yz)
-    real_features_zx = torch.vstack(real_features_zx)
-    logger.info(f"Real feature shapes: {real_features_xy.shape}, {real_features_yz.shape}, {real_features_zx.shape}")
-
-    # -------------------------------------------------------------------------
-    # Extract features for Synthetic Dataset
-    # -------------------------------------------------------------------------
-    synth_features_xy, synth_features_yz, synth_features_zx = [], [], []
-    for idx, batch_data in enumerate(synth_loader, start=1):
-        img = batch_data["image"].to(device)
-        fn = img.meta["filename_or_obj"][0]
-        logger.info(f"[Rank {local_rank}] Synth data {idx}/{len(synth_filenames)}: {fn}")
-
-        out_fp = fn.replace(synth_dataset_root, output_root_synth).replace(".nii.gz", ".pt")
-        out_fp = Path(out_fp)
-        out_fp.parent.mkdir(parents=True, exist_ok=True)
-
-        if (not ignore_existing) and os.path.isfile(out_fp):
-            feats = torch.load(out_fp, weights_only=True)
-        else:
-            img_t = img.as_tensor()
-            logger.info(f"image shape: {tuple(img_t.shape)}")
-
-            feats = get_features_2p5d(
-                img_t,
-                feature_network,
-                center_slices=enable_center_slices,
-                center_slices_ratio=center_slices_ratio_final,
-                xy_only=False,
-            )
-            logger.info(f"feats shapes: {feats[0].shape}, {feats[1].shape}, {feats[2].shape}")
-            torch.save(feats, out_fp)
-
-        synth_features_xy.append(feats[0])
-        synth_features_yz.append(feats[1])
-        synth_features_zx.append(feats[2])
-
-    synth_features_xy = torch.vstack(synth_features_xy)
-    synth_features_yz = torch.vstack(synth_features_yz)
-    synth_features_zx = torch.vstack(synth_features_zx)
-    logger.info(f"Synth feature shapes: {synth_features_xy.shape}, {synth_features_yz.shape}, {synth_features_zx.shape}")
-
-    # -------------------------------------------------------------------------
-    # All-reduce / gather features across ranks
+    # Accumulate per-plane feature statistics, merged across ranks
     # -------------------------------------------------------------------------
-    features = [
-        real_features_xy,
-        real_features_yz,
-        real_features_zx,
-        synth_features_xy,
-        synth_features_yz,
-        synth_features_zx,
-    ]
-
-    # 1) Gather local feature sizes across ranks
-    local_sizes = []
-    for ft_idx in range(len(features)):
-        local_size = torch.tensor([features[ft_idx].shape[0]], dtype=torch.int64, device=device)
-        local_sizes.append(local_size)
+    feature_kwargs = {
+        "center_slices": enable_center_slices,
+        "center_slices_ratio": center_slices_ratio_final,
+        "slice_batch_size": int(slice_batch_size),
+        "memory_budget_bytes": memory_budget_bytes,
+    }
+    # the stored features are keyed on everything they depend on but the file list
+    features_options = options_hash({k: v for k, v in reference_metadata.items() if k != "filelist_hash"})
+    metric_names = {m.strip().lower() for m in str(metrics).split(",") if m.strip()}
+    # KID and precision/recall read the real features from the store: with statistics loaded from
+    # `real_stats_file`, the real images that have no stored features yet are extracted here
+    if real_stats is None or (metric_names & {"kid", "pr"} and real_lines is not None):
+        real_filenames = [{"image": os.path.join(real_dataset_root, f)} for f in real_lines]
+        real_filenames = monai.data.partition_dataset(data=real_filenames, shuffle=False, num_partitions=world_size, even_divisible=False)[rank]
+        stats = extract_statistics(
+            real_filenames,
+            transforms,
+            FeatureStore(output_root_real, rank),
+            features_options,
+            feature_network,
+            device,
+            "Real",
+            ignore_existing,
+            num_workers,
+            **feature_kwargs,
+        )
+    if real_stats is None:
+        real_stats = stats
+        all_reduce_statistics(list(real_stats.values()), device)
+        if real_stats_file is not None and rank == 0:
+            save_feature_statistics(real_stats_file, real_stats, reference_metadata)
+            logger.info(f"Saved real feature statistics to {real_stats_file}")
+
+    synth_stats = extract_statistics(
+        synth_filenames,
+        transforms,
+        FeatureStore(output_root_synth, rank),
+        features_options,
+        feature_network,
+        device,
+        "Synth",
+        ignore_existing,
+        num_workers,
+        **feature_kwargs,
+    )
+    all_reduce_statistics(list(synth_stats.values()), device)
+    if synth_stats_file is not None and rank == 0:
+        synth_metadata = {**reference_metadata, "filelist_hash": filelist_hash(synth_lines)}
+        save_feature_statistics(synth_stats_file, synth_stats, synth_metadata)
+
+    # On rank 0, compute the metrics
+    if rank == 0 and "fid" in metric_names:
+        logger.info(f"Real feature counts: {[real_stats[plane].count for plane in PLANES]}")
+        logger.info(f"Synth feature counts: {[synth_stats[plane].count for plane in PLANES]}")
 
-    all_sizes = []
-    for ft_idx in range(len(features)):
-        rank_sizes = [torch.tensor([0], dtype=torch.int64, device=device) for _ in range(world_size)]
-        dist.all_gather(rank_sizes, local_sizes[ft_idx])
-        all_sizes.append(rank_sizes)
-
-    # 2) Pad and gather all features
-    all_tensors_list = []
-    for ft_idx, ft in enumerate(features):
-        max_size = max(all_sizes[ft_idx]).item()
-        ft_padded = pad_to_max_size(ft, max_size)
-
-        gather_list = [torch.empty_like(ft_padded) for _ in range(world_size)]
-        dist.all_gather(gather_list, ft_padded)
-
-        # Trim each gather back to the real size
-        for rk in range(world_size):
-            gather_list[rk] = gather_list[rk][: all_sizes[ft_idx][rk], :]
-
-        all_tensors_list.append(gather_list)
-
-    # On rank 0, compute FID
-    if local_rank == 0:
-        real_xy = torch.vstack(all_tensors_list[0])
-        real_yz = torch.vstack(all_tensors_list[1])
-        real_zx = torch.vstack(all_tensors_list[2])
-
-        synth_xy = torch.vstack(all_tensors_list[3])
-        synth_yz = torch.vstack(all_tensors_list[4])
-        synth_zx = torch.vstack(all_tensors_list[5])
-
-        logger.info(f"Final Real shapes: {real_xy.shape}, {real_yz.shape}, {real_zx.shape}")
-        logger.info(f"Final Synth shapes: {synth_xy.shape}, {synth_yz.shape}, {synth_zx.shape}")
-
-        fid = FIDMetric()
         logger.info(f"Computing FID for: {output_root_real} | {output_root_synth}")
-        fid_res_xy = fid(synth_xy, real_xy)
-        fid_res_yz = fid(synth_yz, real_yz)
-        fid_res_zx = fid(synth_zx, real_zx)
+        fid_res_xy = frechet_distance(synth_stats["xy"], real_stats["xy"])
+        fid_res_yz = frechet_distance(synth_stats["yz"], real_stats["yz"])
+        fid_res_zx = frechet_distance(synth_stats["zx"], real_stats["zx"])
 
         logger.info(f"FID XY: {fid_res_xy}")
         logger.info(f"FID YZ: {fid_res_yz}")
@@ -719,7 +1237,47 @@ def main(
         fid_avg = (fid_res_xy + fid_res_yz + fid_res_zx) / 3.0
         logger.info(f"FID Avg: {fid_avg}")
 
-    dist.destroy_process_group()
+    if rank == 0 and metric_names & {"kid", "pr"}:
+        if real_lines is None:
+            logger.warning(f"KID and precision/recall need the real features: {real_filelist} is not available, skipped.")
+        else:
+            real_paths = [os.path.join(real_dataset_root, f) for f in real_lines]
+            synth_paths = [os.path.join(synth_dataset_root, f) for f in synth_lines]
+            real_features = load_stored_features(FeatureStore(output_root_real, rank), real_paths, features_options, device)
+            synth_features = load_stored_features(FeatureStore(output_root_synth, rank), synth_paths, features_options, device)
+            for plane in PLANES:
+                for name, features in (("real", real_features[plane]), ("synthetic", synth_features[plane])):
+                    if features.shape[0] < 2:
+                        raise ValueError(
+                            f"KID and precision/recall need at least two {name} {plane.upper()} slice features, found {features.shape[0]}; "
+                            f"check that the {name} images were extracted with the current options."
+                        )
+            if "kid" in metric_names:
+                kids = []
+                for plane in PLANES:
+                    kid_mean, kid_std = kernel_inception_distance(
+                        synth_features[plane], real_features[plane], num_subsets=int(kid_subsets), subset_size=int(kid_subset_size)
+                    )
+                    kids.append(kid_mean)
+                    logger.info(f"KID {plane.upper()}: {kid_mean} +/- {kid_std}")
+                logger.info(f"KID Avg: {sum(kids) / len(kids)}")
+            if "pr" in metric_names:
+                max_samples = None if pr_max_samples is None else int(pr_max_samples)
+                precisions, recalls = [], []
+                for plane in PLANES:
+                    synth_plane, real_plane = synth_features[plane], real_features[plane]
+                    if max_samples is not None:
+                        generator = torch.Generator().manual_seed(0)
+                        synth_plane = synth_plane[torch.randperm(synth_plane.shape[0], generator=generator)[:max_samples].to(device)]
+                        real_plane = real_plane[torch.randperm(real_plane.shape[0], generator=generator)[:max_samples].to(device)]
+                    precision, recall = precision_recall(synth_plane, real_plane, k=int(pr_k), chunk_size=int(knn_chunk_size))
+                    precisions.append(precision)
+                    recalls.append(recall)
+                    logger.info(f"Precision {plane.upper()}: {precision}, Recall {plane.upper()}: {recall}")
+                logger.info(f"Precision Avg: {sum(precisions) / len(precisions)}, Recall Avg: {sum(recalls) / len(recalls)}")
+
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":
@@ -12,6 +12,7 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
 import json
 import logging
 import os
@@ -19,6 +20,7 @@ from datetime import datetime
 from pathlib import Path
 
 import monai
+import nibabel as nib
 import torch
 import torch.distributed as dist
 from monai.data import DataLoader, partition_dataset
@@ -31,6 +33,7 @@ from torch.nn.parallel import DistributedDataParallel
 
 from .diff_model_setting import initialize_distributed, load_config, setup_logging
 from .utils import define_instance
+from .utils_train import AsyncCheckpointWriter, ShapeBucketBatchSampler, TrainingMonitor
 
 
 def augment_modality_label(modality_tensor, prob=0.1):
@@ -82,6 +85,20 @@ def load_filenames(data_list_path: str) -> list:
     return [_item["image"].replace(".nii.gz", "_emb.nii.gz") for _item in filenames_train]
 
 
+def load_latent_shapes(train_files: list) -> list:
+    """
+    Read the spatial shape of every latent from its NIfTI header, without loading the voxel data.
+
+    Args:
+        train_files (list): List of training file dictionaries with an "image" key.
+
+    Returns:
+        list: Spatial shape (X, Y, Z) of each latent, in the order of ``train_files``.
+    """
+    # latents are saved as [X, Y, Z, C] by diff_model_create_training_data
+    return [tuple(nib.load(_item["image"]).shape[:3]) for _item in train_files]
+
+
 def prepare_data(
     train_files: list,
     device: torch.device,
@@ -91,6 +108,7 @@ def prepare_data(
     include_body_region: bool = False,
     include_modality: bool = True,
     modality_mapping: dict = None,
+    batch_sampler: ShapeBucketBatchSampler | None = None,
 ) -> DataLoader:
     """
     Prepare training data.
@@ -102,6 +120,8 @@ def prepare_data(
         num_workers (int): Number of workers for data loading.
         batch_size (int): Mini-batch size.
         include_body_region (bool): Whether to include body region in data
+        batch_sampler (ShapeBucketBatchSampler | None): Optional batch sampler; when given it replaces
+            ``batch_size`` and shuffling, and ``train_files`` must be its rank's subset (``batch_sampler.indices``).
 
     Returns:
         DataLoader: Data loader for training.
@@ -136,13 +156,95 @@ def prepare_data(
 
     train_ds = monai.data.CacheDataset(data=train_files, transform=train_transforms, cache_rate=cache_rate, num_workers=num_workers)
 
+    if batch_sampler is not None:
+        return DataLoader(train_ds, num_workers=6, batch_sampler=batch_sampler)
     return DataLoader(train_ds, num_workers=6, batch_size=batch_size, shuffle=True)
 
 
+def freeze_unused_parameters(unet: torch.nn.Module, device: torch.device, logger: logging.Logger, probe_size: int = 32) -> int:
+    """
+    Freeze the UNet parameters that receive no gradient under the current conditioning configuration.
+
+    A single forward/backward pass on a small synthetic latent, built with the same inputs as
+    ``train_one_epoch`` (spacing, optional body region and modality), reveals which parameters
+    take part in the graph. The others are frozen so that DDP can run with a static graph.
+
+    Args:
+        unet (torch.nn.Module): UNet model, not yet wrapped by DDP.
+        device (torch.device): Device of the model.
+        logger (logging.Logger): Logger for logging information.
+        probe_size (int): Spatial size of the synthetic latent; must be divisible by the total downsampling factor.
+
+    Returns:
+        int: Number of frozen parameter tensors.
+    """
+    include_body_region = unet.include_top_region_index_input
+    include_modality = unet.num_class_embeds is not None
+
+    unet_inputs = {
+        "x": torch.randn(1, unet.in_channels, probe_size, probe_size, probe_size, device=device),
+        "timesteps": torch.randint(0, 1000, (1,), device=device).long(),
+        "spacing_tensor": torch.ones(1, 3, device=device) * 1e2,
+    }
+    if include_body_region:
+        unet_inputs["top_region_index_tensor"] = torch.tensor([[0, 1, 0, 0]], dtype=torch.float, device=device) * 1e2
+        unet_inputs["bottom_region_index_tensor"] = torch.tensor([[0, 0, 1, 0]], dtype=torch.float, device=device) * 1e2
+    if include_modality:
+        unet_inputs["class_labels"] = torch.ones(1, dtype=torch.long, device=device)
+
+    unet.zero_grad(set_to_none=True)
+    with autocast("cuda", enabled=True):
+        model_output = unet(**unet_inputs)
+    model_output.float().mean().backward()
+
+    frozen_names, frozen_bytes = [], 0
+    for name, param in unet.named_parameters():
+        if param.requires_grad and param.grad is None:
+            param.requires_grad = False
+            frozen_names.append(name)
+            frozen_bytes += param.numel() * param.element_size()
+    unet.zero_grad(set_to_none=True)
+
+    logger.info(f"static_graph: froze {len(frozen_names)} unused parameter tensors ({frozen_bytes / 1024**2:.2f} MB).")
+    if frozen_names:
+        logger.info(f"static_graph: frozen parameters -> {frozen_names}.")
+    return len(frozen_names)
+
+
+def log_ddp_comm_stats(unet: torch.nn.Module, logger: logging.Logger) -> None:
+    """
+    Log the average backward computation and communication time measured by DDP.
+
+    DDP samples these timings internally; comparing them between runs with and without
+    ``static_graph`` shows the per-iteration communication time saved.
+
+    Args:
+        unet (torch.nn.Module): DDP-wrapped model.
+        logger (logging.Logger): Logger for logging information.
+    """
+    if not isinstance(unet, DistributedDataParallel) or not hasattr(unet, "_get_ddp_logging_data"):
+        return
+    ddp_data = unet._get_ddp_logging_data()
+    if "avg_backward_comm_time" not in ddp_data:
+        return
+    # DDP reports times in nanoseconds
+    logger.info(
+        f"[ddp] static_graph {bool(ddp_data.get('static_graph', 0))}, "
+        f"find_unused_parameters {bool(ddp_data.get('find_unused_parameters', 0))}: "
+        f"backward compute {ddp_data.get('avg_backward_compute_time', 0) / 1e6:.2f} ms, "
+        f"comm {ddp_data['avg_backward_comm_time'] / 1e6:.2f} ms, "
+        f"overlap {ddp_data.get('avg_backward_compute_comm_overlap_time', 0) / 1e6:.2f} ms per iteration."
+    )
+
+
 def load_unet(args: argparse.Namespace, device: torch.device, logger: logging.Logger) -> torch.nn.Module:
     """
     Load the UNet model.
 
+    When ``diffusion_unet_train["static_graph"]`` is set, parameters unused under the current
+    conditioning configuration are frozen and DDP runs with a static graph instead of
+    searching for unused parameters at every iteration.
+
     Args:
         args (argparse.Namespace): Configuration arguments.
         device (torch.device): Device to load the model on.
@@ -154,19 +256,26 @@ def load_unet(args: argparse.Namespace, device: torch.device, logger: logging.Lo
     unet = define_instance(args, "diffusion_unet_def").to(device)
     unet = torch.nn.SyncBatchNorm.convert_sync_batchnorm(unet)
 
-    if dist.is_initialized():
-        unet = DistributedDataParallel(unet, device_ids=[device], find_unused_parameters=True)
-
     if args.existing_ckpt_filepath is None:
         logger.info("Training from scratch.")
     else:
         checkpoint_unet = torch.load(f"{args.existing_ckpt_filepath}", map_location=device, weights_only=False)
+        unet.load_state_dict(checkpoint_unet["unet_state_dict"], strict=False)
+        logger.info(f"Pretrained checkpoint {args.existing_ckpt_filepath} loaded.")
 
-        if dist.is_initialized():
-            unet.module.load_state_dict(checkpoint_unet["unet_state_dict"], strict=False)
+    if dist.is_initialized():
+        if args.diffusion_unet_train.get("static_graph", False):
+            freeze_unused_parameters(unet, device, logger)
+            unet = DistributedDataParallel(
+                unet,
+                device_ids=[device],
+                find_unused_parameters=False,
+                static_graph=True,
+                gradient_as_bucket_view=True,
+                bucket_cap_mb=args.diffusion_unet_train.get("ddp_bucket_cap_mb", 25),
+            )
         else:
-            unet.load_state_dict(checkpoint_unet["unet_state_dict"], strict=False)
-        logger.info(f"Pretrained checkpoint {args.existing_ckpt_filepath} loaded.")
+            unet = DistributedDataParallel(unet, device_ids=[device], find_unused_parameters=True)
 
     return unet
 
@@ -195,6 +304,121 @@ def calculate_scale_factor(train_loader: DataLoader, device: torch.device, logge
     return scale_factor
 
 
+def _merge_moments(count_a: float, mean_a: float, m2_a: float, count_b: float, mean_b: float, m2_b: float) -> tuple:
+    """
+    Merge two partial (count, mean, M2) statistics with the parallel algorithm of Chan et al.
+
+    Returns:
+        tuple: Merged (count, mean, M2).
+    """
+    count = count_a + count_b
+    if count == 0:
+        return 0.0, 0.0, 0.0
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta * delta * count_a * count_b / count
+    return count, mean, m2
+
+
+def estimate_scale_factor(
+    train_files: list,
+    device: torch.device,
+    logger: logging.Logger,
+    num_samples: int = 0,
+    cache_path: str | None = None,
+    seed: int = 0,
+) -> torch.Tensor:
+    """
+    Estimate the scaling factor ``1 / std`` over a sample of latents of the whole dataset.
+
+    Every rank streams its share of the sampled latents and accumulates exact (count, mean, M2)
+    statistics in float64; the partial statistics are merged across ranks with the parallel
+    variance algorithm, so the result does not depend on shuffling or on the number of GPUs.
+    The result is cached as JSON and reused as long as the sampled files (names, sizes and
+    modification times) are unchanged.
+
+    Args:
+        train_files (list): Full (un-partitioned) list of training file dictionaries.
+        device (torch.device): Device to use for calculation.
+        logger (logging.Logger): Logger for logging information.
+        num_samples (int): Number of latents to sample; ``0`` or a negative value uses all of them.
+        cache_path (str | None): Path of the JSON cache file, or None to disable caching.
+        seed (int): Seed of the latent sampling.
+
+    Returns:
+        torch.Tensor: Estimated scaling factor.
+    """
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+
+    filenames = sorted(_item["image"] for _item in train_files)
+    if 0 < num_samples < len(filenames):
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        filenames = sorted(filenames[i] for i in torch.randperm(len(filenames), generator=generator)[:num_samples].tolist())
+    # the file sizes and modification times invalidate the cache when latents are regenerated under the same names
+    signatures = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        signatures.append(f"{filename}\t{stat.st_size}\t{stat.st_mtime_ns}")
+    cache_key = hashlib.sha1("\n".join(signatures).encode()).hexdigest()
+
+    # rank 0 decides whether the cache is valid so that all ranks take the same branch
+    cached = torch.zeros(2, dtype=torch.float64, device=device)
+    if rank == 0 and cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache.get("cache_key") == cache_key:
+            cached[0], cached[1] = 1.0, cache["scale_factor"]
+    if dist.is_initialized():
+        dist.broadcast(cached, src=0)
+    if cached[0] > 0:
+        scale_factor = cached[1].float()
+        logger.info(f"scale_factor -> {scale_factor} (cached in {cache_path}).")
+        return scale_factor
+
+    count, mean, m2 = 0.0, 0.0, 0.0
+    for filename in filenames[rank::world_size]:
+        z = torch.from_numpy(nib.load(filename).get_fdata(dtype="float32")).to(device, dtype=torch.float64)
+        z_mean = z.mean()
+        z_m2 = torch.sum((z - z_mean) ** 2)
+        count, mean, m2 = _merge_moments(count, mean, m2, float(z.numel()), z_mean.item(), z_m2.item())
+
+    partial = torch.tensor([count, mean, m2], dtype=torch.float64, device=device)
+    if dist.is_initialized():
+        gathered = [torch.zeros_like(partial) for _ in range(world_size)]
+        dist.all_gather(gathered, partial)
+    else:
+        gathered = [partial]
+    count, mean, m2 = 0.0, 0.0, 0.0
+    # merge in rank order so that every rank gets bit-identical results
+    for _partial in gathered:
+        count, mean, m2 = _merge_moments(count, mean, m2, *_partial.tolist())
+    if count < 2:
+        raise ValueError("At least two latent voxels are required to estimate the scale factor.")
+
+    std = (m2 / (count - 1)) ** 0.5
+    scale_factor = torch.tensor(1.0 / std, dtype=torch.float32, device=device)
+    logger.info(f"Latent statistics over {len(filenames)} files: mean {mean:.6f}, std {std:.6f}.")
+    logger.info(f"scale_factor -> {scale_factor}.")
+
+    if rank == 0 and cache_path is not None:
+        with open(cache_path, "w") as f:
+            json.dump(
+                {
+                    "cache_key": cache_key,
+                    "num_files": len(filenames),
+                    "num_voxels": int(count),
+                    "mean": mean,
+                    "std": std,
+                    "scale_factor": 1.0 / std,
+                },
+                f,
+                indent=4,
+            )
+    return scale_factor
+
+
 def create_optimizer(model: torch.nn.Module, lr: float) -> torch.optim.Optimizer:
     """
     Create optimizer for training.
@@ -239,6 +463,7 @@ def train_one_epoch(
     logger: logging.Logger,
     local_rank: int,
     amp: bool = True,
+    monitor: TrainingMonitor | None = None,
 ) -> torch.Tensor:
     """
     Train the model for one epoch.
@@ -259,6 +484,7 @@ def train_one_epoch(
         logger (logging.Logger): Logger for logging information.
         local_rank (int): Local rank for distributed training.
         amp (bool): Use automatic mixed precision training.
+        monitor (TrainingMonitor | None): Optional per-iteration timing instrumentation.
 
     Returns:
         torch.Tensor: Training loss for the epoch.
@@ -270,11 +496,16 @@ def train_one_epoch(
         current_lr = optimizer.param_groups[0]["lr"]
         logger.info(f"Epoch {epoch + 1}, lr {current_lr}.")
 
+    if monitor is None:
+        monitor = TrainingMonitor(enabled=False)
+
     _iter = 0
     loss_torch = torch.zeros(2, dtype=torch.float, device=device)
 
     unet.train()
+    monitor.start_epoch(epoch)
     for train_data in train_loader:
+        monitor.mark("data")
         current_lr = optimizer.param_groups[0]["lr"]
 
         _iter += 1
@@ -289,6 +520,7 @@ def train_one_epoch(
             modality_tensor = augment_modality_label(modality_tensor).to(device)
 
         spacing_tensor = train_data["spacing"].to(device)
+        monitor.mark("h2d")
 
         optimizer.zero_grad(set_to_none=True)
 
@@ -344,13 +576,19 @@ def train_one_epoch(
 
         if amp:
             scaler.scale(loss).backward()
+        else:
+            loss.backward()
+        monitor.mark("compute")
+
+        if amp:
             scaler.step(optimizer)
             scaler.update()
         else:
-            loss.backward()
             optimizer.step()
 
         lr_scheduler.step()
+        monitor.mark("optimizer")
+        monitor.end_iteration(images.shape[0])
 
         loss_torch[0] += loss.item()
         loss_torch[1] += 1.0
@@ -360,6 +598,8 @@ def train_one_epoch(
                 f"[{str(datetime.now())[:19]}] epoch {epoch + 1}, iter {_iter}/{len(train_loader)}, loss: {loss.item():.4f}, lr: {current_lr:.12f}."
             )
 
+    monitor.end_epoch()
+
     if dist.is_initialized():
         dist.all_reduce(loss_torch, op=torch.distributed.ReduceOp.SUM)
 
@@ -374,6 +614,8 @@ def save_checkpoint(
     scale_factor: torch.Tensor,
     ckpt_folder: str,
     args: argparse.Namespace,
+    writer: AsyncCheckpointWriter | None = None,
+    is_best: bool = False,
 ) -> None:
     """
     Save checkpoint.
@@ -386,18 +628,21 @@ def save_checkpoint(
         scale_factor (torch.Tensor): Scaling factor.
         ckpt_folder (str): Checkpoint folder path.
         args (argparse.Namespace): Configuration arguments.
+        writer (AsyncCheckpointWriter | None): Optional background writer; saves synchronously when None.
+        is_best (bool): Whether this epoch has the lowest loss so far (only used by the background writer).
     """
     unet_state_dict = unet.module.state_dict() if dist.is_initialized() else unet.state_dict()
-    torch.save(
-        {
-            "epoch": epoch + 1,
-            "loss": loss_torch_epoch,
-            "num_train_timesteps": num_train_timesteps,
-            "scale_factor": scale_factor,
-            "unet_state_dict": unet_state_dict,
-        },
-        f"{ckpt_folder}/{args.model_filename}",
-    )
+    checkpoint = {
+        "epoch": epoch + 1,
+        "loss": loss_torch_epoch,
+        "num_train_timesteps": num_train_timesteps,
+        "scale_factor": scale_factor,
+        "unet_state_dict": unet_state_dict,
+    }
+    if writer is None:
+        torch.save(checkpoint, f"{ckpt_folder}/{args.model_filename}")
+    else:
+        writer.save(checkpoint, f"{ckpt_folder}/{args.model_filename}", epoch=epoch + 1, is_best=is_best)
 
 
 def diff_model_train(env_config_path: str, model_config_path: str, model_def_path: str, num_gpus: int, amp: bool = True) -> None:
@@ -455,7 +700,28 @@ def diff_model_train(env_config_path: str, model_config_path: str, model_def_pat
         if include_modality:
             train_files_i["modality"] = str_info
         train_files.append(train_files_i)
-    if dist.is_initialized():
+
+    all_train_files = train_files
+
+    # the bucketing sampler partitions the files across ranks itself, from the shapes of the full file list
+    batch_sampler = None
+    if args.diffusion_unet_train.get("shape_bucketing", False):
+        latent_shapes = load_latent_shapes(train_files)
+        batch_sampler = ShapeBucketBatchSampler(
+            latent_shapes,
+            batch_size=args.diffusion_unet_train["batch_size"],
+            shuffle=True,
+            num_replicas=world_size,
+            rank=local_rank,
+            seed=args.diffusion_unet_train.get("seed", 0),
+        )
+        train_files = [train_files[i] for i in batch_sampler.indices]
+        if local_rank == 0:
+            shape_counts = {}
+            for shape in latent_shapes:
+                shape_counts[shape] = shape_counts.get(shape, 0) + 1
+            logger.info(f"[config] shape_bucketing -> {len(shape_counts)} buckets: {shape_counts}.")
+    elif dist.is_initialized():
         train_files = partition_dataset(data=train_files, shuffle=True, num_partitions=dist.get_world_size(), even_divisible=True)[local_rank]
 
     train_loader = prepare_data(
@@ -466,12 +732,26 @@ def diff_model_train(env_config_path: str, model_config_path: str, model_def_pat
         include_body_region=include_body_region,
         include_modality=include_modality,
         modality_mapping=args.modality_mapping,
+        batch_sampler=batch_sampler,
     )
 
-    scale_factor = calculate_scale_factor(train_loader, device, logger)
+    if "scale_factor_num_samples" in args.diffusion_unet_train:
+        scale_factor = estimate_scale_factor(
+            all_train_files,
+            device,
+            logger,
+            num_samples=args.diffusion_unet_train["scale_factor_num_samples"],
+            cache_path=args.diffusion_unet_train.get("scale_factor_cache", os.path.join(args.embedding_base_dir, "scale_factor_stats.json")),
+            seed=args.diffusion_unet_train.get("seed", 0),
+        )
+    else:
+        scale_factor = calculate_scale_factor(train_loader, device, logger)
     optimizer = create_optimizer(unet, args.diffusion_unet_train["lr"])
 
-    total_steps = (args.diffusion_unet_train["n_epochs"] * len(train_loader.dataset)) / args.diffusion_unet_train["batch_size"]
+    if batch_sampler is not None:
+        total_steps = args.diffusion_unet_train["n_epochs"] * len(train_loader)
+    else:
+        total_steps = (args.diffusion_unet_train["n_epochs"] * len(train_loader.dataset)) / args.diffusion_unet_train["batch_size"]
     lr_scheduler = create_lr_scheduler(optimizer, total_steps)
     loss_pt = torch.nn.L1Loss()
     scaler = GradScaler("cuda")
@@ -479,7 +759,26 @@ def diff_model_train(env_config_path: str, model_config_path: str, model_def_pat
     torch.set_float32_matmul_precision("highest")
     logger.info("torch.set_float32_matmul_precision -> highest.")
 
+    monitor = TrainingMonitor(
+        enabled=args.diffusion_unet_train.get("monitor", False),
+        device=device,
+        rank=local_rank,
+        jsonl_path=os.path.join(args.model_dir, "train_monitor.jsonl"),
+        logger=logger,
+    )
+
+    checkpoint_writer = None
+    if args.diffusion_unet_train.get("async_checkpoint", False):
+        checkpoint_writer = AsyncCheckpointWriter(
+            max_in_flight=args.diffusion_unet_train.get("max_checkpoints_in_flight", 1),
+            keep_last=args.diffusion_unet_train.get("keep_last_checkpoints", 0),
+            logger=logger,
+        )
+    best_loss = float("inf")
+
     for epoch in range(args.diffusion_unet_train["n_epochs"]):
+        if batch_sampler is not None:
+            batch_sampler.set_epoch(epoch)
         loss_torch = train_one_epoch(
             epoch,
             unet,
@@ -496,13 +795,17 @@ def diff_model_train(env_config_path: str, model_config_path: str, model_def_pat
             logger,
             local_rank,
             amp=amp,
+            monitor=monitor,
         )
 
         loss_torch = loss_torch.tolist()
         if torch.cuda.device_count() == 1 or local_rank == 0:
             loss_torch_epoch = loss_torch[0] / loss_torch[1]
             logger.info(f"epoch {epoch + 1} average loss: {loss_torch_epoch:.4f}.")
+            log_ddp_comm_stats(unet, logger)
 
+            is_best = loss_torch_epoch < best_loss
+            best_loss = min(best_loss, loss_torch_epoch)
             save_checkpoint(
                 epoch,
                 unet,
@@ -511,8 +814,13 @@ def diff_model_train(env_config_path: str, model_config_path: str, model_def_pat
                 scale_factor,
                 args.model_dir,
                 args,
+                writer=checkpoint_writer,
+                is_best=is_best,
             )
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
     if dist.is_initialized():
         dist.destroy_process_group()
 
@@ -0,0 +1,334 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline pool of augmented candidate masks.
+
+``LDMSampler`` augments every selected database mask inline (``scripts.augmentation.augmentation``),
+which puts the elastic deformations on the critical path of each generation. This command runs the
+same resampling and augmentation ahead of time, in a process pool, and the sampler draws from the
+result instead (``"augmented_mask_pool"`` in ``config_infer.json``).
+
+What lives here:
+
+- ``generate_mask_pool``  — augment the candidate masks of an inference config, ``num_per_mask``
+                            seeds each, and write the pool.
+- ``AugmentedMaskPool``   — read side used by ``LDMSampler``: draw and load pool entries.
+
+Pool layout: one compressed ``.npz`` per augmented mask (``label`` in the smallest integer dtype,
+``affine``), and ``mask_pool_index.json`` listing, per entry, the file, the source mask (relative to
+the mask database directory), the augmentation seed, the spacing, dim, label list and body region
+indices.
+
+Usage:
+
+    python -m scripts.generate_mask_pool -e ./configs/environment_rflow-ct.json -i ./configs/config_infer.json \\
+        --pool_dir ./datasets/augmented_mask_pool --num_per_mask 4 --num_workers 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import monai
+import numpy as np
+import torch
+from monai.data import MetaTensor
+
+from .augmentation import augmentation
+from .find_masks import find_masks
+from .utils import get_body_region_index_from_mask
+
+POOL_INDEX_FILENAME = "mask_pool_index.json"
+POOL_VERSION = 1
+
+logger = logging.getLogger("maisi.mask_pool")
+
+
+def _source_key(path: str) -> str:
+    return os.path.normpath(path).replace(os.sep, "/")
+
+
+def _same_geometry(entry: dict, output_size, spacing) -> bool:
+    return list(entry["dim"]) == [int(v) for v in output_size] and all(abs(float(a) - float(b)) < 1e-4 for a, b in zip(entry["spacing"], spacing))
+
+
+class AugmentedMaskPool:
+    """
+    Augmented masks pre-generated by ``python -m scripts.generate_mask_pool``.
+
+    Entries are grouped by source mask. Each draw for a source mask returns the next entry of a
+    shuffled order, so all its augmentations are used once before any is repeated.
+
+    Args:
+        pool_dir: directory holding ``mask_pool_index.json`` and the ``.npz`` entries.
+        seed: seed of the shuffling of the entries.
+    """
+
+    def __init__(self, pool_dir: str, seed: int | None = None) -> None:
+        self.pool_dir = pool_dir
+        with open(os.path.join(pool_dir, POOL_INDEX_FILENAME)) as f:
+            index = json.load(f)
+        if index.get("version") != POOL_VERSION:
+            raise ValueError(f"Unsupported mask pool version {index.get('version')} in {pool_dir}, expected {POOL_VERSION}.")
+        self.entries: dict[str, list[dict]] = {}
+        for entry in index["entries"]:
+            self.entries.setdefault(_source_key(entry["source_mask"]), []).append(entry)
+        self._rng = random.Random(seed)
+        self._order: dict[tuple, list[dict]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self.entries.values())
+
+    def draw(self, source_mask: str, output_size, spacing) -> dict | None:
+        """
+        Draw an augmentation of a source mask.
+
+        Args:
+            source_mask: path of the source mask relative to the mask database directory.
+            output_size: required dim of the augmented mask.
+            spacing: required spacing of the augmented mask.
+
+        Returns:
+            dict | None: index entry of the augmented mask, or None if the pool has none for this source and geometry.
+        """
+        key = (_source_key(source_mask), tuple(output_size), tuple(spacing))
+        if not self._order.get(key):
+            candidates = [e for e in self.entries.get(key[0], []) if _same_geometry(e, output_size, spacing)]
+            if not candidates:
+                return None
+            self._rng.shuffle(candidates)
+            self._order[key] = candidates
+        return self._order[key].pop()
+
+    def load(self, entry: dict) -> MetaTensor:
+        """
+        Load an augmented mask.
+
+        Args:
+            entry: index entry returned by ``draw``.
+
+        Returns:
+            MetaTensor: int64 label volume of shape [1,H,W,D] with its affine.
+        """
+        with np.load(os.path.join(self.pool_dir, entry["file"])) as data:
+            label = torch.from_numpy(data["label"].astype(np.int64))
+            affine = torch.from_numpy(data["affine"])
+        return MetaTensor(label, affine=affine)
+
+
+def _minimal_label_dtype(label: np.ndarray) -> np.dtype:
+    for dtype in (np.uint8, np.uint16, np.int32):
+        if label.min() >= np.iinfo(dtype).min and label.max() <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _resample_label(label: MetaTensor, spacing, output_size) -> tuple[MetaTensor, bool]:
+    """Resample a [1,H,W,D] label to ``spacing`` and pad/crop it to ``output_size``, as ``LDMSampler.ensure_output_size_and_spacing``."""
+    current_spacing = [float(label.affine[i, i]) for i in range(3)]
+    if current_spacing == [float(s) for s in spacing] and list(label.shape[1:]) == [int(s) for s in output_size]:
+        return label, False
+    resample = monai.transforms.Spacing(pixdim=tuple(spacing), mode="nearest")
+    pad_crop = monai.transforms.ResizeWithPadOrCrop(spatial_size=tuple(output_size))
+    return pad_crop(resample(label)).to(label.dtype), True
+
+
+def _augment_mask(task: dict) -> list[dict]:
+    """Resample one database mask and write its augmentations; runs in a worker process."""
+    device = torch.device(task["device"])
+    loader = monai.transforms.Compose(
+        [
+            monai.transforms.LoadImage(image_only=True, ensure_channel_first=True),
+            monai.transforms.Orientation(axcodes="RAS"),
+            monai.transforms.EnsureType(dtype=torch.long),
+        ]
+    )
+    label, resampled = _resample_label(loader(task["pseudo_label"]), task["spacing"], task["output_size"])
+    if resampled and not set(task["anatomy_list"]).issubset(set(torch.unique(label).tolist())):
+        logger.info(f"{task['source_mask']}: resampled mask misses some of the required labels, skipped")
+        return []
+    # the body region indices of the database only hold for the original geometry
+    if resampled or task["top_region_index"] is None:
+        top_region_index, bottom_region_index = get_body_region_index_from_mask(label.unsqueeze(0))
+    else:
+        top_region_index, bottom_region_index = task["top_region_index"], task["bottom_region_index"]
+    affine = np.asarray(label.affine, dtype=np.float64)
+
+    entries = []
+    stem = os.path.basename(task["source_mask"]).split(".")[0]
+    for seed in task["seeds"]:
+        start_time = time.time()
+        augmented = augmentation(label.clone().unsqueeze(0).to(device), task["output_size"], seed).squeeze(0)
+        augmented = augmented.cpu().numpy()
+        filename = f"{stem}_aug{seed}.npz"
+        np.savez_compressed(os.path.join(task["pool_dir"], filename), label=augmented.astype(_minimal_label_dtype(augmented)), affine=affine)
+        entries.append(
+            {
+                "file": filename,
+                "source_mask": task["source_mask"],
+                "seed": seed,
+                "spacing": [float(s) for s in task["spacing"]],
+                "dim": [int(s) for s in task["output_size"]],
+                "label_list": sorted(int(v) for v in np.unique(augmented)),
+                "top_region_index": [float(v) for v in top_region_index],
+                "bottom_region_index": [float(v) for v in bottom_region_index],
+            }
+        )
+        logger.info(f"{filename}: augmented in {time.time() - start_time:.1f}s")
+    return entries
+
+
+def _init_worker(num_threads: int) -> None:
+    torch.set_num_threads(num_threads)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="[%(asctime)s][%(levelname)5s](%(name)s) - %(message)s")
+
+
+def generate_mask_pool(
+    candidate_masks: list[dict],
+    mask_dir: str,
+    pool_dir: str,
+    anatomy_list: list[int],
+    output_size,
+    spacing,
+    num_per_mask: int = 4,
+    seed: int = 0,
+    num_workers: int = 1,
+    device: str = "cpu",
+) -> list[dict]:
+    """
+    Augment candidate masks in a process pool and write the pool index.
+
+    A mask whose augmentation fails is logged and left out; the index lists the masks that succeeded.
+
+    Args:
+        candidate_masks: database entries as returned by ``find_masks``.
+        mask_dir: mask database directory, the source masks are recorded relative to it.
+        pool_dir: output directory.
+        anatomy_list: labels the resampled masks must still contain.
+        output_size: dim of the pool masks.
+        spacing: spacing of the pool masks.
+        num_per_mask: number of augmentations of each mask; mask ``i`` gets seeds ``seed + i * num_per_mask + k``.
+        seed: base augmentation seed.
+        num_workers: number of worker processes.
+        device: torch device of the augmentations in the workers.
+
+    Returns:
+        list[dict]: the index entries.
+    """
+    os.makedirs(pool_dir, exist_ok=True)
+    tasks = []
+    for i, candidate in enumerate(candidate_masks):
+        tasks.append(
+            {
+                "pseudo_label": candidate["pseudo_label"],
+                "source_mask": _source_key(os.path.relpath(candidate["pseudo_label"], mask_dir)),
+                "seeds": [seed + i * num_per_mask + k for k in range(num_per_mask)],
+                "anatomy_list": list(anatomy_list),
+                "output_size": list(output_size),
+                "spacing": list(spacing),
+                "top_region_index": candidate.get("top_region_index"),
+                "bottom_region_index": candidate.get("bottom_region_index"),
+                "pool_dir": pool_dir,
+                "device": device,
+            }
+        )
+
+    start_time = time.time()
+    entries = []
+    num_threads = max(1, (os.cpu_count() or 1) // max(num_workers, 1))
+    # spawn: CUDA and the MONAI transforms' thread pools are not fork-safe
+    with ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(num_threads,)
+    ) as executor:
+        futures = {executor.submit(_augment_mask, task): task["source_mask"] for task in tasks}
+        num_failed = 0
+        for future in as_completed(futures):
+            try:
+                entries.extend(future.result())
+            except Exception as e:
+                # a failing mask must not lose the augmentations of the others
+                num_failed += 1
+                logger.warning(f"{futures[future]}: skipped, {e}")
+    if num_failed:
+        logger.warning(f"{num_failed} of {len(tasks)} source masks failed and are not in the pool.")
+    entries.sort(key=lambda e: (e["source_mask"], e["seed"]))
+
+    index = {"version": POOL_VERSION, "output_size": list(output_size), "spacing": list(spacing), "entries": entries}
+    with open(os.path.join(pool_dir, POOL_INDEX_FILENAME), "w") as f:
+        json.dump(index, f, indent=2)
+    logger.info(f"Wrote {len(entries)} augmented masks of {len(tasks)} source masks to {pool_dir} in {time.time() - start_time:.1f}s")
+    return entries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pre-generate a pool of augmented candidate masks for inference.")
+    parser.add_argument("-e", "--environment-file", default="./configs/environment_rflow-ct.json", help="environment json file")
+    parser.add_argument("-i", "--inference-file", default="./configs/config_infer.json", help="inference config json file")
+    parser.add_argument("--pool_dir", required=True, help="output directory of the pool")
+    parser.add_argument("--num_per_mask", type=int, default=4, help="number of augmentations of each candidate mask")
+    parser.add_argument("--max_masks", type=int, default=0, help="maximum number of candidate masks, 0 for all")
+    parser.add_argument("--seed", type=int, default=0, help="base augmentation seed")
+    parser.add_argument("--num_workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="number of worker processes")
+    parser.add_argument("--device", type=str, default="cpu", help="torch device of the augmentations")
+    args = parser.parse_args()
+
+    with open(args.environment_file) as f:
+        env_dict = json.load(f)
+    with open(args.inference_file) as f:
+        config_infer = json.load(f)
+    # the dataset paths are resolved as in scripts.inference
+    root_dir = os.environ.get("MONAI_DATA_DIRECTORY", "")
+    for k in ["all_mask_files_base_dir", "all_mask_files_json"]:
+        if "datasets/" in env_dict[k]:
+            env_dict[k] = os.path.join(root_dir, env_dict[k])
+    mask_dir, database = env_dict["all_mask_files_base_dir"], env_dict["all_mask_files_json"]
+    with open(env_dict["label_dict_json"]) as f:
+        label_dict = json.load(f)
+    anatomy_list = [label_dict[organ] for organ in config_infer["anatomy_list"]]
+
+    candidate_masks = find_masks(
+        config_infer["body_region"], anatomy_list, config_infer["spacing"], config_infer["output_size"], False, database, mask_dir
+    )
+    random.Random(args.seed).shuffle(candidate_masks)
+    if args.max_masks > 0:
+        candidate_masks = candidate_masks[: args.max_masks]
+    logger.info(f"Augmenting {len(candidate_masks)} candidate masks x {args.num_per_mask} with {args.num_workers} workers.")
+    generate_mask_pool(
+        candidate_masks,
+        mask_dir,
+        args.pool_dir,
+        anatomy_list,
+        config_infer["output_size"],
+        config_infer["spacing"],
+        num_per_mask=args.num_per_mask,
+        seed=args.seed,
+        num_workers=args.num_workers,
+        device=args.device,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="[%(asctime)s.%(msecs)03d][%(levelname)5s](%(name)s) - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    main()
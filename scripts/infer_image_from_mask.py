@@ -81,6 +81,8 @@ def ldm_conditional_sample_one_image_from_mask(
     autoencoder_sliding_window_infer_size=(96, 96, 96),
     autoencoder_sliding_window_infer_overlap=0.6667,
     cfg_guidance_scale=0,
+    latent_gate=None,
+    output_device=None,
 ):
     """
     Generate a CT/MR image from a **3D label mask** via the ControlNet-
@@ -101,7 +103,10 @@ def ldm_conditional_sample_one_image_from_mask(
     while reusing the same ``run_controlnet_conditioned_image_dm`` core.
 
     Returns ``(synthetic_image, combine_label)`` — the mask is returned for
-    downstream filtering (e.g. ``filter_mask_with_organs``).
+    downstream filtering (e.g. ``filter_mask_with_organs``). ``synthetic_image``
+    is ``None`` when the optional ``latent_gate`` (see
+    ``run_controlnet_conditioned_image_dm``) rejected the latents before decoding.
+    ``output_device`` is the device the image is returned on (CPU by default).
     """
     # modality_tensor can be scalar (single mask) or shape (B,) (batch infer);
     # collapse to a single int so `if` doesn't choke on a multi-element bool tensor.
@@ -155,7 +160,11 @@ def ldm_conditional_sample_one_image_from_mask(
         autoencoder_sliding_window_infer_overlap=autoencoder_sliding_window_infer_overlap,
         cfg_guidance_scale=cfg_guidance_scale,
         controlnet_uncond_tensor=controlnet_uncond_tensor,
+        latent_gate=latent_gate,
+        output_device=output_device,
     )
+    if synthetic_images is None:
+        return None, combine_label
 
     # ── Mask-specific post-processing ──────────────────────────────────────────
     # Regularize background HU using the mask: voxels where mask==0 → a_min.
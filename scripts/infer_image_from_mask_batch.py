@@ -18,9 +18,9 @@ from datetime import datetime
 import torch
 import torch.distributed as dist
 from monai.data import MetaTensor, decollate_batch
-from monai.transforms import SaveImage
 from monai.utils import RankFilter
 
+from .async_writer import AsyncNiftiWriter
 from .diff_model_setting import load_config
 from .infer_image_from_mask import ldm_conditional_sample_one_image
 from .utils import prepare_maisi_controlnet_json_dataloader, setup_ddp
@@ -43,7 +43,12 @@ def infer_image_from_mask_batch(env_config_path: str, model_config_path: str, mo
           ``include_top_region_index_input=True`` — i.e. ``ddpm-ct``)
 
     For each batch, calls :func:`ldm_conditional_sample_one_image` and saves
-    the paired image + label as NIfTI under ``args.output_dir``.
+    the paired image + label as NIfTI under ``args.output_dir``. The files are
+    written by an :class:`AsyncNiftiWriter` while the next batch is generated;
+    ``output_compression_level``, ``num_writer_threads`` and ``max_pending_writes``
+    in ``args.controlnet_infer`` configure it, and ``image_output_encoding``,
+    ``label_output_encoding`` and ``verify_output_encoding`` select compact
+    integer outputs (see ``async_writer.encode_output``).
 
     For single-mask inference, use ``python -m scripts.infer_image_from_mask
     --mask <file>`` instead (no manifest needed).
@@ -103,6 +108,14 @@ def infer_image_from_mask_batch(env_config_path: str, model_config_path: str, mo
     controlnet.eval()
     unet.eval()
 
+    writer = AsyncNiftiWriter(
+        num_workers=args.controlnet_infer.get("num_writer_threads", 2),
+        max_pending=args.controlnet_infer.get("max_pending_writes", 4),
+        compression_level=args.controlnet_infer.get("output_compression_level", None),
+        verify=args.controlnet_infer.get("verify_output_encoding", False),
+    )
+    image_encoding = args.controlnet_infer.get("image_output_encoding", None)
+    label_encoding = args.controlnet_infer.get("label_output_encoding", None)
     for batch in val_loader:
         # get label mask
         labels = batch["label"].to(device)
@@ -145,18 +158,11 @@ def infer_image_from_mask_batch(env_config_path: str, model_config_path: str, mo
         output_postfix = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
         labels.meta["filename_or_obj"] = "sample.nii.gz"
         synthetic_images = MetaTensor(synthetic_images.squeeze(0), meta=labels.meta)
-        img_saver = SaveImage(
-            output_dir=args.output_dir,
-            output_postfix=output_postfix + "_image",
-            separate_folder=False,
-        )
-        img_saver(synthetic_images)
-        label_saver = SaveImage(
-            output_dir=args.output_dir,
-            output_postfix=output_postfix + "_label",
-            separate_folder=False,
+        writer.submit(
+            synthetic_images, encoding=image_encoding, output_dir=args.output_dir, output_postfix=output_postfix + "_image", separate_folder=False
         )
-        label_saver(labels)
+        writer.submit(labels, encoding=label_encoding, output_dir=args.output_dir, output_postfix=output_postfix + "_label", separate_folder=False)
+    writer.close()
     if use_ddp:
         dist.destroy_process_group()
 
@@ -218,6 +218,17 @@ def main():
         autoencoder_sliding_window_infer_size=args.autoencoder_sliding_window_infer_size,
         autoencoder_sliding_window_infer_overlap=args.autoencoder_sliding_window_infer_overlap,
         cfg_guidance_scale=args.cfg_guidance_scale,
+        augmented_mask_pool=getattr(args, "augmented_mask_pool", None),
+        preview_quality_check=getattr(args, "preview_quality_check", None),
+        preview_stride=getattr(args, "preview_stride", 4),
+        preview_margin=getattr(args, "preview_margin", 100.0),
+        output_compression_level=getattr(args, "output_compression_level", None),
+        num_writer_threads=getattr(args, "num_writer_threads", 2),
+        max_pending_writes=getattr(args, "max_pending_writes", 4),
+        image_output_encoding=getattr(args, "image_output_encoding", None),
+        label_output_encoding=getattr(args, "label_output_encoding", None),
+        verify_output_encoding=getattr(args, "verify_output_encoding", False),
+        decode_on_device=getattr(args, "decode_on_device", False),
     )
 
     logger.info(f"The generated image/mask pairs will be saved in {args.output_dir}.")
@@ -0,0 +1,396 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Binary morphology on torch tensors with separable max-pool kernels.
+
+A dilation by a k x k x k box is the maximum over the box, which factorizes into three 1D
+max-pool passes of length k, instead of a dense k^3 convolution. Erosion is the dual
+(``1 - dilate(1 - x)``). Used by:
+
+- ``scripts/utils.py``         — ``erode_one_img``, ``dilate_one_img`` and mask post-processing
+- ``scripts/augmentation.py``  — ``erode3d``, ``dilate3d`` and tumour augmentation
+- ``scripts/train_controlnet.py`` — region-contrastive loss masks
+
+What lives here:
+
+- ``dilate`` / ``erode``   — box or approximate-ball structuring elements, per-axis sizes,
+                             iterations and constant padding.
+- ``closing`` / ``opening`` — alternating rounds of the two, as used by the post-processing.
+- ``bounding_box``         — padded bounding box of a NumPy or torch mask.
+- ``BBoxCrop`` / ``crop_apply`` — run an operation on the padded bounding box of a small
+                             organ or tumour instead of the whole volume, and paste it back.
+
+Inputs are binary masks (non-zero voxels are foreground) of shape ``(..., *spatial)`` with
+2 or 3 spatial dimensions; leading dimensions are treated as a batch. bool, uint8, integer
+and floating-point tensors are accepted and the output has the input's dtype and shape.
+"""
+
+from __future__ import annotations
+
+import logging
+from collections.abc import Callable, Sequence
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from monai.utils import ensure_tuple_rep
+
+ELEMENTS = ("box", "ball")
+
+logger = logging.getLogger(__name__)
+
+
+def _pool_dtype(device: torch.device) -> torch.dtype:
+    # 0/1 values are exact in half precision, which halves the memory of the passes on GPU
+    return torch.float16 if device.type == "cuda" else torch.float32
+
+
+def _check_filter_size(filter_size: int | Sequence[int], spatial_dims: int) -> tuple[int, ...]:
+    filter_size = ensure_tuple_rep(filter_size, spatial_dims)
+    for k in filter_size:
+        if k < 1 or k % 2 == 0:
+            raise ValueError(f"filter_size has to be positive odd numbers, got {filter_size}.")
+    return tuple(int(k) for k in filter_size)
+
+
+def _to_batch(mask: torch.Tensor, spatial_dims: int) -> torch.Tensor:
+    if spatial_dims not in (2, 3):
+        raise ValueError(f"spatial_dims has to be 2 or 3, got {spatial_dims}.")
+    if mask.ndim < spatial_dims:
+        raise ValueError(f"mask needs at least {spatial_dims} dimensions, got shape {tuple(mask.shape)}.")
+    spatial_shape = mask.shape[mask.ndim - spatial_dims :]
+    return (mask != 0).to(_pool_dtype(mask.device)).reshape((-1, 1) + tuple(spatial_shape))
+
+
+def _from_batch(x: torch.Tensor, like: torch.Tensor) -> torch.Tensor:
+    x = x.reshape(like.shape)
+    if like.dtype == torch.bool:
+        return x > 0
+    return x.to(like.dtype)
+
+
+def _max_filter_box(x: torch.Tensor, filter_size: tuple[int, ...], pad_value: float) -> torch.Tensor:
+    """Maximum over a box, as one 1D max-pool pass per axis on the padded input."""
+    spatial_dims = len(filter_size)
+    pad = []
+    for k in reversed(filter_size):
+        pad += [k // 2, k // 2]
+    x = F.pad(x, pad, mode="constant", value=pad_value)
+    pool = F.max_pool3d if spatial_dims == 3 else F.max_pool2d
+    for axis, k in enumerate(filter_size):
+        if k > 1:
+            kernel = [1] * spatial_dims
+            kernel[axis] = k
+            x = pool(x, kernel_size=kernel, stride=1)
+    return x
+
+
+def _max_filter_cross(x: torch.Tensor, spatial_dims: int, pad_value: float) -> torch.Tensor:
+    """Maximum over the 6-neighbourhood (4 in 2D) plus the center voxel."""
+    x_padded = F.pad(x, [1, 1] * spatial_dims, mode="constant", value=pad_value)
+    pool = F.max_pool3d if spatial_dims == 3 else F.max_pool2d
+    out = None
+    for axis in range(spatial_dims):
+        kernel = [1] * spatial_dims
+        kernel[axis] = 3
+        # crop the padding of the other axes
+        crop = [slice(None), slice(None)] + [slice(None) if d == axis else slice(1, -1) for d in range(spatial_dims)]
+        line = pool(x_padded[tuple(crop)], kernel_size=kernel, stride=1)
+        out = line if out is None else torch.maximum(out, line)
+    return out
+
+
+def _max_filter(x: torch.Tensor, filter_size: tuple[int, ...], element: str, pad_value: float) -> torch.Tensor:
+    if element == "box":
+        return _max_filter_box(x, filter_size, pad_value)
+    if element == "ball":
+        if len(set(filter_size)) != 1:
+            raise ValueError(f"the ball element needs an isotropic filter_size, got {filter_size}.")
+        # alternating cross and 3-box passes approximate a ball of radius filter_size // 2
+        for i in range(filter_size[0] // 2):
+            if i % 2 == 0:
+                x = _max_filter_cross(x, len(filter_size), pad_value)
+            else:
+                x = _max_filter_box(x, (3,) * len(filter_size), pad_value)
+        return x
+    raise ValueError(f"element has to be one of {ELEMENTS}, got {element!r}.")
+
+
+def dilate(
+    mask: torch.Tensor,
+    filter_size: int | Sequence[int] = 3,
+    pad_value: float = 0.0,
+    iterations: int = 1,
+    element: str = "box",
+    spatial_dims: int = 3,
+) -> torch.Tensor:
+    """
+    Binary dilation of a 2D/3D mask.
+
+    Args:
+        mask: binary mask of shape ``(..., *spatial)``.
+        filter_size: odd structuring element size, one value or one per spatial axis.
+        pad_value: value of the voxels outside the volume; 1.0 makes the border foreground.
+        iterations: number of successive dilations.
+        element: ``"box"`` or ``"ball"`` (alternating cross/box approximation of a ball).
+        spatial_dims: number of trailing spatial dimensions, 2 or 3.
+
+    Returns:
+        torch.Tensor: dilated mask with the dtype and shape of ``mask``.
+    """
+    filter_size = _check_filter_size(filter_size, spatial_dims)
+    x = _to_batch(mask, spatial_dims)
+    for _ in range(iterations):
+        x = _max_filter(x, filter_size, element, float(pad_value))
+    return _from_batch(x, mask)
+
+
+def erode(
+    mask: torch.Tensor,
+    filter_size: int | Sequence[int] = 3,
+    pad_value: float = 1.0,
+    iterations: int = 1,
+    element: str = "box",
+    spatial_dims: int = 3,
+) -> torch.Tensor:
+    """
+    Binary erosion of a 2D/3D mask.
+
+    Args:
+        mask: binary mask of shape ``(..., *spatial)``.
+        filter_size: odd structuring element size, one value or one per spatial axis.
+        pad_value: value of the voxels outside the volume; 1.0 keeps objects touching the border.
+        iterations: number of successive erosions.
+        element: ``"box"`` or ``"ball"`` (alternating cross/box approximation of a ball).
+        spatial_dims: number of trailing spatial dimensions, 2 or 3.
+
+    Returns:
+        torch.Tensor: eroded mask with the dtype and shape of ``mask``.
+    """
+    filter_size = _check_filter_size(filter_size, spatial_dims)
+    x = _to_batch(mask, spatial_dims)
+    for _ in range(iterations):
+        x = 1 - _max_filter(1 - x, filter_size, element, 1.0 - float(pad_value))
+    return _from_batch(x, mask)
+
+
+def closing(
+    mask: torch.Tensor,
+    filter_size: int | Sequence[int] = 3,
+    pad_value: float = 0.0,
+    iterations: int = 1,
+    element: str = "box",
+    spatial_dims: int = 3,
+) -> torch.Tensor:
+    """
+    Binary closing: ``iterations`` rounds of one dilation followed by one erosion.
+
+    Args:
+        mask: binary mask of shape ``(..., *spatial)``.
+        filter_size: odd structuring element size, one value or one per spatial axis.
+        pad_value: padding value of both the dilations and the erosions.
+        iterations: number of dilation + erosion rounds.
+        element: ``"box"`` or ``"ball"``.
+        spatial_dims: number of trailing spatial dimensions, 2 or 3.
+
+    Returns:
+        torch.Tensor: closed mask with the dtype and shape of ``mask``.
+    """
+    for _ in range(iterations):
+        mask = dilate(mask, filter_size, pad_value=pad_value, element=element, spatial_dims=spatial_dims)
+        mask = erode(mask, filter_size, pad_value=pad_value, element=element, spatial_dims=spatial_dims)
+    return mask
+
+
+def opening(
+    mask: torch.Tensor,
+    filter_size: int | Sequence[int] = 3,
+    pad_value: float = 0.0,
+    iterations: int = 1,
+    element: str = "box",
+    spatial_dims: int = 3,
+) -> torch.Tensor:
+    """
+    Binary opening: ``iterations`` rounds of one erosion followed by one dilation.
+
+    Args:
+        mask: binary mask of shape ``(..., *spatial)``.
+        filter_size: odd structuring element size, one value or one per spatial axis.
+        pad_value: padding value of both the erosions and the dilations.
+        iterations: number of erosion + dilation rounds.
+        element: ``"box"`` or ``"ball"``.
+        spatial_dims: number of trailing spatial dimensions, 2 or 3.
+
+    Returns:
+        torch.Tensor: opened mask with the dtype and shape of ``mask``.
+    """
+    for _ in range(iterations):
+        mask = erode(mask, filter_size, pad_value=pad_value, element=element, spatial_dims=spatial_dims)
+        mask = dilate(mask, filter_size, pad_value=pad_value, element=element, spatial_dims=spatial_dims)
+    return mask
+
+
+def bounding_box(mask: np.ndarray | torch.Tensor, margin: int | Sequence[int] = 0, spatial_dims: int = 3) -> tuple[slice, ...] | None:
+    """
+    Bounding box of the non-zero voxels of a mask.
+
+    Args:
+        mask: NumPy array or torch tensor; leading dimensions before the last ``spatial_dims`` are reduced.
+        margin: voxels added on both sides, one value or one per spatial axis. The box is clipped to the volume.
+        spatial_dims: number of trailing spatial dimensions.
+
+    Returns:
+        tuple[slice, ...] | None: one slice per spatial axis, or None if ``mask`` is empty.
+    """
+    margin = ensure_tuple_rep(margin, spatial_dims)
+    bbox = []
+    for axis in range(spatial_dims):
+        dim = mask.ndim - spatial_dims + axis
+        other_dims = tuple(d for d in range(mask.ndim) if d != dim)
+        if isinstance(mask, torch.Tensor):
+            line = (mask != 0).to(torch.uint8)
+            line = line.amax(dim=other_dims) if other_dims else line
+            index = torch.nonzero(line).flatten()
+        else:
+            index = np.flatnonzero(np.any(mask, axis=other_dims) if other_dims else mask)
+        if len(index) == 0:
+            return None
+        start = max(int(index[0]) - margin[axis], 0)
+        stop = min(int(index[-1]) + 1 + margin[axis], mask.shape[dim])
+        bbox.append(slice(start, stop))
+    return tuple(bbox)
+
+
+class BBoxCrop:
+    """
+    Crop of a volume to the padded bounding box of a region of interest.
+
+    Operations whose effect stays close to one small object, such as the morphology of an organ mask or
+    the deformation of a tumour restricted to its organ, can run on the crop and be pasted back into the
+    volume. The crop is the bounding box of ``roi`` enlarged by ``margin`` voxels and clipped to the volume;
+    ``margin`` has to cover how far the operation can grow the object.
+
+    Inside the volume, the voxels beyond the crop edges are replaced by the operation's own boundary
+    condition. That is exact when the operation pads with background and ``margin`` covers its reach.
+    Otherwise (e.g. morphology with ``pad_value=1.0``) the result is wrong up to ``reach`` voxels inside
+    those edges: only the remaining core of the crop is pasted back. Crop edges on the volume border keep
+    their true boundary condition and are never trimmed.
+
+    An empty ``roi`` gives a single-voxel box at the origin, so the operation still runs on a tiny input.
+
+    Args:
+        roi: mask of the region of interest, a NumPy array or a torch tensor.
+        margin: voxels added around the bounding box, one value or one per spatial axis.
+        reach: voxels trimmed from the crop edges that are inside the volume before pasting.
+        spatial_dims: number of trailing spatial dimensions of ``roi`` and of the cropped arrays.
+        name: name used in the debug log reporting the voxel work saved by the crop.
+    """
+
+    def __init__(
+        self,
+        roi: np.ndarray | torch.Tensor,
+        margin: int | Sequence[int] = 0,
+        reach: int | Sequence[int] = 0,
+        spatial_dims: int = 3,
+        name: str = "crop",
+    ) -> None:
+        self.spatial_shape = tuple(roi.shape[roi.ndim - spatial_dims :])
+        bbox = bounding_box(roi, margin, spatial_dims)
+        if bbox is None:
+            bbox = tuple(slice(0, 1) for _ in range(spatial_dims))
+        reach = ensure_tuple_rep(reach, spatial_dims)
+        self.slices = bbox
+        self.crop_shape = tuple(s.stop - s.start for s in bbox)
+        core, core_slices = [], []
+        for s, r, size in zip(bbox, reach, self.spatial_shape):
+            start = s.start + r if s.start > 0 else s.start
+            stop = max(s.stop - r if s.stop < size else s.stop, start)
+            core.append(slice(start - s.start, stop - s.start))
+            core_slices.append(slice(start, stop))
+        self.core = tuple(core)
+        self.core_slices = tuple(core_slices)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            full = int(np.prod(self.spatial_shape))
+            cropped = int(np.prod(self.crop_shape))
+            logger.debug(
+                f"{name}: cropped to {list(self.crop_shape)} of {list(self.spatial_shape)}, "
+                f"{cropped} of {full} voxels ({100.0 * (full - cropped) / max(full, 1):.1f}% of the voxel work saved)"
+            )
+
+    def crop(self, x: np.ndarray | torch.Tensor) -> np.ndarray | torch.Tensor:
+        """Crop the trailing spatial dimensions of ``x``; returns a view."""
+        return x[(..., *self.slices)]
+
+    def restrict_to_core(self, x: np.ndarray | torch.Tensor, fill_value=0) -> np.ndarray | torch.Tensor:
+        """Set the voxels of the cropped ``x`` outside the core to ``fill_value``."""
+        if all(c.start == 0 and c.stop == size for c, size in zip(self.core, self.crop_shape)):
+            return x
+        out = torch.full_like(x, fill_value) if isinstance(x, torch.Tensor) else np.full_like(x, fill_value)
+        out[(..., *self.core)] = x[(..., *self.core)]
+        return out
+
+    def paste(self, result: np.ndarray | torch.Tensor, out: np.ndarray | torch.Tensor | None = None, fill_value=0) -> np.ndarray | torch.Tensor:
+        """
+        Paste the core of a cropped result back into a full-size volume.
+
+        Args:
+            result: output of the operation on the crop.
+            out: volume to paste into; by default a new volume filled with ``fill_value``.
+            fill_value: value outside the core when ``out`` is not given.
+
+        Returns:
+            np.ndarray | torch.Tensor: the full-size volume.
+        """
+        if out is None:
+            shape = tuple(result.shape[: result.ndim - len(self.spatial_shape)]) + self.spatial_shape
+            if isinstance(result, torch.Tensor):
+                out = torch.full(shape, fill_value, dtype=result.dtype, device=result.device)
+            else:
+                out = np.full(shape, fill_value, dtype=result.dtype)
+        out[(..., *self.core_slices)] = result[(..., *self.core)]
+        return out
+
+
+def crop_apply(
+    fn: Callable,
+    roi: np.ndarray | torch.Tensor,
+    *inputs: np.ndarray | torch.Tensor,
+    margin: int | Sequence[int] = 0,
+    reach: int | Sequence[int] = 0,
+    fill_value=0,
+    out: np.ndarray | torch.Tensor | None = None,
+    spatial_dims: int = 3,
+    name: str = "crop_apply",
+) -> np.ndarray | torch.Tensor:
+    """
+    Run ``fn`` on the padded bounding box of ``roi`` and paste the result back, see ``BBoxCrop``.
+
+    The result equals ``fn(*inputs)`` on the whole volume as long as that is ``fill_value`` outside
+    the core of the crop, and ``margin`` and ``reach`` cover the reach of ``fn``.
+
+    Args:
+        fn: operation on the cropped inputs, returning an array of the crop's spatial shape.
+        roi: mask of the region of interest.
+        inputs: full-size arrays cropped before calling ``fn``.
+        margin: voxels added around the bounding box, one value or one per spatial axis.
+        reach: voxels trimmed from the crop edges that are inside the volume before pasting.
+        fill_value: value outside the crop when ``out`` is not given.
+        out: volume to paste into, e.g. the input itself when ``fn`` works in place on the crop view.
+        spatial_dims: number of trailing spatial dimensions.
+        name: name used in the debug log reporting the voxel work saved.
+
+    Returns:
+        np.ndarray | torch.Tensor: the full-size result.
+    """
+    box = BBoxCrop(roi, margin=margin, reach=reach, spatial_dims=spatial_dims, name=name)
+    return box.paste(fn(*[box.crop(x) for x in inputs]), out=out, fill_value=fill_value)
@@ -10,6 +10,25 @@
 # limitations under the License.
 
 import numpy as np
+import torch
+
+_NO_GROUP = np.iinfo(np.uint16).max
+
+# label groups of the CT quality check, keyed as in configs/image_median_statistics_ct.json
+CT_LABEL_GROUPS = {
+    "liver": [1],
+    "spleen": [3],
+    "pancreas": [4],
+    "kidney": [5, 14],
+    "lung": [28, 29, 30, 31],
+    "brain": [22],
+    "hepatic tumor": [26],
+    "bone lesion": [128],
+    "lung tumor": [23],
+    "colon cancer primaries": [27],
+    "pancreatic tumor": [24],
+    "bone": list(range(33, 57)) + list(range(63, 98)) + [120, 122, 127],
+}
 
 
 def get_masked_data(label_data, image_data, labels):
@@ -66,16 +85,166 @@ def get_masked_data(label_data, image_data, labels):
     return masked_data
 
 
-def is_outlier(statistics, image_data, label_data, label_int_dict):
+def grouped_statistics(image_data, label_data, label_groups, percentiles=()):
+    """
+    Compute the median (and optional percentiles) of the image in several label groups in one pass.
+
+    Every distinct label of ``label_groups`` gets an id through a lookup table, the selected voxels are
+    sorted once by id (a radix sort, the ids are small integers), and each group reads its contiguous
+    segments. A label may belong to several groups. NaN voxels are ignored, as in ``np.nanmedian``.
+
+    Torch tensors are processed on the device of ``image_data``, with a single copy of the statistics
+    to the host (see ``_grouped_statistics_t``).
+
+    Args:
+        image_data (np.ndarray or torch.Tensor): image data, e.g. a 3D volume.
+        label_data (np.ndarray or torch.Tensor): integer label data of the same shape, with non-negative labels.
+        label_groups (dict): group name -> list of label integers, e.g. {"liver": [1], "kidney": [5, 14]}.
+        percentiles (Sequence[float]): percentiles in [0, 100] to compute besides the median.
+
+    Returns:
+        dict: group name -> {"count": number of non-NaN voxels, "median": median or None if the group is empty,
+        "percentile_<q>": percentile or None, for each ``q`` in ``percentiles``}.
+
+    Raises:
+        ValueError: If `image_data` and `label_data` do not have the same shape.
+    """
+    if image_data.shape != label_data.shape:
+        raise ValueError(
+            f"Shape mismatch: image_data has shape {image_data.shape}, but label_data has shape {label_data.shape}. They must be the same."
+        )
+    if isinstance(image_data, torch.Tensor):
+        return _grouped_statistics_t(image_data, label_data, label_groups, percentiles)
+    label_data = np.asarray(label_data)
+    if not np.issubdtype(label_data.dtype, np.integer):
+        label_data = label_data.astype(np.int64)
+
+    all_labels = sorted({int(label) for labels in label_groups.values() for label in labels})
+    results = {}
+    if all_labels:
+        # label -> id lookup table; the last entry catches every label above the largest grouped one
+        table = np.full(all_labels[-1] + 2, _NO_GROUP, dtype=np.uint16)
+        table[all_labels] = np.arange(len(all_labels), dtype=np.uint16)
+        ids = np.take(table, label_data, mode="clip")
+        selected = ids != _NO_GROUP
+        ids, values = ids[selected], np.asarray(image_data)[selected]
+        if np.issubdtype(values.dtype, np.floating):
+            not_nan = ~np.isnan(values)
+            ids, values = ids[not_nan], values[not_nan]
+        values = values[np.argsort(ids, kind="stable")]
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(ids, minlength=len(all_labels)))])
+        segments = {label: values[bounds[i] : bounds[i + 1]] for i, label in enumerate(all_labels)}
+    else:
+        segments = {}
+
+    for name, labels in label_groups.items():
+        parts = [segments[label] for label in sorted({int(label) for label in labels})]
+        group_values = parts[0] if len(parts) == 1 else np.concatenate(parts) if parts else np.array([])
+        result = {"count": int(group_values.size), "median": np.median(group_values) if group_values.size else None}
+        for q in percentiles:
+            result[f"percentile_{q}"] = np.percentile(group_values, q) if group_values.size else None
+        results[name] = result
+    return results
+
+
+def _disjoint_label_groups(label_groups):
+    """Split the label groups into as few lists as possible in which no label belongs to two groups."""
+    passes = []
+    for name, labels in label_groups.items():
+        labels = sorted({int(label) for label in labels})
+        for groups, used in passes:
+            if used.isdisjoint(labels):
+                groups[name] = labels
+                used.update(labels)
+                break
+        else:
+            passes.append(({name: labels}, set(labels)))
+    return [groups for groups, _ in passes]
+
+
+def _grouped_statistics_t(image_data, label_data, label_groups, percentiles=()):
+    """
+    Torch version of ``grouped_statistics``, on the device of ``image_data``.
+
+    A lookup table maps every label to its group id, and the labelled non-NaN voxels are sorted by value and
+    then stably by group id, so that each group is a sorted contiguous segment. The medians (mean of the two
+    middle values, as ``np.median``) and the linearly interpolated percentiles (as ``np.percentile``) of all
+    the groups are gathered at once and copied to the host together. Groups that share labels are handled
+    in separate passes.
+
+    Args:
+        image_data (torch.Tensor): image data, e.g. a 3D volume.
+        label_data (torch.Tensor): integer label data of the same shape, with non-negative labels.
+        label_groups (dict): group name -> list of label integers.
+        percentiles (Sequence[float]): percentiles in [0, 100] to compute besides the median.
+
+    Returns:
+        dict: same as ``grouped_statistics``, with Python floats.
+    """
+    device = image_data.device
+    image_data = image_data.as_subclass(torch.Tensor)
+    label_data = label_data.as_subclass(torch.Tensor).to(device=device, dtype=torch.long)
+    results = {name: {"count": 0, "median": None, **{f"percentile_{q}": None for q in percentiles}} for name in label_groups}
+    for groups in _disjoint_label_groups(label_groups):
+        all_labels = [label for labels in groups.values() for label in labels]
+        if not all_labels:
+            continue
+        # label -> group id lookup table; the last entry catches every label above the largest grouped one
+        table = torch.full((max(all_labels) + 2,), -1, dtype=torch.long, device=device)
+        for group_id, labels in enumerate(groups.values()):
+            table[labels] = group_id
+        ids = table[label_data.clamp(0, table.numel() - 1)]
+        selected = ids >= 0
+        if image_data.is_floating_point():
+            selected &= ~torch.isnan(image_data)
+        ids, values = ids[selected], image_data[selected]
+        if values.numel() == 0:
+            continue
+        values, order = torch.sort(values)
+        ids, order = torch.sort(ids[order], stable=True)
+        values = values[order]
+
+        counts = torch.bincount(ids, minlength=len(groups))
+        starts = torch.cumsum(counts, 0) - counts
+        last = (counts - 1).clamp(min=0)
+
+        def at(offsets):
+            # empty groups read a valid index, their statistics are discarded below
+            return values[(starts + offsets).clamp(max=values.numel() - 1)]
+
+        stats = [(at(last // 2) + at((last + 1) // 2)) / 2]
+        for q in percentiles:
+            position = last.double() * (q / 100.0)
+            lower = position.floor().long()
+            t = (position - lower).to(values.dtype)
+            a, b = at(lower), at(position.ceil().long())
+            diff = b - a
+            stats.append(torch.where(t >= 0.5, b - diff * (1 - t), a + diff * t))
+        # a single device-to-host copy for all the groups of this pass
+        host = torch.cat([counts.double(), torch.stack(stats).double().flatten()]).tolist()
+        num_groups = len(groups)
+        for group_id, name in enumerate(groups):
+            count = int(host[group_id])
+            if count == 0:
+                continue
+            row = [host[num_groups * (1 + i) + group_id] for i in range(len(stats))]
+            results[name] = {"count": count, "median": row[0], **{f"percentile_{q}": v for q, v in zip(percentiles, row[1:])}}
+    return results
+
+
+def is_outlier(statistics, image_data, label_data, label_int_dict, margin=0.0):
     """
     Perform a quality check on the generated image by comparing its statistics with precomputed thresholds.
 
     Args:
         statistics (dict): Dictionary containing precomputed statistics including mean +/- 3sigma ranges.
-        image_data (np.ndarray): The image data to be checked, typically a 3D NumPy array.
-        label_data (np.ndarray): The label data corresponding to the image, used for masking regions of interest.
+        image_data (np.ndarray or torch.Tensor): The image data to be checked, typically a 3D volume.
+            Tensors are checked on their device, without copying the volume to the host.
+        label_data (np.ndarray or torch.Tensor): The label data corresponding to the image, used for masking regions of interest.
         label_int_dict (dict): Dictionary mapping label names to their corresponding integer lists.
             e.g., label_int_dict = {"liver": [1], "kidney": [5, 14]}
+        margin (float): widens the acceptable range by this amount on both sides, e.g. for
+            medians estimated from a low-resolution preview.
 
     Returns:
         dict: A dictionary with labels as keys, each containing the quality check result,
@@ -105,6 +274,8 @@ def is_outlier(statistics, image_data, label_data, label_int_dict):
         result = is_outlier(statistics, image_data, label_data, label_int_dict)
     """
     outlier_results = {}
+    # the medians of all the label groups, in a single pass over the volume
+    group_stats = grouped_statistics(image_data, label_data, {label_name: label_int_dict.get(label_name, []) for label_name in statistics})
 
     for label_name, stats in statistics.items():
         # Get the thresholds from the statistics
@@ -113,13 +284,9 @@ def is_outlier(statistics, image_data, label_data, label_int_dict):
 
         if label_name == "bone":
             high_thresh = 1000.0
+        low_thresh, high_thresh = low_thresh - margin, high_thresh + margin
 
-        # Retrieve the corresponding label integers
-        labels = label_int_dict.get(label_name, [])
-        masked_data = get_masked_data(label_data, image_data, labels)
-        masked_data = masked_data[~np.isnan(masked_data)]
-
-        if len(masked_data) == 0 or masked_data.size == 0:
+        if group_stats[label_name]["count"] == 0:
             outlier_results[label_name] = {
                 "is_outlier": False,
                 "median_value": None,
@@ -128,8 +295,8 @@ def is_outlier(statistics, image_data, label_data, label_int_dict):
             }
             continue
 
-        # Compute the median of the masked region
-        median_value = np.nanmedian(masked_data)
+        # The median of the masked region
+        median_value = group_stats[label_name]["median"]
 
         if np.isnan(median_value):
             median_value = None
@@ -35,16 +35,18 @@ from datetime import datetime
 import monai
 import torch
 from monai.data import MetaTensor
-from monai.transforms import Compose, SaveImage
+from monai.transforms import Compose
 from monai.utils import set_determinism
 
+from .async_writer import AsyncNiftiWriter
 from .augmentation import augmentation
 from .find_masks import find_masks
+from .generate_mask_pool import AugmentedMaskPool
 from .infer_image_from_mask import (  # noqa: F401  (re-exported)
     crop_img_body_mask,
     ldm_conditional_sample_one_image,
 )
-from .quality_check import is_outlier
+from .quality_check import CT_LABEL_GROUPS, is_outlier
 
 # Backward-compat re-exports — existing callers ``from scripts.sample import X``
 # keep working. ``X`` now physically lives in sample_mask / infer_image_from_mask.
@@ -57,6 +59,9 @@ from .sample_mask import (  # noqa: F401  (re-exported)
     ldm_conditional_sample_one_mask,
 )
 from .utils import get_body_region_index_from_mask
+from .utils_infer import decode_latent_preview
+
+PREVIEW_QUALITY_CHECK_MODES = ("gate", "calibrate")
 
 
 class LDMSampler:
@@ -102,12 +107,43 @@ class LDMSampler:
         autoencoder_sliding_window_infer_size=[96, 96, 96],
         autoencoder_sliding_window_infer_overlap=0.6667,
         cfg_guidance_scale=0.0,
+        augmented_mask_pool=None,
+        preview_quality_check=None,
+        preview_stride=4,
+        preview_margin=100.0,
+        output_compression_level=None,
+        num_writer_threads=2,
+        max_pending_writes=4,
+        image_output_encoding=None,
+        label_output_encoding=None,
+        verify_output_encoding=False,
+        decode_on_device=False,
     ) -> None:
         """
         Initialize the LDMSampler with various parameters and models.
 
         Args:
             Various parameters related to model configuration, input settings, and output specifications.
+            augmented_mask_pool: optional directory (or ``AugmentedMaskPool``) of augmented masks pre-generated by
+                ``scripts.generate_mask_pool``. Selected masks that have augmentations in the pool are drawn from
+                it instead of being augmented inline.
+            preview_quality_check: optional CT quality check on a cheap preview of the final latents
+                (``decode_latent_preview``), before the full sliding-window decode. ``"gate"`` regenerates pairs whose
+                preview fails, while spare candidate masks remain; ``"calibrate"`` never rejects and only compares the
+                preview verdicts with the full check. Both modes log the false-accept rate; the false-reject rate is only
+                measured in ``"calibrate"`` mode, since gated pairs are not decoded.
+            preview_stride: latent subsampling step of the preview.
+            preview_margin: HU margin added on both sides of the quality-check range for the preview.
+            output_compression_level: gzip level (0-9) of the ``.nii.gz`` outputs, nibabel's default when ``None``.
+            num_writer_threads: number of background threads writing the image/label files (``AsyncNiftiWriter``).
+            max_pending_writes: maximum number of files waiting to be written; generation blocks beyond it.
+            image_output_encoding: ``None`` (float32), ``"int16"`` (rounded HU) or ``"int16_scaled"`` (int16 with
+                ``scl_slope``/``scl_inter``) storage of the images, see ``async_writer.encode_output``.
+            label_output_encoding: ``None`` (float32) or ``"uint"`` (smallest unsigned dtype) storage of the labels.
+            verify_output_encoding: read the encoded files back and check their round-trip error.
+            decode_on_device: stitch the sliding-window decode on ``device`` instead of the host. It saves the
+                host round trip of the image, but the stitched image and the inferer's weight buffers take about
+                1.5 GB of GPU memory for 512³ outputs.
         """
         self.random_seed = random_seed
         if random_seed is not None:
@@ -161,22 +197,16 @@ class LDMSampler:
 
         # quality check args
         self.max_try_time = 2  # if not pass quality check, will try self.max_try_time times
+        if preview_quality_check is not None and preview_quality_check not in PREVIEW_QUALITY_CHECK_MODES:
+            raise ValueError(f"preview_quality_check must be None or one of {PREVIEW_QUALITY_CHECK_MODES}.\n Got {preview_quality_check}")
+        self.preview_quality_check = preview_quality_check
+        self.preview_stride = preview_stride
+        self.preview_margin = preview_margin
+        self.decode_on_device = decode_on_device
+        self.preview_counts = {"compared": 0, "full_fail": 0, "full_pass": 0, "false_accept": 0, "false_reject": 0, "rejected": 0}
         with open(real_img_median_statistics) as json_file:
             self.median_statistics = json.load(json_file)
-        self.label_int_dict = {
-            "liver": [1],
-            "spleen": [3],
-            "pancreas": [4],
-            "kidney": [5, 14],
-            "lung": [28, 29, 30, 31, 31],
-            "brain": [22],
-            "hepatic tumor": [26],
-            "bone lesion": [128],
-            "lung tumor": [23],
-            "colon cancer primaries": [27],
-            "pancreatic tumor": [24],
-            "bone": list(range(33, 57)) + list(range(63, 98)) + [120, 122, 127],
-        }
+        self.label_int_dict = {name: list(labels) for name, labels in CT_LABEL_GROUPS.items()}
 
         # networks
         self.autoencoder.eval()
@@ -207,6 +237,20 @@ class LDMSampler:
             ]
 
         self.val_transforms = Compose(val_transforms_list)
+
+        if isinstance(augmented_mask_pool, str):
+            augmented_mask_pool = AugmentedMaskPool(augmented_mask_pool, seed=random_seed)
+            logging.info(f"Augmented mask pool loaded: {len(augmented_mask_pool)} masks.")
+        self.augmented_mask_pool = augmented_mask_pool
+        # the pairs are written in the background while the next ones are generated
+        self.image_output_encoding = image_output_encoding
+        self.label_output_encoding = label_output_encoding
+        self.writer = AsyncNiftiWriter(
+            num_workers=num_writer_threads,
+            max_pending=max_pending_writes,
+            compression_level=output_compression_level,
+            verify=verify_output_encoding,
+        )
         logging.info("LDM sampler initialized.")
 
     def sample_multiple_images(self, num_img):
@@ -215,6 +259,9 @@ class LDMSampler:
 
         Args:
             num_img (int): Number of images to generate.
+
+        Returns:
+            list: ``[image_filename, label_filename]`` of the generated pairs, all written when the method returns.
         """
         modality_tensor = self.modality_tensor
         output_filenames = []
@@ -270,20 +317,46 @@ class LDMSampler:
                 # read in mask file
                 mask_file = item["mask_file"]
                 if_aug = item["if_aug"]
-                (
-                    combine_label_or,
-                    top_region_index_tensor,
-                    bottom_region_index_tensor,
-                    spacing_tensor,
-                ) = self.read_mask_information(mask_file)
-                if need_resample:
-                    combine_label_or = self.ensure_output_size_and_spacing(combine_label_or)
-                # mask augmentation
-                if if_aug:
-                    combine_label_or = augmentation(combine_label_or, self.output_size, self.random_seed)
+                pool_entry = None
+                if if_aug and self.augmented_mask_pool is not None:
+                    pool_entry = self.augmented_mask_pool.draw(
+                        os.path.relpath(mask_file["pseudo_label"], self.data_root), self.output_size, self.spacing
+                    )
+                if pool_entry is not None:
+                    # pre-augmented mask, already at the output size and spacing
+                    logging.info(f"Use augmented mask {pool_entry['file']} (seed {pool_entry['seed']}) from the pool.")
+                    (
+                        combine_label_or,
+                        top_region_index_tensor,
+                        bottom_region_index_tensor,
+                        spacing_tensor,
+                    ) = self.read_pool_mask_information(pool_entry)
+                else:
+                    (
+                        combine_label_or,
+                        top_region_index_tensor,
+                        bottom_region_index_tensor,
+                        spacing_tensor,
+                    ) = self.read_mask_information(mask_file)
+                    if need_resample:
+                        combine_label_or = self.ensure_output_size_and_spacing(combine_label_or)
+                    # mask augmentation
+                    if if_aug:
+                        combine_label_or = augmentation(combine_label_or, self.output_size, self.random_seed)
             end_time = time.time()
             logging.info(f"---- Mask preparation time: {end_time - start_time} seconds ----")
             torch.cuda.empty_cache()
+            perform_quality_check = modality_tensor <= 7 and modality_tensor >= 1
+            # a pair rejected by the preview check can only be regenerated while spare candidate masks remain
+            can_regenerate = (num_img - num_generated_img) < (len(selected_mask_files) - index_s)
+            preview_verdict = []
+            latent_gate = None
+            if self.preview_quality_check is not None and perform_quality_check:
+
+                def latent_gate(latents, recon_model, label=combine_label_or):
+                    preview_verdict.append(self.preview_quality_check_ct(latents, recon_model, label))
+                    return preview_verdict[0] or self.preview_quality_check != "gate" or not can_regenerate
+
             # start generation
             synthetic_images, synthetic_labels = self.sample_one_pair(
                 combine_label_or,
@@ -291,13 +364,20 @@ class LDMSampler:
                 bottom_region_index_tensor,
                 spacing_tensor,
                 modality_tensor,
+                latent_gate=latent_gate,
             )
-            # synthetic image quality check
+            if synthetic_images is None:
+                self.preview_counts["rejected"] += 1
+                logging.info("Generated latents did not pass the preview quality check, will re-generate another pair.")
+                continue
+            # synthetic image quality check, on the device holding the image (see decode_on_device)
             pass_quality_check = self.quality_check_ct(
-                synthetic_images.cpu().detach().numpy(),
-                combine_label_or.cpu().detach().numpy(),
-                perform_quality_check=(modality_tensor <= 7 and modality_tensor >= 1),
+                synthetic_images.detach(),
+                combine_label_or.detach(),
+                perform_quality_check=perform_quality_check,
             )
+            if preview_verdict:
+                self.log_preview_quality_check(preview_verdict[0], pass_quality_check)
             if pass_quality_check or (num_img - num_generated_img) >= (len(selected_mask_files) - index_s):
                 if not pass_quality_check:
                     logging.info(
@@ -308,28 +388,33 @@ class LDMSampler:
                 # save image/label pairs
                 output_postfix = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
                 synthetic_labels.meta["filename_or_obj"] = "sample.nii.gz"
-                synthetic_images = MetaTensor(synthetic_images, meta=synthetic_labels.meta)
-                img_saver = SaveImage(
+                # only the saved pairs are copied to the host
+                synthetic_images = MetaTensor(synthetic_images.cpu(), meta=synthetic_labels.meta)
+                self.writer.submit(
+                    synthetic_images[0],
+                    encoding=self.image_output_encoding,
                     output_dir=self.output_dir,
                     output_postfix=output_postfix + "_image",
                     output_ext=self.image_output_ext,
                     separate_folder=False,
                 )
-                img_saver(synthetic_images[0])
                 synthetic_images_filename = os.path.join(self.output_dir, "sample_" + output_postfix + "_image" + self.image_output_ext)
                 # filter out the organs that are not in anatomy_list
-                synthetic_labels = filter_mask_with_organs(synthetic_labels, self.anatomy_list)
-                label_saver = SaveImage(
+                synthetic_labels = filter_mask_with_organs(synthetic_labels, self.anatomy_list).cpu()
+                self.writer.submit(
+                    synthetic_labels[0],
+                    encoding=self.label_output_encoding,
                     output_dir=self.output_dir,
                     output_postfix=output_postfix + "_label",
                     output_ext=self.label_output_ext,
                     separate_folder=False,
                 )
-                label_saver(synthetic_labels[0])
                 synthetic_labels_filename = os.path.join(self.output_dir, "sample_" + output_postfix + "_label" + self.label_output_ext)
                 output_filenames.append([synthetic_images_filename, synthetic_labels_filename])
             else:
                 logging.info("Generated image/label pair did not pass quality check, will re-generate another pair.")
+        # stop the writer threads between calls, the next submit starts new ones
+        self.writer.close()
         return output_filenames
 
     def select_mask(self, candidate_mask_files, num_img):
@@ -358,6 +443,7 @@ class LDMSampler:
         bottom_region_index_tensor,
         spacing_tensor,
         modality_tensor,
+        latent_gate=None,
     ):
         """
         Generate a single pair of synthetic image and mask.
@@ -368,9 +454,13 @@ class LDMSampler:
             bottom_region_index_tensor (torch.Tensor): Tensor specifying the bottom region index.
             spacing_tensor (torch.Tensor): Tensor specifying the spacing.
             modality_tensor (torch.Tensor): Int Tensor specifying the modality.
+            latent_gate (callable, optional): early-rejection check on the final latents, see
+                ``run_controlnet_conditioned_image_dm``.
 
         Returns:
-            tuple: A tuple containing the synthetic image and its corresponding label.
+            tuple: A tuple containing the synthetic image, on ``self.device`` if ``decode_on_device`` is set and on the
+                host otherwise, and its corresponding label, on ``self.device``.
+                The image is None if ``latent_gate`` rejected the latents.
         """
         # generate image/label pairs
         synthetic_images, synthetic_labels = ldm_conditional_sample_one_image(
@@ -392,6 +482,8 @@ class LDMSampler:
             autoencoder_sliding_window_infer_size=self.autoencoder_sliding_window_infer_size,
             autoencoder_sliding_window_infer_overlap=self.autoencoder_sliding_window_infer_overlap,
             cfg_guidance_scale=self.cfg_guidance_scale,
+            latent_gate=latent_gate,
+            output_device=self.device if self.decode_on_device else None,
         )
         return synthetic_images, synthetic_labels
 
@@ -572,6 +664,24 @@ class LDMSampler:
             val_data["spacing"],
         )
 
+    def read_pool_mask_information(self, entry):
+        """
+        Read an augmented mask from the augmented mask pool, in the format of ``read_mask_information``.
+
+        Args:
+            entry (dict): pool index entry returned by ``AugmentedMaskPool.draw``.
+
+        Returns:
+            tuple: A tuple containing the mask tensor and associated information.
+        """
+        label = self.augmented_mask_pool.load(entry).unsqueeze(0).to(self.device)
+        spacing = (torch.FloatTensor(entry["spacing"]) * 1e2).unsqueeze(0).to(self.device)
+        top_region_index, bottom_region_index = None, None
+        if self.include_body_region:
+            top_region_index = (torch.FloatTensor(entry["top_region_index"]) * 1e2).unsqueeze(0).to(self.device)
+            bottom_region_index = (torch.FloatTensor(entry["bottom_region_index"]) * 1e2).unsqueeze(0).to(self.device)
+        return label, top_region_index, bottom_region_index, spacing
+
     def find_closest_masks(self, num_img):
         """
         Find the closest matching masks from the database.
@@ -665,12 +775,62 @@ class LDMSampler:
         mask["dim"] = self.output_size
         return mask
 
+    def preview_quality_check_ct(self, latents, recon_model, label_data):
+        """
+        Perform the CT quality check on a low-resolution preview of the final latents.
+
+        Args:
+            latents (torch.Tensor): The final latents, before decoding.
+            recon_model (torch.nn.Module): The scale-corrected decoder.
+            label_data (torch.Tensor): The corresponding whole body mask, at the output size.
+        Returns:
+            bool: True if the preview passes the quality check, widened by ``preview_margin``, False otherwise.
+        """
+        preview = decode_latent_preview(recon_model, latents, stride=self.preview_stride).float()
+        preview_label = torch.nn.functional.interpolate(
+            label_data.as_subclass(torch.Tensor).to(preview.device).float(), size=preview.shape[2:], mode="nearest"
+        )
+        outlier_results = is_outlier(self.median_statistics, preview, preview_label, self.label_int_dict, margin=self.preview_margin)
+        for label, result in outlier_results.items():
+            if result.get("is_outlier", False):
+                logging.info(
+                    f"Preview quality check for label '{label}' failed: median value {result['median_value']} is outside the acceptable range ({result['low_thresh']} - {result['high_thresh']})."
+                )
+                return False
+        return True
+
+    def log_preview_quality_check(self, pass_preview, pass_full):
+        """
+        Update and log the agreement of the preview quality check with the full-resolution one.
+
+        False rejects are only logged in ``"calibrate"`` mode: in ``"gate"`` mode a rejected pair is not decoded,
+        so the few failed previews that do get the full check (no spare mask left) are not a fair sample.
+
+        Args:
+            pass_preview (bool): Verdict of ``preview_quality_check_ct``.
+            pass_full (bool): Verdict of ``quality_check_ct`` on the decoded image.
+        """
+        counts = self.preview_counts
+        counts["compared"] += 1
+        counts["full_pass" if pass_full else "full_fail"] += 1
+        counts["false_accept"] += int(pass_preview and not pass_full)
+        counts["false_reject"] += int(pass_full and not pass_preview)
+        if self.preview_quality_check == "calibrate":
+            false_reject = f"false reject {counts['false_reject']}/{counts['full_pass']} full-check passes"
+        else:
+            false_reject = "false reject not measured in gate mode"
+        logging.info(
+            f"Preview quality check vs. full check over {counts['compared']} pairs: "
+            f"false accept {counts['false_accept']}/{counts['full_fail']} full-check failures, {false_reject}; "
+            f"{counts['rejected']} pairs rejected before decoding."
+        )
+
     def quality_check_ct(self, image_data, label_data, perform_quality_check=True):
         """
         Perform a quality check on the generated image.
         Args:
-            image_data (np.ndarray): The generated image.
-            label_data (np.ndarray): The corresponding whole body mask.
+            image_data (np.ndarray or torch.Tensor): The generated image. Tensors are checked on their device.
+            label_data (np.ndarray or torch.Tensor): The corresponding whole body mask.
         Returns:
             bool: True if the image passes the quality check, False otherwise.
         """
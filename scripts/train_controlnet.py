@@ -23,7 +23,6 @@ import torch.nn.functional as F
 from monai.networks.schedulers import RFlowScheduler
 from monai.networks.schedulers.ddpm import DDPMPredictionType
 from monai.networks.utils import copy_model_state
-from monai.transforms.utils_morphological_ops import dilate
 from monai.utils import RankFilter
 from torch.amp import GradScaler, autocast
 from torch.nn.parallel import DistributedDataParallel as DDP  # noqa: N817
@@ -31,7 +30,9 @@ from torch.utils.tensorboard import SummaryWriter
 
 from .augmentation import remove_tumors
 from .diff_model_setting import load_config
+from .morphology import dilate
 from .utils import binarize_labels, define_instance, prepare_maisi_controlnet_json_dataloader, setup_ddp
+from .utils_train import TrainingMonitor
 
 
 def remove_roi(labels):
@@ -363,12 +364,23 @@ def train_controlnet(env_config_path: str, model_config_path: str, model_def_pat
     if weighted_loss > 1.0:
         logger.info(f"apply weighted loss = {weighted_loss} on labels: {weighted_loss_label}")
 
+    monitor = TrainingMonitor(
+        enabled=args.controlnet_train.get("monitor", False),
+        device=device,
+        rank=rank,
+        jsonl_path=os.path.join(args.model_dir, f"{args.exp_name}_train_monitor.jsonl"),
+        tensorboard_writer=tensorboard_writer if rank == 0 else None,
+        logger=logger,
+    )
+
     controlnet.train()
     unet.eval()
     prev_time = time.time()
     for epoch in range(n_epochs):
         epoch_loss_ = 0
+        monitor.start_epoch(epoch)
         for step, batch in enumerate(train_loader):
+            monitor.mark("data")
             # get image embedding and label mask and scale image embedding by the provided scale_factor
             images = batch["image"].to(device) * scale_factor
             labels = batch["label"].to(device)
@@ -385,6 +397,7 @@ def train_controlnet(env_config_path: str, model_config_path: str, model_def_pat
             # We trained with only CT in this version
             if include_modality:
                 modality_tensor = batch["modality"].to(device)
+            monitor.mark("h2d")
 
             optimizer.zero_grad(set_to_none=True)
 
@@ -481,9 +494,12 @@ def train_controlnet(env_config_path: str, model_config_path: str, model_def_pat
                     loss += args.controlnet_train["region_contrasive_loss_weight"] * final_loss_region_contrasive
 
             scaler.scale(loss).backward()
+            monitor.mark("compute")
             scaler.step(optimizer)
             scaler.update()
             lr_scheduler.step()
+            monitor.mark("optimizer")
+            monitor.end_iteration(images.shape[0])
             total_step += 1
 
             if rank == 0:
@@ -500,6 +516,7 @@ def train_controlnet(env_config_path: str, model_config_path: str, model_def_pat
             epoch_loss_ += loss.detach()
 
         epoch_loss = epoch_loss_ / (step + 1)
+        monitor.end_epoch(step=total_step)
 
         if use_ddp:
             dist.barrier()
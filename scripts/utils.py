@@ -12,6 +12,7 @@
 import copy
 import json
 import math
+import numbers
 import os
 from argparse import Namespace
 from collections.abc import Sequence
@@ -26,11 +27,13 @@ from monai.bundle import ConfigParser
 from monai.config import DtypeLike, NdarrayOrTensor
 from monai.data import CacheDataset, DataLoader, partition_dataset
 from monai.transforms import Compose, EnsureTyped, Lambdad, LoadImaged, Orientationd
-from monai.transforms.utils_morphological_ops import dilate, erode
 from monai.utils import TransformBackends, convert_data_type, convert_to_dst_type, get_equivalent_dtype
-from scipy import ndimage, stats
+from scipy import ndimage
 from torch import Tensor
 
+from .morphology import bounding_box, crop_apply, dilate, erode
+from .utils_label import LabelLUT, is_integer_label, load_label_lut
+
 
 def remap_labels(mask, label_dict_remap_json):
     """
@@ -46,6 +49,12 @@ def remap_labels(mask, label_dict_remap_json):
     Returns:
         Tensor: The remapped mask tensor.
     """
+    if not torch.is_floating_point(mask):
+        # integer masks (e.g. argmax outputs): one gather through the cached lookup table
+        lut = load_label_lut(label_dict_remap_json, dtype=torch.long)
+        mask_t, *_ = convert_data_type(mask[0, ...], torch.Tensor)
+        return lut(mask_t)[None, ...].to(mask.device)
+
     with open(label_dict_remap_json) as f:
         mapping_dict = json.load(f)
     mapper = MapLabelValue(
@@ -75,6 +84,39 @@ def get_index_arr(img):
     )
 
 
+def _dominant_component_selection(label_cc, total_size):
+    """
+    Apply the "keep the two largest" rule to a connected-component labelling of a cropped label mask.
+
+    Entry 0 of ``label_cc`` stands for every voxel of the full volume outside the label (``total_size``
+    voxels minus the label's), and the two largest entries are kept, with the same ordering as
+    ``np.argsort(counts)[::-1]`` on a full-volume labelling.
+
+    Args:
+        label_cc (ndarray): connected-component labelling of the label's bounding-box crop.
+        total_size (int): number of voxels of the full volume.
+
+    Returns:
+        tuple: ``(suppress, suppress_outside)`` where ``suppress`` is a boolean lookup table over
+        component ids (None if nothing is suppressed) and ``suppress_outside`` tells whether every
+        voxel outside the label is suppressed as well.
+    """
+    counts = np.bincount(label_cc.ravel())
+    counts[0] = total_size - counts[1:].sum()
+    offset = 0
+    if counts[0] == 0:
+        counts = counts[1:]
+        offset = 1
+    dominant_vals = np.argsort(counts, kind="stable")[::-1][:2] + offset
+    if len(dominant_vals) < 2:  # Case: no predictions
+        return None, False
+
+    suppress = np.ones(len(counts) + offset, dtype=np.bool_)
+    suppress[dominant_vals] = False
+    suppress[0] = False
+    return suppress, offset == 0 and 0 not in dominant_vals
+
+
 def supress_non_largest_components(img, target_label, default_val=0):
     """
     Suppress all components except the largest one(s) for specified target labels.
@@ -82,6 +124,10 @@ def supress_non_largest_components(img, target_label, default_val=0):
     This function identifies the largest component(s) for each target label and
     suppresses all other smaller components.
 
+    For each label, the connected components are labelled only inside the label's bounding
+    box, and the two largest entries among the components and the rest of the volume (the
+    "background" of that label) are kept, as in a full-volume labelling.
+
     Args:
         img (ndarray): The input image array.
         target_label (list): List of label values to process.
@@ -92,21 +138,32 @@ def supress_non_largest_components(img, target_label, default_val=0):
             - ndarray: Modified image with non-largest components suppressed.
             - int: Number of voxels that were changed.
     """
-    index_arr = get_index_arr(img)
     img_mod = copy.deepcopy(img)
-    new_background = np.zeros(img.shape, dtype=np.bool_)
+    # a None label (e.g. no target tumor) matches no voxel
+    target_label = [label for label in target_label if label is not None]
+
+    # bounding boxes of all integer labels in one pass
+    bboxes = None
+    if np.issubdtype(img.dtype, np.integer) and img.size > 0 and img.min() >= 0:
+        bboxes = ndimage.find_objects(img, max_label=max(int(max(target_label, default=0)), 1))
+
     for label in target_label:
-        label_cc = skimage.measure.label(img == label, connectivity=3)
-        uv, uc = np.unique(label_cc, return_counts=True)
-        dominant_vals = uv[np.argsort(uc)[::-1][:2]]
-        if len(dominant_vals) >= 2:  # Case: no predictions
-            new_background = np.logical_or(
-                new_background,
-                np.logical_not(np.logical_or(label_cc == dominant_vals[0], label_cc == dominant_vals[1])),
-            )
-
-    for voxel in index_arr[new_background]:
-        img_mod[tuple(voxel)] = default_val
+        if bboxes is not None and label >= 1 and float(label).is_integer():
+            bbox = bboxes[int(label) - 1] if int(label) <= len(bboxes) else None
+        else:
+            label_mask = img == label
+            bbox = ndimage.find_objects(label_mask.astype(np.uint8))[0] if label_mask.any() else None
+        if bbox is None:  # Case: no predictions
+            continue
+
+        label_cc = skimage.measure.label(img[bbox] == label, connectivity=3)
+        suppress, suppress_outside = _dominant_component_selection(label_cc, img.size)
+        if suppress is None:
+            continue
+        img_mod[bbox][suppress[label_cc]] = default_val
+        if suppress_outside:
+            img_mod[img != label] = default_val
+
     diff = np.sum((img - img_mod) > 0)
 
     return img_mod, diff
@@ -126,19 +183,7 @@ def erode_one_img(mask_t: Tensor, filter_size: int | Sequence[int] = 3, pad_valu
     Return:
         Tensor: eroded mask, same shape as input.
     """
-    return (
-        erode(
-            mask_t.float()
-            .unsqueeze(0)
-            .unsqueeze(
-                0,
-            ),
-            filter_size,
-            pad_value=pad_value,
-        )
-        .squeeze(0)
-        .squeeze(0)
-    )
+    return erode(mask_t, filter_size, pad_value=pad_value, spatial_dims=mask_t.ndim).float()
 
 
 def dilate_one_img(mask_t: Tensor, filter_size: int | Sequence[int] = 3, pad_value: float = 0.0) -> Tensor:
@@ -155,19 +200,7 @@ def dilate_one_img(mask_t: Tensor, filter_size: int | Sequence[int] = 3, pad_val
     Return:
         Tensor: dilated mask, same shape as input.
     """
-    return (
-        dilate(
-            mask_t.float()
-            .unsqueeze(0)
-            .unsqueeze(
-                0,
-            ),
-            filter_size,
-            pad_value=pad_value,
-        )
-        .squeeze(0)
-        .squeeze(0)
-    )
+    return dilate(mask_t, filter_size, pad_value=pad_value, spatial_dims=mask_t.ndim).float()
 
 
 def binarize_labels(x: Tensor, bits: int = 8) -> Tensor:
@@ -358,12 +391,20 @@ def organ_fill_by_closing(data, target_label, device, close_times=2, filter_size
     Returns:
         ndarray: Boolean mask of the filled organ.
     """
-    mask = (data == target_label).astype(np.long)
-    mask = torch.from_numpy(mask).to(device)
-    for _ in range(close_times):
-        mask = dilate_one_img(mask, filter_size=filter_size, pad_value=pad_value)
-        mask = erode_one_img(mask, filter_size=filter_size, pad_value=pad_value)
-    return mask.cpu().numpy().astype(np.bool_)
+
+    def _close(mask):
+        mask = torch.from_numpy(mask.astype(np.long)).to(device)
+        for _ in range(close_times):
+            mask = dilate_one_img(mask, filter_size=filter_size, pad_value=pad_value)
+            mask = erode_one_img(mask, filter_size=filter_size, pad_value=pad_value)
+        return mask.cpu().numpy().astype(np.bool_)
+
+    # the closing only runs on the bounding box of the organ, padded by the reach of the dilations; a non-zero
+    # pad_value also corrupts the voxels within the reach of all the operations inside the crop edges, which are not pasted back
+    mask = data == target_label
+    growth = close_times * (filter_size // 2)
+    reach = 2 * growth if pad_value else 0
+    return crop_apply(_close, mask, mask, margin=growth + reach, reach=reach, fill_value=False, name="organ_fill_by_closing")
 
 
 def organ_fill_by_removed_mask(data, target_label, remove_mask, device):
@@ -379,11 +420,16 @@ def organ_fill_by_removed_mask(data, target_label, remove_mask, device):
     Returns:
         ndarray: Boolean mask of the filled organ in previously removed regions.
     """
-    mask = (data == target_label).astype(np.long)
-    mask = dilate_one_img(torch.from_numpy(mask).to(device), filter_size=3, pad_value=0.0)
-    mask = dilate_one_img(mask, filter_size=3, pad_value=0.0)
-    roi_oragn_mask = dilate_one_img(mask, filter_size=3, pad_value=0.0).cpu().numpy()
-    return (roi_oragn_mask * remove_mask).astype(np.bool_)
+
+    def _fill(data, remove_mask):
+        mask = (data == target_label).astype(np.long)
+        mask = dilate_one_img(torch.from_numpy(mask).to(device), filter_size=3, pad_value=0.0)
+        mask = dilate_one_img(mask, filter_size=3, pad_value=0.0)
+        roi_oragn_mask = dilate_one_img(mask, filter_size=3, pad_value=0.0).cpu().numpy()
+        return (roi_oragn_mask * remove_mask).astype(np.bool_)
+
+    # only the removed regions can be filled: crop to them, padded by the reach of the three dilations
+    return crop_apply(_fill, remove_mask, data, remove_mask, margin=3, fill_value=False, name="organ_fill_by_removed_mask")
 
 
 def get_body_region_index_from_mask(input_mask):
@@ -567,29 +613,130 @@ def add_body_envelope(
     return out.astype(orig_dtype)
 
 
-def general_mask_generation_post_process(volume_t, target_tumor_label=None, device="cuda:0"):
+def _supress_non_largest_components_t(img: Tensor, target_label, default_val=0):
     """
-    Perform post-processing on a generated mask volume.
+    Torch counterpart of ``supress_non_largest_components`` that keeps the volume on its device.
 
-    This function applies various refinement steps to improve the quality of the generated mask,
-    including body mask refinement, tumor prediction refinement, and organ-specific processing.
+    Only the bounding-box crop of each label travels to the host for connected-component labelling.
 
     Args:
-        volume_t (ndarray): Input volume containing organ and tumor labels.
-        target_tumor_label (int, optional): Label of the target tumor. Defaults to None.
-        device (str, optional): Device to perform operations on. Defaults to "cuda:0".
+        img (Tensor): the input label volume.
+        target_label (list): list of label values to process.
+        default_val (int, optional): value to assign to suppressed voxels. Defaults to 0.
 
     Returns:
-        ndarray: Post-processed volume with refined organ and tumor labels.
+        tuple: modified volume and number of changed voxels.
+    """
+    img_mod = img.clone()
+    for label in target_label:
+        if label is None:
+            continue
+        label_mask = img == label
+        bbox = bounding_box(label_mask)
+        if bbox is None:
+            continue
+        label_cc = skimage.measure.label(label_mask[bbox].cpu().numpy(), connectivity=3)
+        suppress, suppress_outside = _dominant_component_selection(label_cc, img.numel())
+        if suppress is None:
+            continue
+        img_mod[bbox][torch.from_numpy(suppress[label_cc]).to(img.device)] = default_val
+        if suppress_outside:
+            img_mod[~label_mask] = default_val
+    diff = int(torch.sum((img - img_mod) > 0))
+    return img_mod, diff
+
+
+def _dilate_t(mask: Tensor, times: int = 1) -> Tensor:
+    """Dilate a 3D mask ``times`` times with a 3x3x3 filter, on its bounding box; returns a float 0/1 tensor."""
+
+    def _dilate(mask):
+        mask = mask.float()[None, None]
+        for _ in range(times):
+            mask = dilate(mask, 3, pad_value=0.0)
+        return mask[0, 0]
+
+    return crop_apply(_dilate, mask, mask, margin=times, fill_value=0.0, name="dilate")
+
+
+def _organ_fill_by_closing_t(data: Tensor, target_labels, batch_size: int = 4, close_times: int = 2, filter_size: int = 3) -> Tensor:
     """
-    # assume volume_t is np array with shape (H,W,D)
+    Apply ``data[organ_fill_by_closing(data, label)] = label`` for each label in order, on the device.
+
+    The closings of ``batch_size`` consecutive labels are computed together from the same snapshot of
+    ``data``. A label whose mask was modified by the fills of the previous labels of its batch is
+    recomputed from the current data, so the result is identical to the sequential loop.
+
+    Each batch runs on the bounding box of its labels padded by the reach of the dilations. Fills only
+    remove voxels of the other labels, and a closing stays inside the bounding box of its mask, so the
+    masks of the batch never leave that crop.
+
+    Args:
+        data (Tensor): label volume, modified in place.
+        target_labels (list): labels to fill, in order; repetitions are allowed.
+        batch_size (int): number of label masks processed in one batched morphology call.
+        close_times (int): number of dilation + erosion rounds.
+        filter_size (int): morphology filter size.
+
+    Returns:
+        Tensor: the filled label volume.
+    """
+
+    def _close(masks: Tensor) -> Tensor:
+        masks = masks.float()[:, None]
+        for _ in range(close_times):
+            masks = dilate(masks, filter_size, pad_value=0.0)
+            masks = erode(masks, filter_size, pad_value=0.0)
+        return masks[:, 0] > 0
+
+    def _fill_chunk(data, chunk):
+        masks = torch.stack([data == label for label in chunk])
+        closed = _close(masks)
+        for i, label in enumerate(chunk):
+            closed_label = closed[i]
+            if i > 0:
+                current_mask = data == label
+                if not torch.equal(current_mask, masks[i]):
+                    closed_label = _close(current_mask[None])[0]
+            data[closed_label] = label
+        return data
+
+    target_labels = list(target_labels)
+    for start in range(0, len(target_labels), batch_size):
+        chunk = target_labels[start : start + batch_size]
+        roi = torch.isin(data, torch.tensor(chunk, device=data.device, dtype=data.dtype))
+        # the chunk is filled in place in the view of the crop
+        crop_apply(
+            lambda x: _fill_chunk(x, chunk),
+            roi,
+            data,
+            margin=close_times * (filter_size // 2),
+            out=data,
+            name="organ_fill_by_closing",
+        )
+    return data
+
+
+def _organ_fill_by_removed_mask_t(data: Tensor, target_label, remove_mask: Tensor) -> Tensor:
+    """Torch counterpart of ``organ_fill_by_removed_mask``; returns a boolean tensor on the device of ``data``."""
+
+    def _fill(data, remove_mask):
+        mask = (data == target_label).float()[None, None]
+        for _ in range(3):
+            mask = dilate(mask, 3, pad_value=0.0)
+        return (mask[0, 0] > 0) & (remove_mask != 0)
+
+    return crop_apply(_fill, remove_mask, data, remove_mask, margin=3, fill_value=False, name="organ_fill_by_removed_mask")
+
+
+def _general_mask_generation_post_process_t(volume_t: Tensor, target_tumor_label=None, morph_batch_size: int = 4) -> Tensor:
+    """Device-resident implementation of ``general_mask_generation_post_process``, see there."""
     hepatic_vessel = volume_t == 25
     airway = volume_t == 132
 
     # ------------ refine body mask pred
-    body_region_mask = erode_one_img(torch.from_numpy(volume_t > 0).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
-    body_region_mask, _ = supress_non_largest_components(body_region_mask, [1])
-    body_region_mask = dilate_one_img(torch.from_numpy(body_region_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy().astype(np.long)
+    body_region_mask = erode((volume_t > 0).float()[None, None], 3, pad_value=0.0)[0, 0]
+    body_region_mask, _ = _supress_non_largest_components_t(body_region_mask, [1])
+    body_region_mask = _dilate_t(body_region_mask).long()
     volume_t = volume_t * body_region_mask
 
     # ------------ refine tumor pred
@@ -598,12 +745,14 @@ def general_mask_generation_post_process(volume_t, target_tumor_label=None, devi
         if t != target_tumor_label:
             volume_t[volume_t == t] = tumor_organ_dict[t]
         else:
-            volume_t[organ_fill_by_closing(volume_t, target_label=t, device=device)] = t
-            volume_t[organ_fill_by_closing(volume_t, target_label=t, device=device)] = t
+            volume_t = _organ_fill_by_closing_t(volume_t, [t, t], batch_size=morph_batch_size)
     # we only keep the largest connected componet for tumors except hepatic tumor and bone lesion
     if target_tumor_label != 26 and target_tumor_label != 128:
-        volume_t, _ = supress_non_largest_components(volume_t, [target_tumor_label], default_val=200)
-    target_tumor = volume_t == target_tumor_label
+        volume_t, _ = _supress_non_largest_components_t(volume_t, [target_tumor_label], default_val=200)
+    if target_tumor_label is None:
+        target_tumor = torch.zeros_like(volume_t, dtype=torch.bool)
+    else:
+        target_tumor = volume_t == target_tumor_label
 
     # ------------ remove undesired organ pred
     # general post-process non-largest components suppression
@@ -611,78 +760,63 @@ def general_mask_generation_post_process(volume_t, target_tumor_label=None, devi
     oran_list = [1, 4, 10, 12, 3, 28, 29, 30, 31, 32, 5, 14, 13, 6, 7, 8, 9, 10]
     if target_tumor_label != 128:
         oran_list += list(range(33, 60))  # + list(range(63,87))
-    data, _ = supress_non_largest_components(volume_t, oran_list, default_val=200)  # 200 is body region
-    organ_remove_mask = (volume_t - data).astype(np.bool_)
+    data, _ = _supress_non_largest_components_t(volume_t, oran_list, default_val=200)  # 200 is body region
+    organ_remove_mask = volume_t != data
     # process intestinal system (stomach 12, duodenum 13, small bowel 19, colon 62)
-    intestinal_mask_ = (data == 12).astype(np.long) + (data == 13).astype(np.long) + (data == 19).astype(np.long) + (data == 62).astype(np.long)
-    intestinal_mask, _ = supress_non_largest_components(intestinal_mask_, [1], default_val=0)
-    # process small bowel 19
-    small_bowel_remove_mask = (data == 19).astype(np.long) - (data == 19).astype(np.long) * intestinal_mask
-    # process colon 62
-    colon_remove_mask = (data == 62).astype(np.long) - (data == 62).astype(np.long) * intestinal_mask
-    intestinal_remove_mask = (small_bowel_remove_mask + colon_remove_mask).astype(np.bool_)
+    intestinal_mask_ = (data == 12).long() + (data == 13).long() + (data == 19).long() + (data == 62).long()
+    intestinal_mask, _ = _supress_non_largest_components_t(intestinal_mask_, [1], default_val=0)
+    # process small bowel 19 and colon 62
+    small_bowel_remove_mask = (data == 19).long() - (data == 19).long() * intestinal_mask
+    colon_remove_mask = (data == 62).long() - (data == 62).long() * intestinal_mask
+    intestinal_remove_mask = (small_bowel_remove_mask + colon_remove_mask) != 0
     data[intestinal_remove_mask] = 200
 
     # ------------ full correponding organ in removed regions
-    for organ_label in oran_list:
-        data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+    data = _organ_fill_by_closing_t(data, oran_list, batch_size=morph_batch_size)
 
-    if target_tumor_label == 23 and np.sum(target_tumor) > 0:
+    if target_tumor_label == 23 and target_tumor.any():
         # speical process for cases with lung tumor
-        dia_lung_tumor_mask = dilate_one_img(torch.from_numpy(data == 23).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
-        tmp = (data * (dia_lung_tumor_mask.astype(np.long) - (data == 23).astype(np.long))).astype(np.float32).flatten()
-        tmp[tmp == 0] = float("nan")
-        mode = int(stats.mode(tmp.flatten(), nan_policy="omit")[0])
+        dia_lung_tumor_mask = _dilate_t(data == 23)
+        ring = dia_lung_tumor_mask.long() - (data == 23).long()
+        ring_values = (data * ring)[(data * ring) != 0]
+        # most frequent non-zero label around the tumor, ties broken towards the smallest label
+        mode = int(torch.argmax(torch.bincount(ring_values.long()))) if ring_values.numel() > 0 else None
         if mode in [28, 29, 30, 31, 32]:
-            dia_lung_tumor_mask = dilate_one_img(torch.from_numpy(dia_lung_tumor_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
-            lung_remove_mask = dia_lung_tumor_mask.astype(np.long) - (data == 23).astype(np.long).astype(np.long)
-            data[organ_fill_by_removed_mask(data, target_label=mode, remove_mask=lung_remove_mask, device=device)] = mode
-        dia_lung_tumor_mask = dilate_one_img(torch.from_numpy(dia_lung_tumor_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
-        data[organ_fill_by_removed_mask(data, target_label=23, remove_mask=dia_lung_tumor_mask * organ_remove_mask, device=device)] = 23
-        for organ_label in [28, 29, 30, 31, 32]:
-            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
-            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
-            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
-
-    if target_tumor_label == 26 and np.sum(target_tumor) > 0:
+            dia_lung_tumor_mask = _dilate_t(dia_lung_tumor_mask)
+            lung_remove_mask = dia_lung_tumor_mask.long() - (data == 23).long()
+            data[_organ_fill_by_removed_mask_t(data, mode, lung_remove_mask)] = mode
+        dia_lung_tumor_mask = _dilate_t(dia_lung_tumor_mask)
+        data[_organ_fill_by_removed_mask_t(data, 23, dia_lung_tumor_mask * organ_remove_mask)] = 23
+        data = _organ_fill_by_closing_t(data, [label for label in [28, 29, 30, 31, 32] for _ in range(3)], batch_size=morph_batch_size)
+
+    if target_tumor_label == 26 and target_tumor.any():
         # speical process for cases with hepatic tumor
         # process liver 1
-        data[organ_fill_by_removed_mask(data, target_label=1, remove_mask=intestinal_remove_mask, device=device)] = 1
-        data[organ_fill_by_removed_mask(data, target_label=1, remove_mask=intestinal_remove_mask, device=device)] = 1
+        data[_organ_fill_by_removed_mask_t(data, 1, intestinal_remove_mask)] = 1
+        data[_organ_fill_by_removed_mask_t(data, 1, intestinal_remove_mask)] = 1
         # process spleen 2
-        data[organ_fill_by_removed_mask(data, target_label=3, remove_mask=organ_remove_mask, device=device)] = 3
-        data[organ_fill_by_removed_mask(data, target_label=3, remove_mask=organ_remove_mask, device=device)] = 3
-        dia_tumor_mask = dilate_one_img(torch.from_numpy(data == target_tumor_label).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
-        dia_tumor_mask = dilate_one_img(torch.from_numpy(dia_tumor_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
-        data[organ_fill_by_removed_mask(data, target_label=target_tumor_label, remove_mask=dia_tumor_mask * organ_remove_mask, device=device)] = (
-            target_tumor_label
-        )
+        data[_organ_fill_by_removed_mask_t(data, 3, organ_remove_mask)] = 3
+        data[_organ_fill_by_removed_mask_t(data, 3, organ_remove_mask)] = 3
+        dia_tumor_mask = _dilate_t(data == target_tumor_label, times=2)
+        data[_organ_fill_by_removed_mask_t(data, target_tumor_label, dia_tumor_mask * organ_remove_mask)] = target_tumor_label
         # refine hepatic tumor
-        hepatic_tumor_vessel_liver_mask_ = (data == 26).astype(np.long) + (data == 25).astype(np.long) + (data == 1).astype(np.long)
-        hepatic_tumor_vessel_liver_mask_ = (hepatic_tumor_vessel_liver_mask_ > 1).astype(np.long)
-        hepatic_tumor_vessel_liver_mask, _ = supress_non_largest_components(hepatic_tumor_vessel_liver_mask_, [1], default_val=0)
-        removed_region = (hepatic_tumor_vessel_liver_mask_ - hepatic_tumor_vessel_liver_mask).astype(np.bool_)
+        hepatic_tumor_vessel_liver_mask_ = (data == 26).long() + (data == 25).long() + (data == 1).long()
+        hepatic_tumor_vessel_liver_mask_ = (hepatic_tumor_vessel_liver_mask_ > 1).long()
+        hepatic_tumor_vessel_liver_mask, _ = _supress_non_largest_components_t(hepatic_tumor_vessel_liver_mask_, [1], default_val=0)
+        removed_region = (hepatic_tumor_vessel_liver_mask_ - hepatic_tumor_vessel_liver_mask) != 0
         data[removed_region] = 200
-        target_tumor = (target_tumor * hepatic_tumor_vessel_liver_mask).astype(np.bool_)
+        target_tumor = target_tumor & (hepatic_tumor_vessel_liver_mask != 0)
         # refine liver
-        data[organ_fill_by_closing(data, target_label=1, device=device)] = 1
-        data[organ_fill_by_closing(data, target_label=1, device=device)] = 1
-        data[organ_fill_by_closing(data, target_label=1, device=device)] = 1
+        data = _organ_fill_by_closing_t(data, [1, 1, 1], batch_size=morph_batch_size)
 
-    if target_tumor_label == 27 and np.sum(target_tumor) > 0:
+    if target_tumor_label == 27 and target_tumor.any():
         # speical process for cases with colon tumor
-        dia_tumor_mask = dilate_one_img(torch.from_numpy(data == target_tumor_label).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
-        dia_tumor_mask = dilate_one_img(torch.from_numpy(dia_tumor_mask).to(device), filter_size=3, pad_value=0.0).cpu().numpy()
-        data[organ_fill_by_removed_mask(data, target_label=target_tumor_label, remove_mask=dia_tumor_mask * organ_remove_mask, device=device)] = (
-            target_tumor_label
-        )
+        dia_tumor_mask = _dilate_t(data == target_tumor_label, times=2)
+        data[_organ_fill_by_removed_mask_t(data, target_tumor_label, dia_tumor_mask * organ_remove_mask)] = target_tumor_label
 
-    if target_tumor_label == 129 and np.sum(target_tumor) > 0:
+    if target_tumor_label == 129 and target_tumor.any():
         # speical process for cases with kidney tumor
-        for organ_label in [5, 14]:
-            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
-            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
-            data[organ_fill_by_closing(data, target_label=organ_label, device=device)] = organ_label
+        data = _organ_fill_by_closing_t(data, [5, 5, 5, 14, 14, 14], batch_size=morph_batch_size)
     # TODO: current model does not support hepatic vessel by size control.
     # we treat it as liver for better visiaulization
     print(
@@ -697,6 +831,34 @@ def general_mask_generation_post_process(volume_t, target_tumor_label=None, devi
     return data
 
 
+def general_mask_generation_post_process(volume_t, target_tumor_label=None, device="cuda:0", morph_batch_size=4):
+    """
+    Perform post-processing on a generated mask volume.
+
+    This function applies various refinement steps to improve the quality of the generated mask,
+    including body mask refinement, tumor prediction refinement, and organ-specific processing.
+
+    The volume is copied to ``device`` once and every step runs there; only the bounding-box crops
+    used for connected-component labelling go back to the host. The result is identical to the
+    step-by-step NumPy implementation.
+
+    Args:
+        volume_t (ndarray): Input volume containing organ and tumor labels.
+        target_tumor_label (int, optional): Label of the target tumor. Defaults to None.
+        device (str, optional): Device to perform operations on. Defaults to "cuda:0".
+        morph_batch_size (int, optional): Number of organ masks closed together in one batched
+            morphology call. Defaults to 4.
+
+    Returns:
+        ndarray: Post-processed volume with refined organ and tumor labels.
+    """
+    # assume volume_t is np array with shape (H,W,D); labels are combined with int64 masks as in the NumPy pipeline
+    volume = torch.from_numpy(np.asarray(volume_t).astype(np.result_type(volume_t.dtype, np.int64), copy=False)).to(device)
+    with torch.no_grad():
+        data = _general_mask_generation_post_process_t(volume, target_tumor_label=target_tumor_label, morph_batch_size=morph_batch_size)
+    return data.cpu().numpy()
+
+
 class MapLabelValue:
     """
     Utility to map label values to another set of values.
@@ -731,6 +893,12 @@ class MapLabelValue:
             self.use_numpy = True
             self.dtype = get_equivalent_dtype(dtype, data_type=np.ndarray)
 
+        # integer labels mapped to numbers are remapped with a single lookup-table gather
+        self.lut = None
+        numeric_dtype = not self.use_numpy or np.dtype(self.dtype).kind in "biuf"
+        if numeric_dtype and all(is_integer_label(o) and isinstance(t, numbers.Number) for o, t in self.pair):
+            self.lut = LabelLUT(dict(self.pair), dtype=self.dtype)
+
     def __call__(self, img: NdarrayOrTensor):
         """
         Apply the label mapping to the input image.
@@ -743,6 +911,9 @@ class MapLabelValue:
         """
         if self.use_numpy:
             img_np, *_ = convert_data_type(img, np.ndarray)
+            if self.lut is not None and (np.issubdtype(img_np.dtype, np.integer) or img_np.dtype == np.bool_):
+                out, *_ = convert_to_dst_type(src=self.lut(img_np), dst=img, dtype=self.dtype)
+                return out
             _out_shape = img_np.shape
             img_flat = img_np.flatten()
             try:
@@ -755,6 +926,9 @@ class MapLabelValue:
             out_t = out_flat.reshape(_out_shape)
         else:
             img_t, *_ = convert_data_type(img, torch.Tensor)
+            if self.lut is not None and not (img_t.is_floating_point() or img_t.is_complex()):
+                out, *_ = convert_to_dst_type(src=self.lut(img_t.detach()), dst=img, dtype=self.dtype)
+                return out
             out_t = img_t.detach().clone().to(self.dtype)  # type: ignore
             for o, t in self.pair:
                 out_t[img_t == o] = t
@@ -24,6 +24,7 @@ What lives here:
 
 - ``ReconModel``                          — wraps an autoencoder for scale-corrected decode
 - ``initialize_noise_latents``            — fp16 random-noise latent generator
+- ``decode_latent_preview``               — cheap low-resolution decode of strided latents
 - ``run_controlnet_conditioned_image_dm`` — modality-agnostic core: timestep loop +
                                             ControlNet + image DM + sliding-window AE decode +
                                             HU range mapping. Caller pre-prepares the
@@ -107,6 +108,27 @@ def initialize_noise_latents(latent_shape, device):
     )
 
 
+def decode_latent_preview(recon_model, latents, stride=4, a_min=-1000, a_max=1000):
+    """
+    Decode a low-resolution preview of the latents, without the sliding-window inferer.
+
+    Every ``stride``-th latent voxel along each spatial axis is decoded in a single forward
+    pass, so the preview has ``1 / stride`` of the final image size per axis and costs roughly
+    ``1 / stride**3`` of the full decode. It is only meant for coarse intensity statistics.
+
+    Args:
+        recon_model (ReconModel): scale-corrected decoder.
+        latents (torch.Tensor): final latents of shape ``(B, C, H_lat, W_lat, D_lat)``.
+        stride (int): latent subsampling step.
+        a_min, a_max (float): intensity range the autoencoder output ``[0, 1]`` is mapped to.
+
+    Returns:
+        torch.Tensor: preview image on the device of ``latents``, in the ``[a_min, a_max]`` range.
+    """
+    preview = recon_model(latents[..., ::stride, ::stride, ::stride])
+    return torch.clip(preview, 0.0, 1.0) * (a_max - a_min) + a_min
+
+
 def run_controlnet_conditioned_image_dm(
     autoencoder,
     diffusion_unet,
@@ -127,6 +149,8 @@ def run_controlnet_conditioned_image_dm(
     autoencoder_sliding_window_infer_overlap=0.6667,
     cfg_guidance_scale=0.0,
     controlnet_uncond_tensor=None,
+    latent_gate=None,
+    output_device=None,
 ):
     """
     Run the ControlNet-conditioned image-DM denoising loop + AE decode.
@@ -167,11 +191,21 @@ def run_controlnet_conditioned_image_dm(
             counterpart of ``controlnet_cond_tensor`` — same shape. Caller
             decides what "unconditional" means for the conditioning modality
             (mask conditioning: tumor-free mask; image conditioning: TBD).
+        latent_gate (callable|None): optional early-rejection check,
+            ``latent_gate(latents, recon_model) -> bool``, called on the final
+            latents before the sliding-window decode (e.g. a preview quality
+            check via ``decode_latent_preview``). When it returns ``False`` the
+            decode is skipped and ``None`` is returned.
+        output_device (torch.device|None): device the sliding-window output is
+            stitched, clipped and returned on. ``None`` (default) uses the CPU;
+            passing ``device`` keeps the image there for on-device checks at
+            the cost of holding the full-size output in device memory.
 
     Returns:
-        Tensor: synthetic image in HU/MR intensity range. Shape ``(B, 1,
-        H_out, W_out, D_out)`` on CPU. **No background-mask cleanup is
-        applied here** — that's modality-specific and lives in the wrapper.
+        Tensor|None: synthetic image in HU/MR intensity range. Shape ``(B, 1,
+        H_out, W_out, D_out)`` on ``output_device``, or ``None`` if ``latent_gate`` rejected
+        the latents. **No background-mask cleanup is applied here** — that's
+        modality-specific and lives in the wrapper.
     """
     if cfg_guidance_scale > 0 and controlnet_uncond_tensor is None:
         raise ValueError(
@@ -290,6 +324,10 @@ def run_controlnet_conditioned_image_dm(
         gc.collect()
         torch.cuda.empty_cache()
 
+        if latent_gate is not None and not latent_gate(latents, recon_model):
+            logging.info("---- Latents rejected before decoding ----")
+            return None
+
         # Sliding-window AE decode
         logging.info("---- Start decoding latent features into images... ----")
         start_time = time.time()
@@ -300,16 +338,16 @@ def run_controlnet_conditioned_image_dm(
             mode="gaussian",
             overlap=autoencoder_sliding_window_infer_overlap,
             sw_device=device,
-            device=torch.device("cpu"),
+            device=torch.device("cpu") if output_device is None else output_device,
         )
         synthetic_images = dynamic_infer(inferer, recon_model, latents)
         # modality_tensor can be scalar (single mask) or shape (B,) (batch infer).
         # Use the first element so a >1-batch boolean tensor doesn't blow up in `if`.
         # All batch items share the same modality in our call sites.
         if modality_tensor is not None and int(modality_tensor.flatten()[0]) <= 7:
-            synthetic_images = torch.clip(synthetic_images, b_min, b_max).cpu()
+            synthetic_images = torch.clip(synthetic_images, b_min, b_max)
         else:
-            synthetic_images = torch.clip(synthetic_images, b_min, None).cpu()
+            synthetic_images = torch.clip(synthetic_images, b_min, None)
         end_time = time.time()
         logging.info(f"---- Image VAE decoding time: {end_time - start_time} seconds ----")
 
@@ -0,0 +1,168 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lookup-table label remapping shared by:
+
+- ``scripts/utils.py``         — ``MapLabelValue`` and ``remap_labels`` (132-class remap)
+- ``scripts/augmentation.py``  — ``remap_labels`` on tumour/organ labels
+
+What lives here:
+
+- ``LabelLUT``            — integer label -> value lookup table; one gather per volume on
+                            NumPy arrays or torch tensors (CPU or GPU).
+- ``load_label_lut``      — compiled ``LabelLUT`` for a ``{name: [orig, target]}`` mapping
+                            JSON, cached per file path and modification time.
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import numbers
+import os
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+
+_TORCH_SMALL_INT_DTYPES = (torch.bool, torch.uint8, torch.int8, torch.int16)
+
+
+def is_integer_label(value) -> bool:
+    """Return whether ``value`` is an integer, or a float with an integral value, usable as a LUT index."""
+    if isinstance(value, bool | np.bool_):
+        return False
+    if isinstance(value, numbers.Integral):
+        return True
+    return isinstance(value, numbers.Real) and float(value).is_integer()
+
+
+class LabelLUT:
+    """
+    Remap integer labels with a lookup table, i.e. a single gather per volume.
+
+    Values absent from ``mapping`` are kept (cast to ``dtype``), exactly like a sequence of
+    ``out[x == orig] = target`` assignments computed on the input. The table initially covers
+    ``[min(0, min(orig)), max(orig)]`` and grows with identity entries whenever an input holds
+    labels outside that range. A torch copy of the table is cached per device.
+
+    Args:
+        mapping: original label -> target value. Keys must be integers.
+        dtype: output dtype, a NumPy or torch dtype; defaults to the input dtype.
+    """
+
+    def __init__(self, mapping: Mapping, dtype: np.dtype | torch.dtype | None = None) -> None:
+        for orig in mapping:
+            if not is_integer_label(orig):
+                raise ValueError(f"LabelLUT only supports integer labels, got {orig!r}.")
+        self.mapping = {int(orig): target for orig, target in mapping.items()}
+        self.dtype = dtype
+        self._np_tables: dict[np.dtype, tuple[int, np.ndarray]] = {}
+        self._torch_tables: dict[tuple[torch.dtype, torch.device], tuple[int, int, torch.Tensor]] = {}
+
+    def _build_table(self, low: int, high: int, dtype: np.dtype) -> np.ndarray:
+        table = np.arange(low, high + 1).astype(dtype)
+        for orig, target in self.mapping.items():
+            table[orig - low] = target
+        return table
+
+    def _numpy_table(self, low: int, high: int, dtype: np.dtype) -> tuple[int, np.ndarray]:
+        table_low, table = self._np_tables.get(dtype, (0, np.empty(0, dtype=dtype)))
+        table_high = table_low + len(table) - 1
+        if len(table) == 0 or low < table_low or high > table_high:
+            keys = list(self.mapping) or [0]
+            low = min(low, table_low, 0, *keys)
+            high = max(high, table_high, *keys)
+            table_low, table = low, self._build_table(low, high, dtype)
+            self._np_tables[dtype] = (table_low, table)
+        return table_low, table
+
+    def _apply_numpy(self, x: np.ndarray) -> np.ndarray:
+        dtype = np.dtype(self.dtype) if self.dtype is not None else x.dtype
+        if x.size == 0:
+            return x.astype(dtype)
+        if x.dtype == np.bool_:
+            x = x.view(np.uint8)
+        table_low, table = self._numpy_table(int(x.min()), int(x.max()), dtype)
+        if table_low < 0:
+            return table[x.astype(np.int64) - table_low]
+        return table[x]
+
+    def _apply_torch(self, x: torch.Tensor) -> torch.Tensor:
+        if self.dtype is None:
+            out_dtype = x.dtype
+        elif isinstance(self.dtype, torch.dtype):
+            out_dtype = self.dtype
+        else:
+            out_dtype = torch.from_numpy(np.empty(0, dtype=self.dtype)).dtype
+        if x.numel() == 0:
+            return x.to(out_dtype)
+        x_min, x_max = torch.aminmax(x.to(torch.int32) if x.dtype == torch.bool else x)
+        np_dtype = torch.empty(0, dtype=out_dtype).numpy().dtype
+        table_low, table = self._numpy_table(int(x_min.item()), int(x_max.item()), np_dtype)
+
+        key = (out_dtype, x.device)
+        cached = self._torch_tables.get(key)
+        if cached is None or cached[0] != table_low or cached[1] != len(table):
+            cached = (table_low, len(table), torch.from_numpy(table).to(x.device))
+            self._torch_tables[key] = cached
+        table_t = cached[2]
+
+        index = x.reshape(-1)
+        if index.dtype in _TORCH_SMALL_INT_DTYPES:
+            index = index.to(torch.int32)
+        if table_low != 0:
+            index = index.to(torch.int64) - table_low
+        return table_t.index_select(0, index).reshape(x.shape)
+
+    def __call__(self, x: np.ndarray | torch.Tensor) -> np.ndarray | torch.Tensor:
+        """
+        Remap the labels of ``x``.
+
+        Args:
+            x (np.ndarray | torch.Tensor): integer (or boolean) label volume of any shape.
+
+        Returns:
+            np.ndarray | torch.Tensor: remapped volume of the same type, shape and device.
+        """
+        if isinstance(x, torch.Tensor):
+            if x.is_floating_point() or x.is_complex():
+                raise TypeError(f"LabelLUT expects an integer tensor, got {x.dtype}.")
+            return self._apply_torch(x)
+        x = np.asarray(x)
+        if not (np.issubdtype(x.dtype, np.integer) or x.dtype == np.bool_):
+            raise TypeError(f"LabelLUT expects an integer array, got {x.dtype}.")
+        return self._apply_numpy(x)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_label_lut_cached(path: str, mtime: float, dtype: np.dtype | torch.dtype | None) -> LabelLUT:
+    with open(path) as f:
+        mapping_dict = json.load(f)
+    return LabelLUT({pair[0]: pair[1] for pair in mapping_dict.values()}, dtype=dtype)
+
+
+def load_label_lut(label_dict_remap_json: str, dtype: np.dtype | torch.dtype | None = None) -> LabelLUT:
+    """
+    Load the ``LabelLUT`` of a ``{name: [orig, target]}`` label mapping JSON.
+
+    The compiled table is cached, and reloaded only if the file is modified.
+
+    Args:
+        label_dict_remap_json (str): path to the JSON file containing the label mapping dictionary.
+        dtype (np.dtype | torch.dtype | None): output dtype of the remapped volumes.
+
+    Returns:
+        LabelLUT: lookup table of the mapping.
+    """
+    path = os.path.abspath(label_dict_remap_json)
+    return _load_label_lut_cached(path, os.path.getmtime(path), dtype)
@@ -0,0 +1,430 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared training helpers reused across:
+
+- ``scripts/diff_model_train.py``  — diffusion UNet training
+- ``scripts/train_controlnet.py``  — ControlNet training
+
+What lives here:
+
+- ``ShapeBucketBatchSampler`` — groups samples of identical spatial shape into
+                                full batches, deterministic under DDP.
+- ``TrainingMonitor``         — per-phase iteration timing (data wait, host-to-device,
+                                compute, optimizer), throughput and peak memory.
+- ``AsyncCheckpointWriter``   — background checkpoint writes from a host-memory snapshot
+                                with atomic renames and a last-K-plus-best retention.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import shutil
+import time
+from collections import deque
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class ShapeBucketBatchSampler(Sampler[list[int]]):
+    """
+    Batch sampler that only batches samples sharing the same spatial shape.
+
+    MAISI latents are resized to multiples of 128 before encoding, so a dataset
+    only contains a handful of distinct latent shapes. Samples are grouped into
+    one bucket per shape, each bucket is shuffled and cut into batches of
+    ``batch_size``, and the resulting batches are shuffled across buckets once
+    per epoch. No padding is needed because every batch is shape-homogeneous.
+
+    Under DDP the sampler also partitions the samples across ranks, so each rank
+    only loads and caches its own share (like ``partition_dataset`` does for the
+    un-bucketed loader). It is given the shapes of the *full* dataset: every
+    bucket is shuffled once with ``seed`` and dealt round-robin to the ranks, and
+    ``indices`` lists the dataset indices of this rank, in dataset order. The
+    batches index into that subset, i.e. the data loader's dataset must be
+    ``[data[i] for i in sampler.indices]``. Each epoch the rank reshuffles its
+    own samples from ``seed + epoch``; the batch list is padded by repeating
+    leading batches so that all ranks run the same number of iterations.
+
+    Args:
+        shapes: spatial shape of every sample in the full dataset, in dataset order.
+        batch_size: maximum number of samples per batch.
+        shuffle: whether to shuffle samples within buckets and batches across buckets.
+        drop_last: drop the trailing incomplete batch of every bucket.
+        num_replicas: number of DDP ranks sharing the dataset.
+        rank: rank of the current process.
+        seed: base random seed, combined with the epoch set via ``set_epoch``.
+    """
+
+    def __init__(
+        self,
+        shapes: Sequence[Sequence[int]],
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+    ) -> None:
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be a positive integer, got {batch_size}.")
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"rank must be in [0, {num_replicas}), got {rank}.")
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        shapes = [tuple(int(s) for s in shape) for shape in shapes]
+        rank_indices = self._partition(shapes)
+        self.indices = rank_indices[rank]
+        self.shapes = [shapes[i] for i in self.indices]
+        self._num_batches = max(self._count_batches([shapes[i] for i in indices]) for indices in rank_indices)
+        if self._num_batches and self._count_batches(self.shapes) == 0:
+            raise ValueError(f"rank {rank} gets no batch out of {len(shapes)} samples, use fewer ranks or a smaller batch_size.")
+
+    def _partition(self, shapes: list[tuple[int, ...]]) -> list[list[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed)
+        rank_indices: list[list[int]] = [[] for _ in range(self.num_replicas)]
+        buckets = self._buckets(shapes)
+        # iterate buckets in a fixed order so that every rank draws the same random numbers
+        for shape in sorted(buckets):
+            indices = buckets[shape]
+            if self.shuffle:
+                indices = [indices[i] for i in torch.randperm(len(indices), generator=generator).tolist()]
+            for rank in range(self.num_replicas):
+                rank_indices[rank] += indices[rank :: self.num_replicas]
+        return [sorted(indices) for indices in rank_indices]
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Set the epoch used to seed the shuffling, so each epoch gets a different order.
+
+        Args:
+            epoch (int): current epoch number.
+        """
+        self.epoch = epoch
+
+    @staticmethod
+    def _buckets(shapes: list[tuple[int, ...]]) -> dict[tuple[int, ...], list[int]]:
+        buckets: dict[tuple[int, ...], list[int]] = {}
+        for index, shape in enumerate(shapes):
+            buckets.setdefault(shape, []).append(index)
+        return buckets
+
+    def _count_batches(self, shapes: list[tuple[int, ...]]) -> int:
+        round_fn = math.floor if self.drop_last else math.ceil
+        return sum(round_fn(len(indices) / self.batch_size) for indices in self._buckets(shapes).values())
+
+    def _local_batches(self) -> list[list[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        batches = []
+        buckets = self._buckets(self.shapes)
+        for shape in sorted(buckets):
+            indices = buckets[shape]
+            if self.shuffle:
+                indices = [indices[i] for i in torch.randperm(len(indices), generator=generator).tolist()]
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start : start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        batches = self._local_batches()
+        if len(batches) == 0:
+            return iter([])
+        # pad with leading batches so that every rank gets the same number of iterations
+        return iter((batches * math.ceil(len(self) / len(batches)))[: len(self)])
+
+    def __len__(self) -> int:
+        return self._num_batches
+
+
+class TrainingMonitor:
+    """
+    Lightweight per-iteration instrumentation of a training loop.
+
+    The loop calls ``mark(phase)`` at the end of each phase; the time since the previous mark
+    is attributed to that phase. Typical phases are ``"data"`` (waiting on the data loader),
+    ``"h2d"`` (host-to-device copies), ``"compute"`` (forward and backward) and ``"optimizer"``.
+    ``end_iteration(num_samples)`` closes an iteration and ``end_epoch()`` gathers the
+    per-rank totals, logs a cross-rank summary and writes it to the optional sinks.
+
+    When ``enabled`` is False every method returns immediately, so the monitor can stay in
+    the loop at no cost. When enabled, CUDA is synchronized at every mark so that
+    asynchronous kernels are attributed to the phase that launched them.
+
+    Args:
+        enabled: whether to record anything.
+        device: training device, used for synchronization, peak memory and collectives.
+        rank: rank of the current process; only rank 0 writes to the sinks.
+        jsonl_path: optional JSONL file receiving one record per rank and epoch.
+        tensorboard_writer: optional ``SummaryWriter`` receiving the cross-rank averages.
+        logger: optional logger for the epoch summary.
+    """
+
+    PHASES = ("data", "h2d", "compute", "optimizer")
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        device: torch.device | None = None,
+        rank: int = 0,
+        jsonl_path: str | None = None,
+        tensorboard_writer=None,
+        logger: logging.Logger | None = None,
+    ) -> None:
+        self.enabled = enabled
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+        self.rank = rank
+        self.jsonl_path = jsonl_path
+        self.tensorboard_writer = tensorboard_writer
+        self.logger = logger or logging.getLogger("maisi.train.monitor")
+        self._sync = enabled and self.device.type == "cuda"
+        self._epoch = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        self._phase_time = dict.fromkeys(self.PHASES, 0.0)
+        self._max_iteration_time = 0.0
+        self._num_iterations = 0
+        self._num_samples = 0
+        self._epoch_start = time.perf_counter()
+        self._iteration_start = self._epoch_start
+        self._last_mark = self._epoch_start
+
+    def _now(self) -> float:
+        if self._sync:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def start_epoch(self, epoch: int) -> None:
+        """
+        Reset the counters at the start of an epoch.
+
+        Args:
+            epoch (int): epoch number, used to tag the records.
+        """
+        if not self.enabled:
+            return
+        self._epoch = epoch
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self._reset()
+        self._epoch_start = self._iteration_start = self._last_mark = self._now()
+
+    def mark(self, phase: str) -> None:
+        """
+        Attribute the time elapsed since the previous mark to ``phase``.
+
+        Args:
+            phase (str): one of ``TrainingMonitor.PHASES``.
+        """
+        if not self.enabled:
+            return
+        now = self._now()
+        self._phase_time[phase] += now - self._last_mark
+        self._last_mark = now
+
+    def end_iteration(self, num_samples: int) -> None:
+        """
+        Close the current iteration.
+
+        Args:
+            num_samples (int): number of samples processed in the iteration.
+        """
+        if not self.enabled:
+            return
+        now = self._now()
+        self._max_iteration_time = max(self._max_iteration_time, now - self._iteration_start)
+        self._iteration_start = self._last_mark = now
+        self._num_iterations += 1
+        self._num_samples += num_samples
+
+    def end_epoch(self, step: int | None = None) -> dict | None:
+        """
+        Gather the epoch statistics of all ranks, log them and write them to the sinks.
+
+        Must be called by every rank when the monitor is enabled, since it runs a collective.
+
+        Args:
+            step (int | None): global step used for TensorBoard; defaults to the epoch number.
+
+        Returns:
+            dict | None: cross-rank averages of the epoch statistics, or None when disabled.
+        """
+        if not self.enabled:
+            return None
+        elapsed = self._now() - self._epoch_start
+        peak_memory = torch.cuda.max_memory_allocated(self.device) if self.device.type == "cuda" else 0
+        local = torch.tensor(
+            [self._phase_time[phase] for phase in self.PHASES]
+            + [elapsed, self._max_iteration_time, self._num_iterations, self._num_samples, peak_memory],
+            dtype=torch.float64,
+            device=self.device,
+        )
+        if dist.is_initialized():
+            gathered = [torch.zeros_like(local) for _ in range(dist.get_world_size())]
+            dist.all_gather(gathered, local)
+        else:
+            gathered = [local]
+
+        records = []
+        for rank, stats in enumerate(gathered):
+            stats = stats.tolist()
+            phase_time = dict(zip(self.PHASES, stats[: len(self.PHASES)]))
+            elapsed, max_iteration_time, num_iterations, num_samples, peak_memory = stats[len(self.PHASES) :]
+            record = {"epoch": self._epoch, "rank": rank, "iterations": int(num_iterations), "samples": int(num_samples)}
+            record.update({f"{phase}_time": value for phase, value in phase_time.items()})
+            record["data_wait_fraction"] = phase_time["data"] / elapsed if elapsed > 0 else 0.0
+            record["mean_iteration_time"] = elapsed / num_iterations if num_iterations > 0 else 0.0
+            record["max_iteration_time"] = max_iteration_time
+            record["samples_per_second"] = num_samples / elapsed if elapsed > 0 else 0.0
+            record["peak_memory_gb"] = peak_memory / 1024**3
+            records.append(record)
+
+        numeric_keys = [k for k in records[0] if k not in ("epoch", "rank")]
+        summary = {k: sum(r[k] for r in records) / len(records) for k in numeric_keys}
+        summary["samples_per_second"] = sum(r["samples_per_second"] for r in records)
+        summary["peak_memory_gb"] = max(r["peak_memory_gb"] for r in records)
+        slowest = max(records, key=lambda r: r["mean_iteration_time"])
+
+        if self.rank == 0:
+            self.logger.info(
+                f"[monitor] epoch {self._epoch + 1}: {summary['samples_per_second']:.2f} samples/s, "
+                f"iter {summary['mean_iteration_time']:.3f}s (data {summary['data_time']:.1f}s, h2d {summary['h2d_time']:.1f}s, "
+                f"compute {summary['compute_time']:.1f}s, optimizer {summary['optimizer_time']:.1f}s per rank), "
+                f"data wait {100 * summary['data_wait_fraction']:.1f}%, peak memory {summary['peak_memory_gb']:.2f} GB, "
+                f"slowest rank {slowest['rank']}."
+            )
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, "a") as f:
+                    for record in records:
+                        f.write(json.dumps(record) + "\n")
+            if self.tensorboard_writer is not None:
+                step = self._epoch if step is None else step
+                for key, value in summary.items():
+                    self.tensorboard_writer.add_scalar(f"monitor/{key}", value, step)
+        return summary
+
+
+def _snapshot_to_cpu(obj: Any) -> Any:
+    """Recursively copy every tensor of a (nested) checkpoint dictionary to host memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, list | tuple):
+        return type(obj)(_snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointWriter:
+    """
+    Write checkpoints from a background thread so that training does not wait on storage.
+
+    ``save`` snapshots the state to host memory on the calling thread (the only blocking
+    part), then hands it to a single writer thread. Every file is first written to a
+    temporary name and moved into place with ``os.replace``, so a reader never sees a
+    partially written checkpoint. At most ``max_in_flight`` snapshots are kept in memory;
+    ``save`` blocks on the oldest pending write when the limit is reached.
+
+    Besides the "latest" checkpoint, each save can keep an epoch-stamped copy
+    (``<stem>_epoch<N><ext>``), of which only the last ``keep_last`` are retained, and a
+    ``<stem>_best<ext>`` copy. The snapshot is serialised once; the copies are file copies
+    of the latest checkpoint.
+
+    Args:
+        max_in_flight: maximum number of snapshots waiting to be written.
+        keep_last: number of epoch-stamped checkpoints to retain; 0 disables them.
+        logger: optional logger for write and retention messages.
+    """
+
+    def __init__(self, max_in_flight: int = 1, keep_last: int = 0, logger: logging.Logger | None = None) -> None:
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be a positive integer, got {max_in_flight}.")
+        self.max_in_flight = max_in_flight
+        self.keep_last = keep_last
+        self.logger = logger or logging.getLogger("maisi.train.checkpoint")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ckpt_writer")
+        self._pending: deque[Future] = deque()
+        self._retained: deque[str] = deque()
+
+    @staticmethod
+    def _atomic_save(state: dict, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _atomic_copy(src_path: str, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _write(self, state: dict, path: str, epoch: int | None, is_best: bool) -> None:
+        start = time.perf_counter()
+        stem, ext = os.path.splitext(path)
+        self._atomic_save(state, path)
+        if is_best:
+            self._atomic_copy(path, f"{stem}_best{ext}")
+        if epoch is not None and self.keep_last > 0:
+            epoch_path = f"{stem}_epoch{epoch}{ext}"
+            self._atomic_copy(path, epoch_path)
+            self._retained.append(epoch_path)
+            while len(self._retained) > self.keep_last:
+                stale_path = self._retained.popleft()
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+        self.logger.info(f"Checkpoint written to {path} in {time.perf_counter() - start:.1f}s.")
+
+    def _wait(self, max_pending: int) -> None:
+        while len(self._pending) > max_pending:
+            # re-raises any exception of the writer thread
+            self._pending.popleft().result()
+
+    def save(self, state: dict, path: str, epoch: int | None = None, is_best: bool = False) -> None:
+        """
+        Snapshot ``state`` to host memory and schedule it to be written.
+
+        Args:
+            state (dict): checkpoint dictionary; tensors may live on any device.
+            path (str): path of the latest checkpoint.
+            epoch (int | None): epoch number of the epoch-stamped copy, or None to skip it.
+            is_best (bool): also write the ``_best`` copy.
+        """
+        self._wait(self.max_in_flight - 1)
+        snapshot = _snapshot_to_cpu(state)
+        self._pending.append(self._executor.submit(self._write, snapshot, path, epoch, is_best))
+
+    def close(self) -> None:
+        """Wait for all pending writes and stop the writer thread."""
+        self._wait(0)
+        self._executor.shutdown(wait=True)